@@ -0,0 +1,235 @@
+"""!
+@brief Module align
+Gain / offset alignment of drifted spectra without peak fitting.
+The map of each spectrum onto a reference, E_ref = gain E + offset, is
+found by batched FFT cross-correlation: on a log-energy axis a gain is a
+plain shift, so the gain comes from the lag of the log-axis correlation
+and then the offset from the lag on the linear axis.  Both estimates are
+refined by a straight line fit to the shifts of a few energy segments.
+All lags are interpolated to a fraction of a bin by a parabola through
+the correlation maximum.  Finally the spectra are resampled onto the
+reference grid in batches (see resample), conserving counts.
+
+Works on arith.SpectrumStack, so thousands of hourly spectra read with
+arith.iter_hdf5_chunks can be aligned and summed in a few seconds.
+"""
+from __future__ import division
+import numpy as np
+from scipy import fft as sp_fft
+import gammaspy.gammaData.arith as arith
+import gammaspy.gammaData.spectrum as spectrum
+
+ALIGN_DTYPE = [('gain', 'f8'), ('offset', 'f8'), ('corr', 'f8'), ('contrast', 'f8'),
+               ('ok', '?')]
+
+
+def resample(edges, counts, gain, offset, new_edges):
+    """!
+    @brief Move spectra to the energy axis E' = gain E + offset and rebin
+    them onto new_edges.  Counts are spread uniformly over each bin (as in
+    arith.rebin_matrix) by interpolating the cumulative counts, for all
+    spectra at once.
+    @param edges  np_array (n + 1,) bin edges shared by the spectra
+    @param counts  np_array (n_spectra, n)
+    @param gain  np_array (n_spectra,)
+    @param offset  np_array (n_spectra,)
+    @param new_edges  np_array (m + 1,)
+    @return np_array (n_spectra, m) counts
+    """
+    counts = np.atleast_2d(np.asarray(counts, dtype=float))
+    gain = np.asarray(gain, dtype=float).reshape(-1, 1)
+    offset = np.asarray(offset, dtype=float).reshape(-1, 1)
+    cum = np.concatenate((np.zeros((len(counts), 1)), np.cumsum(counts, axis=1)), axis=1)
+    # new edges on the original axis of each spectrum
+    x = (np.asarray(new_edges, dtype=float)[np.newaxis, :] - offset) / gain
+    x = np.clip(x, edges[0], edges[-1])
+    idx = np.clip(np.searchsorted(edges, x), 1, len(edges) - 1)
+    frac = (x - edges[idx - 1]) / (edges[idx] - edges[idx - 1])
+    rows = np.arange(len(counts))[:, np.newaxis]
+    cum_new = cum[rows, idx - 1] + frac * (cum[rows, idx] - cum[rows, idx - 1])
+    return np.diff(cum_new, axis=1)
+
+
+def _features(counts, width):
+    """!
+    @brief Peak emphasizing correlation signal: variance stabilized counts
+    minus their moving average (width bins), normalized to unit length.
+    """
+    sig = np.sqrt(np.maximum(counts, 0.))
+    cum = np.concatenate((np.zeros((len(sig), 1)), np.cumsum(sig, axis=1)), axis=1)
+    n = sig.shape[1]
+    half = max(int(width) // 2, 1)
+    lo = np.clip(np.arange(n) - half, 0, n)
+    hi = np.clip(np.arange(n) + half + 1, 0, n)
+    sig = sig - (cum[:, hi] - cum[:, lo]) / (hi - lo)
+    norm = np.linalg.norm(sig, axis=1, keepdims=True)
+    return sig / np.where(norm > 0., norm, 1.)
+
+
+def xcorr_lag(signals, ref, max_lag, exclude=3):
+    """!
+    @brief Lag of the maximum of the cross-correlation of each signal with
+    the reference, c[k] = sum_n ref[n + k] signal[n], for |k| <= max_lag.
+    @param signals  np_array (n_spectra, n) unit length features
+    @param ref  np_array (n,) unit length feature of the reference, or
+        (n_spectra, n) one reference per signal
+    @param exclude  Int. Half width (bins) of the main peak when looking
+        for the second highest correlation
+    @return (lag (sub bin), max correlation, contrast to the second
+        highest correlation, bool lag not at the search limit)
+    """
+    n = signals.shape[1]
+    max_lag = int(min(max_lag, n - 2))
+    # zero padding by max_lag is enough to keep the wanted lags free of wrap around
+    n_fft = sp_fft.next_fast_len(n + max_lag + 1, real=True)
+    spec_ref = sp_fft.rfft(np.atleast_2d(ref), n_fft, axis=1)
+    corr = sp_fft.irfft(spec_ref * np.conj(sp_fft.rfft(signals, n_fft, axis=1)), n_fft, axis=1)
+    lags = np.arange(-max_lag, max_lag + 1)
+    corr = corr[:, lags % n_fft]
+    k = np.argmax(corr, axis=1)
+    rows = np.arange(len(corr))
+    c1 = corr[rows, k]
+    c0 = corr[rows, np.maximum(k - 1, 0)]
+    c2 = corr[rows, np.minimum(k + 1, len(lags) - 1)]
+    denom = c0 - 2. * c1 + c2
+    delta = np.where(denom < 0., 0.5 * (c0 - c2) / np.where(denom < 0., denom, -1.), 0.)
+    inside = (k > 0) & (k < len(lags) - 1)
+    masked = np.where(np.abs(np.arange(len(lags))[np.newaxis, :] - k[:, np.newaxis]) > exclude,
+                      corr, -np.inf)
+    second = np.max(masked, axis=1) if len(lags) > 2 * exclude + 1 else np.zeros(len(corr))
+    contrast = c1 / np.where(second > 0., second, np.inf)
+    contrast = np.where(second > 0., contrast, np.inf)
+    return lags[k] + np.clip(delta, -0.5, 0.5), c1, contrast, inside
+
+
+def estimate_alignment(edges, counts, ref_counts, e_min=None, e_max=None, max_gain_dev=0.05,
+                       max_offset=10., n_iter=2, n_segments=4, baseline_width=16):
+    """!
+    @brief Gain and offset of spectra relative to a reference.
+    A coarse gain (log axis, offset neglected) and offset (linear axis)
+    are refined by measuring the residual shift in n_segments energy
+    segments and fitting it with a straight line, which removes the
+    coupling between gain and offset in one step.
+    @param edges  np_array (n + 1,) bin edges shared by spectra and reference
+    @param counts  np_array (n_spectra, n)
+    @param ref_counts  np_array (n,)
+    @param e_min  Float. Lower energy of the coarse gain correlation
+        (default 1/4 of e_max, where an offset is small compared to E)
+    @param e_max  Float. Upper energy of the correlations
+    @param max_gain_dev  Float. Max |gain - 1|
+    @param max_offset  Float. Max |offset| (keV)
+    @param n_iter  Int. Number of segment refinements
+    @param n_segments  Int. Number of energy segments of the refinement
+    @param baseline_width  Int. Moving average window (bins) of the
+        continuum removed before correlating
+    @return np structured array (ALIGN_DTYPE), quality of the final
+        whole range correlation
+    """
+    counts = np.atleast_2d(np.asarray(counts, dtype=float))
+    edges = np.asarray(edges, dtype=float)
+    e_max = edges[-1] if e_max is None else e_max
+    e_min = max(0.25 * e_max, edges[0] + 1e-3) if e_min is None else e_min
+    # log grid as fine as the linear grid at e_max
+    width = np.min(np.diff(edges))
+    d_log = width / e_max
+    log_edges = np.exp(np.arange(np.log(e_min), np.log(e_max) + d_log, d_log))
+    lin_edges = np.arange(edges[0], e_max + 0.5 * width, width)
+    n_spec = len(counts)
+    ones, zeros = np.ones(n_spec), np.zeros(n_spec)
+    ref_log = _features(resample(edges, ref_counts, [1.], [0.], log_edges), baseline_width)[0]
+    ref_lin = resample(edges, ref_counts, [1.], [0.], lin_edges)
+    max_lin_lag = np.ceil(max_offset / width) + 1
+
+    # coarse gain, then offset
+    sig = _features(resample(edges, counts, ones, zeros, log_edges), baseline_width)
+    lag, _, _, ok_gain = xcorr_lag(sig, ref_log, np.ceil(np.log1p(max_gain_dev) / d_log) + 1)
+    gain = np.exp(lag * d_log)
+    sig = _features(resample(edges, counts, gain, zeros, lin_edges), baseline_width)
+    lag, _, _, ok_offset = xcorr_lag(sig, _features(ref_lin, baseline_width)[0], max_lin_lag)
+    offset = lag * width
+
+    # residual shift a + b E from segment correlations
+    seg_len = (len(lin_edges) - 1) // n_segments
+    n_used = seg_len * n_segments
+    seg_energy = lin_edges[0] + width * seg_len * (np.arange(n_segments) + 0.5)
+    ref_seg = _features(ref_lin[0, :n_used].reshape(n_segments, seg_len), baseline_width)
+    ref_seg = np.tile(ref_seg, (n_spec, 1))
+    design = np.column_stack((np.ones(n_segments), seg_energy))
+    # the coarse estimate leaves residual shifts of a few bins at most
+    seg_max_lag = min(8, seg_len // 4)
+    for _ in range(n_iter):
+        aligned = resample(edges, counts, gain, offset, lin_edges)[:, :n_used]
+        sig = _features(aligned.reshape(n_spec * n_segments, seg_len), baseline_width)
+        lag, corr, _, inside = xcorr_lag(sig, ref_seg, seg_max_lag)
+        shift = (lag * width).reshape(n_spec, n_segments)
+        w = (np.clip(corr, 0., None) ** 2 * inside).reshape(n_spec, n_segments)
+        for i in range(n_spec):
+            if np.count_nonzero(w[i] > 0.) < 2:
+                continue
+            sw = np.sqrt(w[i])
+            a, b = np.linalg.lstsq(design * sw[:, np.newaxis], shift[i] * sw, rcond=None)[0]
+            gain[i], offset[i] = (1. + b) * gain[i], (1. + b) * offset[i] + a
+
+    sig = _features(resample(edges, counts, gain, offset, lin_edges), baseline_width)
+    _, corr, contrast, _ = xcorr_lag(sig, _features(ref_lin, baseline_width)[0], max_lin_lag)
+    report = np.zeros(n_spec, dtype=ALIGN_DTYPE)
+    report['gain'] = gain
+    report['offset'] = offset
+    report['corr'] = corr
+    report['contrast'] = contrast
+    report['ok'] = ok_gain & ok_offset & (np.abs(gain - 1.) <= max_gain_dev) & \
+        (np.abs(offset) <= max_offset)
+    return report
+
+
+def align_stack(stack, reference=0, min_corr=0.2, min_contrast=1.2, batch_size=256, **kwargs):
+    """!
+    @brief Align every spectrum of a stack to a reference and resample
+    them onto the stack grid.  Spectra whose alignment is not trusted
+    (correlation or contrast too low, lag at the search limit) are kept
+    unchanged and flagged in the report.
+    Variances are resampled like the counts, an upper bound of the
+    propagated variance.
+    @param stack  arith.SpectrumStack
+    @param reference  Int. Row of the reference spectrum, or np_array of
+        reference counts on the stack grid
+    @param batch_size  Int. Spectra aligned per batch (bounds memory)
+    @param kwargs  keyword args of estimate_alignment
+    @return (aligned arith.SpectrumStack, report np structured array)
+    """
+    ref_counts = stack.counts[reference] if np.ndim(reference) == 0 else np.asarray(reference)
+    report = np.zeros(len(stack), dtype=ALIGN_DTYPE)
+    counts = np.empty_like(stack.counts)
+    variance = np.empty_like(stack.variance)
+    for start in range(0, len(stack), batch_size):
+        batch = slice(start, start + batch_size)
+        rep = estimate_alignment(stack.edges, stack.counts[batch], ref_counts, **kwargs)
+        rep['ok'] &= (rep['corr'] >= min_corr) & (rep['contrast'] >= min_contrast)
+        gain = np.where(rep['ok'], rep['gain'], 1.)
+        offset = np.where(rep['ok'], rep['offset'], 0.)
+        counts[batch] = resample(stack.edges, stack.counts[batch], gain, offset, stack.edges)
+        variance[batch] = resample(stack.edges, stack.variance[batch], gain, offset, stack.edges)
+        report[batch] = rep
+    n_bad = np.count_nonzero(~report['ok'])
+    if n_bad:
+        print("WARNING: %d of %d spectra could not be aligned" % (n_bad, len(stack)))
+    return arith.SpectrumStack(stack.edges, counts, variance, stack.live_time,
+                               stack.real_time), report
+
+
+def sum_aligned(spectra, reference=0, edges=None, **kwargs):
+    """!
+    @brief Sum of several GammaSpectrum after gain / offset alignment to
+    the reference spectrum (on the grid of the first one)
+    @param kwargs  keyword args of align_stack
+    @return (GammaSpectrum, np_array variance of the summed counts, report)
+    """
+    stack = arith.SpectrumStack.from_spectra([spec.spectrum for spec in spectra],
+                                             [spec.metadata for spec in spectra], edges)
+    aligned, report = align_stack(stack, reference, **kwargs)
+    total = aligned.total()
+    spec_array, metadata = total.spectrum(0)
+    new_metadata = dict(spectra[0].metadata)
+    new_metadata.update(metadata)
+    return (spectrum.GammaSpectrum(spec_array, new_metadata, shape_cal=spectra[0].shape_cal),
+            total.variance[0], report)
@@ -0,0 +1,303 @@
+"""!
+@brief Module arith
+Spectrum arithmetic on stacks of spectra: conservative rebinning onto a
+common energy grid, summing, live time normalization and background
+subtraction with Poisson variance propagation, and chunked reduction of
+spectra stored in HDF5 files.
+
+Bin convention: the energy of channel i is the upper edge of the bin and
+its width is e[i] - e[i-1] (the first width is copied from the second),
+the same widths used by DataReader.conv_counts_per_enregy and Roi, so
+counts <-> counts / keV round trips exactly.
+"""
+from __future__ import division
+import numpy as np
+from scipy import sparse
+import gammaspy.gammaData.reader as reader
+import gammaspy.gammaData.calibration as calibration
+import gammaspy.gammaData.spectrum as spectrum
+
+
+def bin_edges(energy):
+    """!
+    @brief Bin edges (n + 1,) of a spectrum energy column (n,)
+    """
+    energy = np.asarray(energy, dtype=float)
+    first_width = energy[1] - energy[0] if len(energy) > 1 else 1.
+    return np.concatenate(([energy[0] - first_width], energy))
+
+
+def calibrated_edges(e_cal, n_channels):
+    """!
+    @brief Bin edges of a spectrum of n_channels channels with energy
+    calibration polynomial e_cal (E(ch) = sum_i e_cal[i] ch^i).
+    """
+    return bin_edges(calibration.channel_energy(e_cal, n_channels))
+
+
+def to_counts(spectrum):
+    """!
+    @brief Counts per channel of a [energy, counts / keV] array
+    """
+    return spectrum[:, 1] * np.diff(bin_edges(spectrum[:, 0]))
+
+
+def to_spectrum(edges, counts):
+    """!
+    @brief [energy, counts / keV] array from bin edges and counts
+    """
+    return np.column_stack((edges[1:], counts / np.diff(edges)))
+
+
+def rebin_matrix(old_edges, new_edges):
+    """!
+    @brief Sparse (n_new, n_old) matrix R with new_counts = R old_counts.
+    Counts are assumed uniformly distributed in each old bin, so R[j, i]
+    is the fraction of old bin i overlapping new bin j.  Counts are
+    conserved over the overlapping energy range.
+    Variances propagate as new_var = (R * R) old_var.
+    """
+    old_edges = np.asarray(old_edges, dtype=float)
+    new_edges = np.asarray(new_edges, dtype=float)
+    lo, hi = max(old_edges[0], new_edges[0]), min(old_edges[-1], new_edges[-1])
+    cuts = np.union1d(old_edges, new_edges)
+    cuts = cuts[(cuts >= lo) & (cuts <= hi)]
+    seg_len = np.diff(cuts)
+    mid = 0.5 * (cuts[:-1] + cuts[1:])
+    i_old = np.searchsorted(old_edges, mid) - 1
+    i_new = np.searchsorted(new_edges, mid) - 1
+    frac = seg_len / np.diff(old_edges)[i_old]
+    return sparse.coo_matrix((frac, (i_new, i_old)),
+                             shape=(len(new_edges) - 1, len(old_edges) - 1)).tocsr()
+
+
+def rebin(counts, old_edges, new_edges, variance=None):
+    """!
+    @brief Conservative rebinning of a spectrum or a stack of spectra that
+    share the same binning.
+    @param counts  np_array (n_old,) or (n_spectra, n_old)
+    @param variance  np_array like counts (default: Poisson, = counts)
+    @return (new counts, new variance), shape (..., n_new)
+    """
+    mat = rebin_matrix(old_edges, new_edges)
+    counts = np.asarray(counts, dtype=float)
+    variance = counts if variance is None else np.asarray(variance, dtype=float)
+    return (mat.dot(counts.T).T, mat.multiply(mat).dot(variance.T).T)
+
+
+class SpectrumStack(object):
+    """!
+    @brief Counts of several spectra on one common energy grid.
+    @param edges  np_array (n_bins + 1,) common bin edges (keV)
+    @param counts  np_array (n_spectra, n_bins)
+    @param variance  np_array (n_spectra, n_bins), default Poisson
+    @param live_time  np_array (n_spectra,) live times (s)
+    @param real_time  np_array (n_spectra,) real times (s)
+    """
+    def __init__(self, edges, counts, variance=None, live_time=None, real_time=None):
+        self.edges = np.asarray(edges, dtype=float)
+        self.counts = np.atleast_2d(np.asarray(counts, dtype=float))
+        self.variance = self.counts.copy() if variance is None else \
+            np.atleast_2d(np.asarray(variance, dtype=float))
+        n = len(self.counts)
+        self.live_time = np.ones(n) if live_time is None else \
+            np.asarray(live_time, dtype=float).reshape(n)
+        self.real_time = self.live_time.copy() if real_time is None else \
+            np.asarray(real_time, dtype=float).reshape(n)
+
+    @classmethod
+    def from_spectra(cls, spectra, metadata, edges=None):
+        """!
+        @brief Rebin [energy, counts / keV] arrays onto a common grid.
+        Spectra with identical energy columns are rebinned together in a
+        single sparse product.
+        @param spectra  list of np_array (n_i, 2)
+        @param metadata  list of metadata dicts (l_time, r_time)
+        @param edges  np_array common bin edges (default: grid of the first spectrum)
+        """
+        edges = bin_edges(spectra[0][:, 0]) if edges is None else np.asarray(edges, dtype=float)
+        counts = np.zeros((len(spectra), len(edges) - 1))
+        variance = np.zeros_like(counts)
+        groups = {}
+        for i, spec in enumerate(spectra):
+            groups.setdefault(np.ascontiguousarray(spec[:, 0]).tobytes(), []).append(i)
+        for idxs in groups.values():
+            raw = np.array([to_counts(spectra[i]) for i in idxs])
+            counts[idxs], variance[idxs] = rebin(raw, bin_edges(spectra[idxs[0]][:, 0]), edges)
+        live_time = [md.get('l_time', 1.) for md in metadata]
+        real_time = [md.get('r_time', md.get('l_time', 1.)) for md in metadata]
+        return cls(edges, counts, variance, live_time, real_time)
+
+    def __len__(self):
+        return len(self.counts)
+
+    @property
+    def energy(self):
+        return self.edges[1:]
+
+    def rebin(self, new_edges):
+        """!
+        @brief New stack on the grid new_edges
+        """
+        mat = rebin_matrix(self.edges, new_edges)
+        return SpectrumStack(new_edges, mat.dot(self.counts.T).T,
+                             mat.multiply(mat).dot(self.variance.T).T,
+                             self.live_time, self.real_time)
+
+    def total(self):
+        """!
+        @brief Sum of all spectra as a single row stack.  Live and real
+        times add.
+        """
+        return SpectrumStack(self.edges, np.sum(self.counts, axis=0), np.sum(self.variance, axis=0),
+                             [np.sum(self.live_time)], [np.sum(self.real_time)])
+
+    def rates(self):
+        """!
+        @brief Live time normalized count rates and their variance
+        @return (rates, variances) np_arrays (n_spectra, n_bins), counts / s
+        """
+        lt = self.live_time[:, np.newaxis]
+        return self.counts / lt, self.variance / lt ** 2.
+
+    def subtract(self, background):
+        """!
+        @brief Live time normalized background subtraction:
+        \f[
+        N = S - (t_S / t_B) B, \quad \sigma_N^2 = \sigma_S^2 + (t_S / t_B)^2 \sigma_B^2
+        \f]
+        @param background  SpectrumStack with one row (subtracted from every
+            spectrum) or one row per spectrum.  Rebinned to this grid
+            if needed
+        @return SpectrumStack of net counts
+        """
+        if not np.array_equal(background.edges, self.edges):
+            background = background.rebin(self.edges)
+        scale = (self.live_time / background.live_time)[:, np.newaxis]
+        return SpectrumStack(self.edges, self.counts - scale * background.counts,
+                             self.variance + scale ** 2. * background.variance,
+                             self.live_time, self.real_time)
+
+    def window_counts(self, windows):
+        """!
+        @brief Counts and variance in energy windows of every spectrum
+        (e.g. the time series of a line).  Windows are applied
+        conservatively (partial bins are prorated).
+        @param windows  list of (lo, hi) energies (keV)
+        @return (counts, variance) np_arrays (n_spectra, n_windows)
+        """
+        windows = np.asarray(windows, dtype=float).reshape(-1, 2)
+        rows = [rebin_matrix(self.edges, window) for window in windows]
+        mat = sparse.vstack(rows).tocsr()
+        return mat.dot(self.counts.T).T, mat.multiply(mat).dot(self.variance.T).T
+
+    def spectrum(self, i=0):
+        """!
+        @brief [energy, counts / keV] array and metadata of spectrum i, for
+        GammaSpectrum
+        """
+        metadata = {'l_time': float(self.live_time[i]), 'r_time': float(self.real_time[i])}
+        return to_spectrum(self.edges, self.counts[i]), metadata
+
+
+def _gamma_spectrum(stack, template):
+    spec_array, metadata = stack.spectrum(0)
+    new_metadata = dict(template.metadata)
+    new_metadata.update(metadata)
+    return spectrum.GammaSpectrum(spec_array, new_metadata, shape_cal=template.shape_cal)
+
+
+def sum_spectra(spectra, edges=None):
+    """!
+    @brief Sum of several GammaSpectrum (e.g. repeated counts), rebinned
+    onto the grid of the first one.
+    @return (GammaSpectrum, np_array variance of the summed counts)
+    """
+    stack = SpectrumStack.from_spectra([spec.spectrum for spec in spectra],
+                                       [spec.metadata for spec in spectra], edges).total()
+    return _gamma_spectrum(stack, spectra[0]), stack.variance[0]
+
+
+def subtract_spectra(sample, background):
+    """!
+    @brief Live time normalized sample - background GammaSpectrum
+    @return (net GammaSpectrum, np_array variance of the net counts)
+    """
+    stack = SpectrumStack.from_spectra([sample.spectrum], [sample.metadata])
+    bg = SpectrumStack.from_spectra([background.spectrum], [background.metadata], stack.edges)
+    net = stack.subtract(bg)
+    return _gamma_spectrum(net, sample), net.variance[0]
+
+
+def iter_hdf5_chunks(sources, chunk_size=64):
+    """!
+    @brief Read spectra stored in HDF5 files chunk by chunk.
+    @param sources  list of file names (channel 0) or (file name, channel) pairs
+    @param chunk_size  Int. Max number of spectra per chunk
+    @return generator of (metadata list, spectrum array list)
+    """
+    dreader = reader.DataReader()
+    sources = [(src, 0) if not isinstance(src, (tuple, list)) else tuple(src) for src in sources]
+    for start in range(0, len(sources), chunk_size):
+        chunk = sources[start:start + chunk_size]
+        metadata, spectra = [], []
+        # one file open per distinct file in the chunk
+        by_file = {}
+        for pos, (fname, chan) in enumerate(chunk):
+            by_file.setdefault(fname, []).append((pos, chan))
+        out = [None] * len(chunk)
+        for fname, entries in by_file.items():
+            mdata, data = dreader.read_channels(fname, [chan for pos, chan in entries])
+            for (pos, chan), md, spec in zip(entries, mdata, data):
+                out[pos] = (md, spec)
+        for md, spec in out:
+            metadata.append(md)
+            spectra.append(spec)
+        yield metadata, spectra
+
+
+def aggregate_hdf5(sources, edges=None, chunk_size=64, windows=None, background=None):
+    """!
+    @brief Sum many spectra stored in HDF5 files without loading them all
+    at once.  Only one chunk of spectra is held in memory; the running
+    sum is kept on the common grid.
+    @param sources  list of file names or (file name, channel) pairs
+    @param edges  np_array common bin edges (default: grid of the first spectrum)
+    @param chunk_size  Int. Number of spectra read and rebinned at a time
+    @param windows  list of (lo, hi) energy windows.  If given the per
+        spectrum window counts (a time series) are returned as well
+    @param background  SpectrumStack (one row) subtracted live time
+        normalized.  It is subtracted once from the total, scaled by the
+        summed live time, so its variance enters as
+        \f$ (\sum_i t_i / t_B)^2 \sigma_B^2 \f$.  The per spectrum window
+        counts are net of the background too; they share the same
+        background estimate and are therefore correlated (covariance
+        \f$ (t_i t_j / t_B^2) \sigma_B^2 \f$), which the returned
+        per spectrum variances do not include
+    @return total SpectrumStack, or (total, window counts, window variance,
+        live times) if windows are given
+    """
+    total = None
+    series, series_var, live_times = [], [], []
+    for metadata, spectra in iter_hdf5_chunks(sources, chunk_size):
+        stack = SpectrumStack.from_spectra(spectra, metadata, edges)
+        edges = stack.edges
+        if windows is not None:
+            net = stack.subtract(background) if background is not None else stack
+            w_counts, w_var = net.window_counts(windows)
+            series.append(w_counts)
+            series_var.append(w_var)
+            live_times.append(stack.live_time)
+        chunk_total = stack.total()
+        if total is None:
+            total = chunk_total
+        else:
+            total.counts += chunk_total.counts
+            total.variance += chunk_total.variance
+            total.live_time += chunk_total.live_time
+            total.real_time += chunk_total.real_time
+    if background is not None and total is not None:
+        total = total.subtract(background)
+    if windows is None:
+        return total
+    return total, np.concatenate(series), np.concatenate(series_var), np.concatenate(live_times)
@@ -0,0 +1,247 @@
+"""!
+@brief Module basemodel
+Shared interface for all peak and background models.
+"""
+from __future__ import division
+import numpy as np
+import numdifftools as nd
+
+
+def batch_params(params):
+    """!
+    @brief Splits a parameter vector into per-parameter arrays.
+    A single vector of shape (n_params,) is returned unchanged.  A stack
+    of parameter vectors of shape (n_batch, n_params) is transposed and
+    given a trailing axis so that params[i] has shape (n_batch, 1) and
+    broadcasts against an abscissa array of shape (n_x,).
+    @param params  array_like (n_params,) or (n_batch, n_params)
+    @return np_array
+    """
+    p = np.asarray(params, dtype=float)
+    if p.ndim == 2:
+        return p.T[:, :, np.newaxis]
+    return p
+
+
+def batch_columns(params):
+    """!
+    @brief Like batch_params, but without the trailing abscissa axis.
+    Used by functions of the parameters only (areas, integrals).
+    @param params  array_like (n_params,) or (n_batch, n_params)
+    @return np_array
+    """
+    p = np.asarray(params, dtype=float)
+    if p.ndim == 2:
+        return p.T
+    return p
+
+
+class BaseModel(object):
+    """!
+    @brief Base class of all peak and background models.
+
+    Every model evaluates on a single parameter vector of shape (n_params,)
+    or on a stack of parameter vectors of shape (n_batch, n_params).
+    The shapes of the returned arrays are:
+        - eval:      (n_x,)            or (n_batch, n_x)
+        - jac:       (n_x, n_params)   or (n_batch, n_x, n_params)
+        - area:      scalar            or (n_batch,)
+        - area_jac:  (n_params,)       or (n_batch, n_params)
+
+    Derived classes set the class attributes below and implement eval,
+    jac, integral and (for peaks) area and area_jac.
+    """
+    ## Default model name
+    default_name = "base"
+    ## "peak" or "bg".  Peaks contribute to the net area.
+    model_type = "bg"
+    ## Default initial parameters
+    default_params = []
+    ## Human readable parameter names
+    param_names = []
+    ## Index of the location parameter for shift invariant models f(x - mu)
+    shift_idx = None
+    ## Indices of params with units of energy (widths, tail lengths)
+    width_idxs = ()
+    ## Indices of params with units of counts / energy (heights)
+    height_idxs = ()
+    ## (mean index, sigma index) of each peak component (a multiplet
+    ## model has several)
+    peak_components = ()
+
+    def __init__(self, init_params=None, **kwargs):
+        self.name = kwargs.pop("name", self.default_name)
+        self.bounds = self.default_bounds()
+        self.params = init_params
+        self.model_trust = 1
+
+    def default_bounds(self):
+        """!
+        @brief ((min bounds), (max param bounds))
+        """
+        n = len(self.default_params)
+        return (tuple([-np.inf] * n), tuple([np.inf] * n))
+
+    @property
+    def n_params(self):
+        return len(self.default_params)
+
+    @property
+    def params(self):
+        return self._params
+
+    @params.setter
+    def params(self, params):
+        if params is None:
+            self._params = list(self.default_params)
+        else:
+            assert(len(params) == self.n_params)
+            self._params = params
+
+    def guess(self, x, y):
+        """!
+        @brief Initial parameter guess from (x, y) samples of the
+        component this model describes.  Defaults to current params.
+        """
+        return list(self.params)
+
+    def remap(self, params, g, dg, x):
+        """!
+        @brief Params of the same component on a new energy axis E' = g(E).
+        Shift invariant models move their location to g(mu) and scale
+        their widths by g'(mu) and heights by 1 / g'(mu), so the counts
+        are conserved.  Other models are re-guessed from the remapped
+        density sampled at x.
+        @param params  model parameter array (n_params,)
+        @param g  Callable energy map
+        @param dg  Callable derivative of the energy map
+        @param x  np_array of old energies the model is used at
+        @return np_array of remapped params
+        """
+        p = np.array(params, dtype=float)
+        if self.shift_idx is None:
+            return np.array(self.guess(g(x), self.eval(p, x) / dg(x)), dtype=float)
+        mu = p[self.shift_idx]
+        p[list(self.width_idxs)] *= dg(mu)
+        p[list(self.height_idxs)] /= dg(mu)
+        p[self.shift_idx] = g(mu)
+        return p
+
+    def eval(self, params, x):
+        """!
+        @brief Evaluate the model.  ODR pack argument ordering f([params], x).
+        @param params  model parameter array (n_params,) or (n_batch, n_params)
+        @param x np_array of abscissa
+        """
+        raise NotImplementedError
+
+    def opti_eval(self, x, *params):
+        """!
+        @brief Identical to eval, with flipped argument positions.
+        Scipy optimization routines typically like f(x, *params) format.
+        """
+        return self.eval(params, x)
+
+    def jac(self, params, x):
+        """!
+        @brief Jacobian of the model wrt. the parameters.
+        Falls back to finite differences when a derived class does not
+        provide an analytic form.
+        """
+        fn = lambda p: self.eval(p, x)
+        return np.atleast_2d(nd.Jacobian(fn)(params)).reshape(len(x), -1)
+
+    def deriv(self, params, x):
+        """!
+        @brief Derivative of the model wrt. the abscissa.
+        For shift invariant models this is -df/dmu.
+        """
+        if self.shift_idx is not None:
+            return -self.jac(params, x)[..., self.shift_idx]
+        dx = 1e-6 * np.maximum(np.abs(x), 1.)
+        return (self.eval(params, x + dx) - self.eval(params, x - dx)) / (2. * dx)
+
+    def integral(self, a, b, params):
+        """!
+        @brief Definite integral of the model on [a, b].
+        """
+        raise NotImplementedError
+
+    def int_jac(self, a, b, params):
+        """!
+        @brief Jacobian of the definite integral for
+        area uncertainty calculations.
+        """
+        reduced_int = lambda p: self.integral(a, b, p)
+        jac = nd.Jacobian(reduced_int, step=1e-8)(params)
+        return jac
+
+    def int_hess(self, a, b, params):
+        """!
+        @brief Computes hessian of the definite integral.
+        \f[
+        H^-1 \approx C
+        \f]
+        Where $C$ is the covar matrix and $H$ is the hessian.
+        """
+        reduced_int = lambda p: self.integral(a, b, p)
+        hess_matrix = nd.Hessian(reduced_int)(params)
+        return hess_matrix
+
+    def area(self, params):
+        """!
+        @brief Area under the entire model on $(-\infty, \infty)$.
+        """
+        raise NotImplementedError
+
+    def area_jac(self, params):
+        """!
+        @brief Jacobian of the area function.
+        """
+        jac = nd.Jacobian(self.area, step=1e-6)(params)
+        return jac
+
+    def area_hess(self, params):
+        """!
+        @brief Compute hessian of the area function
+        """
+        hess_matrix = nd.Hessian(self.area)(params)
+        return hess_matrix
+
+
+class ModelRegistry(object):
+    """!
+    @brief Name -> model class lookup used by the model factories.
+    New shapes are plugged in with register().
+    """
+    def __init__(self, default=None):
+        self._models = {}
+        self.default = default
+
+    def register(self, name, model_class=None):
+        """!
+        @brief Register a model class.  May be used as a class decorator:
+        @verbatim
+        @peak_models.register("mymodel")
+        class MyModel(BaseModel): ...
+        @endverbatim
+        """
+        if model_class is None:
+            def decorator(cls):
+                self._models[name] = cls
+                return cls
+            return decorator
+        self._models[name] = model_class
+        return model_class
+
+    def get(self, name):
+        if name in self._models:
+            return self._models[name]
+        print("WARNING: unknown model %s, using %s" % (name, self.default))
+        return self._models[self.default]
+
+    def names(self):
+        return sorted(self._models.keys())
+
+    def __contains__(self, name):
+        return name in self._models
@@ -1,43 +1,46 @@
 """!
 @brief Module background
-Contains background model def
+Contains background model defs
 """
 from __future__ import division
 import numpy as np
-import numdifftools as nd
+from scipy.special import erfc
+from gammaspy.gammaData.basemodel import BaseModel, ModelRegistry, \
+    batch_params, batch_columns
+from gammaspy.gammaData.peak import stack_jac, SQRT2, SIGMA_MIN
 
+## Registry of all available background shapes
+bg_models = ModelRegistry(default="linear")
 
-class LinModel(object):
+
+@bg_models.register("linear")
+class LinModel(BaseModel):
     """!
     @brief Linear background model.
     """
-    def __init__(self, init_params=[0., 100.], **kwargs):
-        self.name = kwargs.pop("name", "linear")
-        self.bounds = ((-np.inf, -np.inf), (np.inf, np.inf))
-        self._params = init_params
-
-    @property
-    def params(self):
-        return self._params
-
-    @params.setter
-    def params(self, params):
-        if params is None:
-            self._params = [0., 100.]
-        else:
-            assert(len(params) == 2)
-            self._params = params
+    default_name = "linear"
+    default_params = [0., 100.]
+    param_names = ["slope", "intercept"]
+
+    def guess(self, x, y):
+        return list(np.polyfit(x, y, 1))
 
     def eval(self, params, x):
         """!
         @brief Evaluate the linear background model
         """
-        model_f = params[0] * x + params[1]
+        p = batch_params(params)
+        model_f = p[0] * x + p[1]
         return model_f
 
-    def opti_eval(self, x, *params):
-        model_f = params[0] * x + params[1]
-        return model_f
+    def jac(self, params, x):
+        p = batch_params(params)
+        shape = np.broadcast(p[0], x).shape
+        return stack_jac([x, 1.], shape)
+
+    def deriv(self, params, x):
+        p = batch_params(params)
+        return np.broadcast_to(p[0], np.broadcast(p[0], x).shape)
 
     def integral(self, a, b, params):
         """!
@@ -46,8 +49,9 @@ class LinModel(object):
         @param b End.
         @param params  model parameter array (len=2)
         """
-        f_f = params[0] * b ** 2. / 2. + params[1] * b
-        f_i = params[0] * a ** 2. / 2. + params[1] * a
+        p = batch_columns(params)
+        f_f = p[0] * b ** 2. / 2. + p[1] * b
+        f_i = p[0] * a ** 2. / 2. + p[1] * a
         return f_f - f_i
 
     def int_jac(self, a, b, params):
@@ -59,22 +63,157 @@ class LinModel(object):
         \f]
         Where $C$ is the covar matrix and $H$ is the jacobian.
         """
-        reduced_int = lambda p: self.integral(a, b, p)
-        jac = nd.Jacobian(reduced_int, step=1e-8)(params)
-        return jac
+        p = batch_columns(params)
+        return stack_jac([(b ** 2. - a ** 2.) / 2., b - a], np.shape(p[0]))
+
+
+@bg_models.register("quadratic")
+class QuadModel(BaseModel):
+    """!
+    @brief Quadratic background model.
+    \f[
+    y(x) = c_2 x^2 + c_1 x + c_0
+    \f]
+    """
+    default_name = "quadratic"
+    default_params = [0., 0., 100.]
+    param_names = ["c2", "c1", "c0"]
+
+    def guess(self, x, y):
+        return [0.] + list(np.polyfit(x, y, 1))
+
+    def eval(self, params, x):
+        p = batch_params(params)
+        return (p[0] * x + p[1]) * x + p[2]
+
+    def jac(self, params, x):
+        p = batch_params(params)
+        shape = np.broadcast(p[0], x).shape
+        return stack_jac([x ** 2., x, 1.], shape)
+
+    def deriv(self, params, x):
+        p = batch_params(params)
+        return 2. * p[0] * x + p[1]
+
+    def integral(self, a, b, params):
+        p = batch_columns(params)
+        prim = lambda t: p[0] * t ** 3. / 3. + p[1] * t ** 2. / 2. + p[2] * t
+        return prim(b) - prim(a)
+
+    def int_jac(self, a, b, params):
+        p = batch_columns(params)
+        return stack_jac([(b ** 3. - a ** 3.) / 3., (b ** 2. - a ** 2.) / 2., b - a],
+                         np.shape(p[0]))
+
+
+@bg_models.register("exponential")
+class ExpModel(BaseModel):
+    """!
+    @brief Exponential background model.
+    \f[
+    y(x) = A e^{k (x - x_0)}
+    \f]
+    The reference energy $x_0$ is fixed (usually the ROI center) so that
+    $A$ stays well conditioned for spectra extending to several MeV.
+    """
+    default_name = "exponential"
+    default_params = [100., 0.]
+    param_names = ["amplitude", "rate"]
+
+    def __init__(self, init_params=None, **kwargs):
+        self.x0 = kwargs.pop("x0", 0.)
+        super(ExpModel, self).__init__(init_params, **kwargs)
+
+    def default_bounds(self):
+        return ((0., -np.inf), (np.inf, np.inf))
+
+    def guess(self, x, y):
+        rate, log_amp = np.polyfit(x - self.x0, np.log(np.maximum(y, 1e-3)), 1)
+        return [np.exp(log_amp), rate]
+
+
+    def eval(self, params, x):
+        p = batch_params(params)
+        return p[0] * np.exp(p[1] * (x - self.x0))
+
+    def jac(self, params, x):
+        p = batch_params(params)
+        e = np.exp(p[1] * (x - self.x0))
+        return stack_jac([e, p[0] * (x - self.x0) * e], e.shape)
+
+    def deriv(self, params, x):
+        p = batch_params(params)
+        return p[1] * self.eval(params, x)
+
+    def integral(self, a, b, params):
+        """!
+        @brief Definite integral, exact in the limit k -> 0.
+        """
+        p = batch_columns(params)
+        k = p[1]
+        w = b - a
+        safe_k = np.where(np.abs(k * w) > 1e-12, k, 1.)
+        ratio = np.where(np.abs(k * w) > 1e-12, np.expm1(k * w) / safe_k, w)
+        return p[0] * np.exp(k * (a - self.x0)) * ratio
+
+
+@bg_models.register("step")
+class StepModel(BaseModel):
+    """!
+    @brief Smoothed step background under a peak.
+    Accounts for the raised continuum on the low energy side of a peak
+    caused by small angle scattering before the detector.
+    \f[
+    y(x) = \frac{h}{2} \mathrm{erfc}\left(\frac{x - \mu}{\sqrt{2}\sigma}\right)
+    \f]
+    """
+    default_name = "step"
+    default_params = [1., 100., 1.]
+    param_names = ["height", "mean", "sigma"]
+    shift_idx = 1
+    width_idxs = (2,)
+    height_idxs = (0,)
+
+    def default_bounds(self):
+        return ((0., 0., SIGMA_MIN), (np.inf, 3000., 15.))
+
+    def eval(self, params, x):
+        p = batch_params(params)
+        return 0.5 * p[0] * erfc((x - p[1]) / (SQRT2 * p[2]))
+
+    def jac(self, params, x):
+        p = batch_params(params)
+        w = (x - p[1]) / (SQRT2 * p[2])
+        step = 0.5 * erfc(w)
+        dstep_dw = -np.exp(-w ** 2) / np.sqrt(np.pi)
+        parts = [step,
+                 -p[0] * dstep_dw / (SQRT2 * p[2]),
+                 -p[0] * dstep_dw * w / p[2]]
+        return stack_jac(parts, step.shape)
+
+    def integral(self, a, b, params):
+        """!
+        @brief Definite integral using
+        $\int \mathrm{erfc}(w) dw = w\ \mathrm{erfc}(w) - e^{-w^2}/\sqrt{\pi}$
+        """
+        p = batch_columns(params)
+        scale = SQRT2 * p[2]
+
+        def prim(t):
+            w = (t - p[1]) / scale
+            return 0.5 * p[0] * scale * (w * erfc(w) - np.exp(-w ** 2) / np.sqrt(np.pi))
+        return prim(b) - prim(a)
 
 
 def bg_model_factory(name, **kwargs):
     """!
     @brief Given string, return correct bg class
-    @param name String.  "linear" or "quadratic"
+    @param name String.  One of bg_models.names(), e.g.
+        "linear", "quadratic", "exponential" or "step"
     @return BgModel instance
     """
     init_params = kwargs.pop("params", None)
-    if name == "linear":
-        return LinModel(init_params)
-    else:
-        return LinModel(init_params)
+    return bg_models.get(name)(init_params, **kwargs)
 
 
 if __name__ == "__main__":
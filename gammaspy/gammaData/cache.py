@@ -0,0 +1,196 @@
+"""!
+@brief Module cache
+On-disk cache of parsed spectrum files.  Each entry is a .npy array plus a
+JSON metadata sidecar in a shared cache directory, so a file parsed once
+(by any worker or GUI session) is reloaded memory mapped instead of being
+parsed again.
+"""
+import os
+import json
+import hashlib
+import tempfile
+import time
+import numpy as np
+
+## Default cache directory, overridden by the GAMMASPY_CACHE env variable
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "gammaspy")
+
+
+def file_hash(fname, block_size=1 << 20):
+    """!
+    @brief Content hash (sha1 hex digest) of a file
+    """
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, bytes):
+        return value.decode()
+    raise TypeError("%s is not JSON serializable" % type(value))
+
+
+class SpectrumCache(object):
+    """!
+    @brief Size bounded LRU cache of parsed spectra.
+    Entries are keyed by the absolute file path and the block / channel
+    read.  The sidecar records the size, mtime and content hash of the
+    source file: a lookup only stats the file, and the file is hashed only
+    when its size or mtime changed (a touched or copied file with the same
+    content is still a hit), so a modified file is never served stale
+    data.  The access time of an entry is its sidecar mtime; when the cache
+    grows past max_bytes the least recently used entries are evicted.
+    Entries are written to a temp file and renamed, so concurrent readers
+    never see partial entries.
+    @param cache_dir  String. Cache directory (created if missing)
+    @param max_bytes  Int. Max total size of the cache files
+    @param orphan_age  Float. Age (s) after which an .npy or temp file
+        without a sidecar (left by a crashed writer) is removed
+    """
+    def __init__(self, cache_dir=None, max_bytes=512 * 1024 ** 2, orphan_age=600.):
+        self.cache_dir = cache_dir or os.environ.get("GAMMASPY_CACHE", DEFAULT_CACHE_DIR)
+        self.max_bytes = max_bytes
+        self.orphan_age = orphan_age
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, fname, block=0):
+        """!
+        @brief Cache key of block (channel) block of file fname
+        """
+        ident = "%s|%s" % (os.path.abspath(fname), block)
+        return hashlib.sha1(ident.encode()).hexdigest()
+
+    def _paths(self, key):
+        base = os.path.join(self.cache_dir, key)
+        return base + ".npy", base + ".json"
+
+    def get(self, fname, block=0):
+        """!
+        @brief Cached [metadata, array] of a file or None.
+        The array is a read only memory map.
+        """
+        npy_path, json_path = self._paths(self.key(fname, block))
+        try:
+            st = os.stat(fname)
+            with open(json_path) as f:
+                sidecar = json.load(f)
+            if (sidecar["size"], sidecar["mtime_ns"]) != (st.st_size, st.st_mtime_ns):
+                if sidecar["size"] != st.st_size or sidecar["hash"] != file_hash(fname):
+                    self.misses += 1
+                    return None
+                sidecar["mtime_ns"] = st.st_mtime_ns
+                self._atomic_write(json_path, lambda f: f.write(json.dumps(sidecar).encode()))
+            metadata = sidecar["metadata"]
+            data = np.load(npy_path, mmap_mode='r')
+        except (IOError, OSError, ValueError, KeyError):
+            self.misses += 1
+            return None
+        try:
+            os.utime(json_path, None)
+        except OSError:
+            pass
+        self.hits += 1
+        return [metadata, data]
+
+    def put(self, fname, data, metadata, block=0):
+        """!
+        @brief Store the parsed array and metadata of a file
+        """
+        npy_path, json_path = self._paths(self.key(fname, block))
+        st = os.stat(fname)
+        sidecar = {"source": os.path.abspath(fname), "block": block, "size": st.st_size,
+                   "mtime_ns": st.st_mtime_ns, "hash": file_hash(fname), "metadata": metadata}
+        self._atomic_write(npy_path, lambda f: np.save(f, np.asarray(data)))
+        self._atomic_write(json_path,
+                           lambda f: f.write(json.dumps(sidecar, default=_to_json).encode()))
+        self.evict()
+
+    def _atomic_write(self, path, write_fn):
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write_fn(f)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def sweep_orphans(self):
+        """!
+        @brief Remove .npy files without a sidecar and temp files older
+        than orphan_age, left by writers that crashed between the writes.
+        @return Int. Number of removed files
+        """
+        names = set(os.listdir(self.cache_dir))
+        now = time.time()
+        n_removed = 0
+        for name in names:
+            if name.endswith(".npy") and name[:-4] + ".json" in names:
+                continue
+            if not (name.endswith(".npy") or name.endswith(".tmp")):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                if now - os.path.getmtime(path) > self.orphan_age:
+                    os.remove(path)
+                    n_removed += 1
+            except OSError:
+                pass
+        return n_removed
+
+    def entries(self):
+        """!
+        @brief (last access time, bytes, key) of all entries, oldest first
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".json"):
+                continue
+            key = name[:-5]
+            npy_path, json_path = self._paths(key)
+            try:
+                size = os.path.getsize(json_path) + os.path.getsize(npy_path)
+                entries.append((os.path.getmtime(json_path), size, key))
+            except OSError:
+                continue
+        return sorted(entries)
+
+    def size(self):
+        return sum(entry[1] for entry in self.entries())
+
+    def evict(self, max_bytes=None):
+        """!
+        @brief Remove least recently used entries until the cache is at
+        most max_bytes large.
+        @return Int. Number of removed entries
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        self.sweep_orphans()
+        entries = self.entries()
+        total = sum(entry[1] for entry in entries)
+        n_removed = 0
+        for atime, size, key in entries:
+            if total <= max_bytes:
+                break
+            for path in self._paths(key):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+            n_removed += 1
+        return n_removed
+
+    def clear(self):
+        return self.evict(0)
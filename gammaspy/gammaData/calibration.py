@@ -0,0 +1,370 @@
+"""!
+@brief Module calibration
+Detector calibrations learned from fitted peaks.
+"""
+from __future__ import division
+import threading
+import numpy as np
+from scipy.optimize import lsq_linear
+from six import iteritems
+
+## FWHM = FWHM_SD * sigma for a gaussian
+FWHM_SD = 2.35482
+
+
+## Typical coaxial HPGe resolution [a, b, c], used when nothing better is known
+DEFAULT_FWHM_COEFFS = [0.8, 2.0e-3, 0.]
+
+
+def fwhm_sqr_min(coeffs, e_min, e_max):
+    """!
+    @brief Minimum of \f$ FWHM^2 = a + b E + c E^2 \f$ on [e_min, e_max]
+    """
+    a, b, c = coeffs
+    energy = [e_min, e_max]
+    if c != 0. and e_min < -b / (2. * c) < e_max:
+        energy.append(-b / (2. * c))
+    energy = np.array(energy, dtype=float)
+    return float(np.min(a + b * energy + c * energy ** 2))
+
+
+def fit_fwhm_coeffs(energy, fwhm, weight=None):
+    """!
+    @brief Weighted linear least squares fit of
+    \f$ FWHM^2 = a + b E + c E^2 \f$ with \f$ a, b \geq 0 \f$.
+    The polynomial order is reduced when there are too few distinct
+    energies or when the curve is not positive over the fitted energies;
+    DEFAULT_FWHM_COEFFS are returned if no order gives a physical curve.
+    @param energy  np_array of peak energies (keV)
+    @param fwhm  np_array of peak FWHMs (keV)
+    @param weight  np_array of inverse FWHM variances
+    @return np_array coefficients [a, b, c]
+    """
+    energy = np.asarray(energy, dtype=float)
+    fwhm = np.asarray(fwhm, dtype=float)
+    weight = np.ones(len(energy)) if weight is None else np.asarray(weight, dtype=float)
+    # weight of fwhm^2 = weight of fwhm / (2 fwhm)^2
+    w = np.sqrt(weight) / (2. * fwhm)
+    for order in range(min(3, len(np.unique(np.round(energy, 1)))), 0, -1):
+        design = np.vstack([energy ** i for i in range(order)]).T
+        lower = [0., 0., -np.inf][:order]
+        coeffs = lsq_linear(design * w[:, None], fwhm ** 2 * w, bounds=(lower, np.inf)).x
+        coeffs = np.concatenate((coeffs, np.zeros(3 - order)))
+        if fwhm_sqr_min(coeffs, energy.min(), energy.max()) > 0.:
+            return coeffs
+    return np.array(DEFAULT_FWHM_COEFFS, dtype=float)
+
+
+class ResolutionCalibration(object):
+    """!
+    @brief Detector resolution curve
+    \f[
+    FWHM(E) = \sqrt{a + b E + c E^2}
+    \f]
+    Stored in spectrum metadata under 'fwhm_cal' as [a, b, c].
+    """
+    def __init__(self, coeffs):
+        self.coeffs = np.asarray(coeffs, dtype=float)
+
+    @classmethod
+    def from_peaks(cls, energy, fwhm, weight=None):
+        return cls(fit_fwhm_coeffs(energy, fwhm, weight))
+
+    @classmethod
+    def from_metadata(cls, metadata):
+        """!
+        @brief Calibration stored in metadata, or None.
+        """
+        coeffs = metadata.get('fwhm_cal')
+        if coeffs is None or len(coeffs) != 3:
+            return None
+        return cls(coeffs)
+
+    def is_physical(self, e_min, e_max):
+        """!
+        @brief True if FWHM^2 is positive on [e_min, e_max]
+        """
+        return bool(np.all(np.isfinite(self.coeffs))) and \
+            fwhm_sqr_min(self.coeffs, e_min, e_max) > 0.
+
+    def fwhm(self, energy):
+        """!
+        @brief FWHM at energy (keV)
+        """
+        a, b, c = self.coeffs
+        energy = np.asarray(energy, dtype=float)
+        return np.sqrt(np.maximum(a + b * energy + c * energy ** 2, 1e-6))
+
+    def sigma(self, energy):
+        """!
+        @brief Gaussian std. deviation at energy (keV)
+        """
+        return self.fwhm(energy) / FWHM_SD
+
+    def dsigma(self, energy):
+        """!
+        @brief Derivative of the gaussian std. deviation wrt. energy
+        """
+        a, b, c = self.coeffs
+        energy = np.asarray(energy, dtype=float)
+        return (b + 2. * c * energy) / (2. * FWHM_SD * self.fwhm(energy))
+
+
+def match_lines(measured, reference, tol=2.):
+    """!
+    @brief Pair measured peak energies with the nearest reference line.
+    Each reference line is used at most once (closest measured peak wins).
+    @param measured  np_array of fitted peak energies (keV)
+    @param reference  np_array of known line energies (keV)
+    @param tol  Float. Max distance of a match (keV)
+    @return (measured idxs, reference idxs) of the matched pairs
+    """
+    measured = np.asarray(measured, dtype=float)
+    reference = np.sort(np.asarray(reference, dtype=float))
+    if len(measured) == 0 or len(reference) == 0:
+        return np.array([], dtype=int), np.array([], dtype=int)
+    pos = np.clip(np.searchsorted(reference, measured), 1, max(len(reference) - 1, 1))
+    left = reference[pos - 1]
+    right = reference[np.minimum(pos, len(reference) - 1)]
+    nearest = np.where(np.abs(measured - left) <= np.abs(measured - right), pos - 1,
+                       np.minimum(pos, len(reference) - 1))
+    dist = np.abs(measured - reference[nearest])
+    order = np.argsort(dist)
+    used, m_idxs, r_idxs = set(), [], []
+    for i in order:
+        if dist[i] <= tol and nearest[i] not in used:
+            used.add(nearest[i])
+            m_idxs.append(i)
+            r_idxs.append(nearest[i])
+    return np.array(m_idxs, dtype=int), np.array(r_idxs, dtype=int)
+
+
+def channel_energy(e_cal, n_channels):
+    """!
+    @brief Energies (keV) of channels 0 .. n_channels-1 from the energy
+    calibration coefficients, E(ch) = sum_i e_cal[i] ch^i
+    """
+    return np.polynomial.polynomial.polyval(np.arange(n_channels, dtype=float),
+                                            np.asarray(e_cal, dtype=float))
+
+
+def fit_e_cal(energy, order=1, e_cal=None, tol=1e-4):
+    """!
+    @brief Energy calibration coefficients reproducing an energy column.
+    @param e_cal  Candidate coefficients (e.g. from the file metadata),
+        returned unchanged if they reproduce energy within tol keV
+    @return list of coefficients (ascending order)
+    """
+    energy = np.asarray(energy, dtype=float)
+    if e_cal is not None and len(e_cal) and \
+            np.allclose(channel_energy(e_cal, len(energy)), energy, rtol=0., atol=tol):
+        return list(e_cal)
+    coeffs = np.polynomial.polynomial.polyfit(np.arange(len(energy), dtype=float), energy, order)
+    if not np.allclose(channel_energy(coeffs, len(energy)), energy, rtol=0., atol=tol):
+        raise ValueError("Energy column is not a polynomial of order %d of the channel" % order)
+    return list(coeffs)
+
+
+class EnergyMap(object):
+    """!
+    @brief Polynomial map from the current to the corrected energy axis
+    \f[
+    E' = g(E) = \sum_i c_i E^i
+    \f]
+    """
+    def __init__(self, coeffs):
+        self.coeffs = np.asarray(coeffs, dtype=float)
+        self.poly = np.polynomial.Polynomial(self.coeffs)
+        self.dpoly = self.poly.deriv()
+
+    @classmethod
+    def from_lines(cls, measured, reference, order=1, weight=None):
+        """!
+        @brief Weighted least squares fit of g to matched lines.
+        The order is reduced when there are too few lines.
+        """
+        measured = np.asarray(measured, dtype=float)
+        reference = np.asarray(reference, dtype=float)
+        if len(measured) == 0:
+            raise ValueError("No matched lines to fit an energy map")
+        order = min(order, len(measured) - 1)
+        if order == 0:
+            # a single line only gives an offset
+            return cls([np.average(reference - measured, weights=weight), 1.])
+        w = None if weight is None else np.sqrt(np.asarray(weight, dtype=float))
+        return cls(np.polynomial.polynomial.polyfit(measured, reference, order, w=w))
+
+    def __call__(self, energy):
+        return self.poly(np.asarray(energy, dtype=float))
+
+    def deriv(self, energy):
+        return self.dpoly(np.asarray(energy, dtype=float))
+
+    def is_monotonic(self, energy):
+        """!
+        @brief True if the map preserves the ordering of energy
+        """
+        return bool(np.all(self.deriv(energy) > 0.))
+
+    def compose_e_cal(self, e_cal):
+        """!
+        @brief Channel -> energy calibration coefficients (ascending
+        order, as metadata['e_cal']) after applying this map.
+        """
+        if e_cal is None or len(e_cal) == 0:
+            return list(e_cal) if e_cal is not None else e_cal
+        new_cal = self.poly(np.polynomial.Polynomial(np.asarray(e_cal, dtype=float)))
+        return new_cal.coef.tolist()
+
+
+class ShapeCalibration(object):
+    """!
+    @brief Per-detector peak shape calibration.
+    Collects the widths (and extra shape parameters, e.g. hypermet tails)
+    of converged peak fits and models the resolution as:
+    \f[
+    FWHM(E) = \sqrt{a + b E + c E^2}
+    \f]
+    The calibration is used to seed the width of new peaks.  Only well
+    fitted peaks are recorded: fits with R^2 below min_r2 are ignored, as
+    are widths pinned at their bounds, tied to a resolution curve or
+    without a finite relative uncertainty below max_rel_err.
+    @param detector  Hashable detector id
+    @param max_points  Int. Number of most recent points kept
+    @param min_r2  Float. Min R^2 of a recorded fit
+    @param max_rel_err  Float. Max relative 1sigma uncert of a recorded width
+    """
+    def __init__(self, detector=None, max_points=500, min_r2=0.95, max_rel_err=0.2):
+        self.detector = detector
+        self.max_points = max_points
+        self.min_r2 = min_r2
+        self.max_rel_err = max_rel_err
+        self.coeffs = None
+        self._energy, self._fwhm, self._weight = [], [], []
+        self._shape = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def n_points(self):
+        return len(self._energy)
+
+    def add_fit(self, model, cov=None, r2=None):
+        """!
+        @brief Record the peak widths of a converged FitModel.
+        @param model  FitModel instance with fitted params
+        @param cov  Covariance matrix of the fitted params.  Points are
+            weighted by the inverse variance of their FWHM.
+        @param r2  Float. R^2 of the fit
+        @return Int. Number of recorded peaks
+        """
+        if r2 is not None and not (np.isfinite(r2) and r2 >= self.min_r2):
+            return 0
+        if model.tied:
+            # the widths come from a resolution curve, not from the data
+            return 0
+        params = np.asarray(model.model_params, dtype=float)
+        lower, upper = np.array(model.model_params_bounds, dtype=float)
+        n_added = 0
+        with self._lock:
+            for model_name, sub_model in model.peak_models():
+                idxs = sub_model["idxs"]
+                components = sub_model["model"].peak_components
+                for mean_idx, sigma_idx in components:
+                    mean_idx, sigma_idx = idxs[mean_idx], idxs[sigma_idx]
+                    mean, sigma = params[mean_idx], abs(params[sigma_idx])
+                    if not np.isfinite(sigma) or sigma <= 0.:
+                        continue
+                    if np.isclose(sigma, lower[sigma_idx], rtol=1e-2) or \
+                            np.isclose(sigma, upper[sigma_idx], rtol=1e-2):
+                        continue
+                    var = cov[sigma_idx, sigma_idx] if cov is not None else np.nan
+                    if cov is not None and not (np.isfinite(var) and var > 0. and
+                                                np.sqrt(var) < self.max_rel_err * sigma):
+                        continue
+                    weight = 1. / (FWHM_SD ** 2 * var) if np.isfinite(var) and var > 0. else 1.
+                    n_added += 1
+                    self._energy.append(mean)
+                    self._fwhm.append(FWHM_SD * sigma)
+                    self._weight.append(weight)
+                    # extra shape params (tails, mixing) of single peak models
+                    shape_params = params[idxs[3:]]
+                    if len(components) == 1 and len(shape_params):
+                        kind = sub_model["model"].default_name
+                        self._shape.setdefault(kind, []).append(shape_params)
+            del self._energy[:-self.max_points]
+            del self._fwhm[:-self.max_points]
+            del self._weight[:-self.max_points]
+            for kind, values in iteritems(self._shape):
+                del values[:-self.max_points]
+            if n_added:
+                self.coeffs = None
+        return n_added
+
+    def fit(self):
+        """!
+        @brief Weighted linear least squares fit of FWHM^2 vs. energy.
+        The polynomial order is reduced when there are too few points.
+        @return coefficients [a, b, c]
+        """
+        with self._lock:
+            energy = np.array(self._energy)
+            fwhm = np.array(self._fwhm)
+            weight = np.array(self._weight)
+        if len(energy) == 0:
+            return None
+        self.coeffs = fit_fwhm_coeffs(energy, fwhm, weight)
+        return self.coeffs
+
+    def fwhm(self, energy):
+        """!
+        @brief Predicted FWHM at energy (keV)
+        """
+        if self.coeffs is None and self.fit() is None:
+            return None
+        return ResolutionCalibration(self.coeffs).fwhm(energy)
+
+    def sigma(self, energy, default=1.0):
+        """!
+        @brief Predicted gaussian std. deviation at energy (keV)
+        """
+        fwhm = self.fwhm(energy)
+        if fwhm is None:
+            return default
+        return fwhm / FWHM_SD
+
+    def shape_params(self, peak_model):
+        """!
+        @brief Median of the recorded extra shape params (beyond height,
+        mean and sigma) of the given peak model, or None.
+        """
+        with self._lock:
+            values = self._shape.get(peak_model)
+            if not values:
+                return None
+            return np.median(np.array(values), axis=0)
+
+
+## Shape calibrations shared by all spectra of the same detector
+shape_calibrations = {}
+
+
+def shape_calibration(detector=None):
+    """!
+    @brief Get (or create) the ShapeCalibration of a detector.
+    @param detector  Hashable detector id.  None gives a new calibration
+        private to the caller: spectra of unknown origin never share one.
+    """
+    if detector is None:
+        return ShapeCalibration()
+    if detector not in shape_calibrations:
+        shape_calibrations[detector] = ShapeCalibration(detector)
+    return shape_calibrations[detector]
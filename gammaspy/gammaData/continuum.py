@@ -0,0 +1,77 @@
+"""!
+@brief Module continuum
+Whole spectrum continuum (Compton + background) estimation by the
+Statistics-sensitive Non-linear Iterative Peak-clipping (SNIP) algorithm.
+"""
+from __future__ import division
+import numpy as np
+
+
+def lls(y):
+    """!
+    @brief Log-log-square root operator.  Compresses the dynamic range
+    of the counts before clipping.
+    """
+    return np.log(np.log(np.sqrt(np.maximum(y, 0.) + 1.) + 1.) + 1.)
+
+
+def lls_inv(z):
+    """!
+    @brief Inverse of lls.
+    """
+    return (np.exp(np.exp(z) - 1.) - 1.) ** 2. - 1.
+
+
+def smooth(y, half_width):
+    """!
+    @brief Moving average over 2 * half_width + 1 channels, edges padded.
+    Reduces the downward bias of clipping a noisy spectrum.
+    """
+    if half_width < 1:
+        return np.array(y, dtype=float)
+    kernel = np.ones(2 * half_width + 1) / (2 * half_width + 1)
+    return np.convolve(np.pad(y, half_width, mode="edge"), kernel, mode="valid")
+
+
+def snip(counts, n_iter=20, decreasing=True, use_lls=True):
+    """!
+    @brief SNIP continuum of a spectrum.  In iteration p every channel is
+    clipped to the mean of its neighbors p channels away:
+    \f[
+    v_i = min(v_i, (v_{i-p} + v_{i+p}) / 2)
+    \f]
+    Each iteration is a single vectorized pass, O(n * n_iter) in total.
+    @param counts  np_array of counts per channel
+    @param n_iter  Int. Max clipping window half width (channels).  Should
+        be about 1 - 2 peak FWHMs.
+    @param decreasing  Bool. Shrink the clipping window from n_iter to 1,
+        which gives a smoother continuum under wide peaks.
+    @param use_lls  Bool. Clip in the lls domain
+    @return np_array continuum (same units as counts)
+    """
+    v = lls(counts) if use_lls else np.array(counts, dtype=float)
+    n = len(v)
+    n_iter = int(min(n_iter, (n - 1) // 2))
+    windows = range(n_iter, 0, -1) if decreasing else range(1, n_iter + 1)
+    for p in windows:
+        clipped = 0.5 * (v[:-2 * p] + v[2 * p:])
+        np.minimum(v[p:-p], clipped, out=v[p:-p])
+    return lls_inv(v) if use_lls else v
+
+
+def estimate_continuum(spectrum, n_iter=20, smooth_width=4, decreasing=True):
+    """!
+    @brief Continuum of a spectrum in counts / keV.
+    The clipping is done on counts per channel, so the lls transform sees
+    Poisson statistics.
+    @param spectrum  np_array (n, 2) of [energy (keV), counts / keV]
+    @param n_iter  Int. Max clipping window half width (channels)
+    @param smooth_width  Int. Half width of the moving average applied
+        before clipping (channels), 0 to disable
+    @return np_array (n,) continuum in counts / keV
+    """
+    bin_widths = np.diff(spectrum[:, 0])
+    bin_widths = np.append(bin_widths[:1], bin_widths) if len(bin_widths) \
+        else np.ones(len(spectrum))
+    counts = smooth(spectrum[:, 1] * bin_widths, smooth_width)
+    return np.maximum(snip(counts, n_iter, decreasing), 0.) / bin_widths
@@ -7,22 +7,37 @@ class FitModel(object):
     """!
     @brief Combines background and peak models via Composition.
     """
-    def __init__(self, bg_order=1, n_peaks=1, peak_centers=[1000.]):
+    def __init__(self, bg_order=1, n_peaks=1, peak_centers=[1000.], **kwargs):
         self.model_params = np.array([])
         self.model_params_bounds = [[],[]]
         self.model_bank = {}
-        self.build(bg_order, n_peaks, peak_centers)
+        # tied param idx -> (source param idx, tie fn, tie fn derivative)
+        self.tied = {}
+        # param idxs held at their current values
+        self.fixed = set()
+        self.build(bg_order, n_peaks, peak_centers, **kwargs)
 
-    def build(self, bg_order, n_peaks, peak_centers):
+    def build(self, bg_order, n_peaks, peak_centers, bg_model=None, peak_model="gauss"):
         """!
         @brief Quickly build a multi-peak model with background
+        @param bg_order  Int. 1 for linear, 2 for quadratic background.
+        @param n_peaks  Int. Number of peaks
+        @param peak_centers  list of initial peak centers
+        @param bg_model  String. Name of a registered bg model.
+            Overrides bg_order if given.
+        @param peak_model  String. Name of a registered peak model.
         """
-        bg_model = bg.LinModel()  # todo add more bg model flexibility
-        self.add_model(bg_model)
+        if bg_model is None:
+            bg_model = "quadratic" if bg_order == 2 else "linear"
+        bg_kwargs = {"x0": np.mean(peak_centers[:n_peaks])} if bg_model == "exponential" else {}
+        self.add_model(bg.bg_model_factory(bg_model, **bg_kwargs))
         for i in range(n_peaks):
-            name = "gauss_" + str(i)
-            self.add_model(peak.GaussModel(init_params=[1.e2, peak_centers[i], 1.0],
-                                           name=name))
+            name = peak_model + "_" + str(i)
+            sub_model = peak.peak_models.get(peak_model)(name=name)
+            init_params = np.array(sub_model.params, dtype=float)
+            init_params[:3] = [1.e2, peak_centers[i], 1.0]
+            sub_model.params = list(init_params)
+            self.add_model(sub_model)
 
     def add_model(self, in_model):
         """!
@@ -36,23 +51,262 @@ class FitModel(object):
         self.model_params = np.concatenate((self.model_params, in_model._params))
         self.model_bank[in_model.name]["idxs"] = list(range(current_nparams, current_nparams + input_model_nparams))
         # parameter bounds for optimization
-        self.model_params_bounds[0] += in_model.bounds[0]
-        self.model_params_bounds[1] += in_model.bounds[1]
+        self.model_params_bounds[0] += list(in_model.bounds[0])
+        self.model_params_bounds[1] += list(in_model.bounds[1])
         print("Model Added: %s" % in_model.name)
 
+    def tie_widths(self, res_cal):
+        """!
+        @brief Constrain the width of every peak to the detector
+        resolution curve: sigma_i = res_cal.sigma(mu_i).
+        The sigmas are removed from the free parameter vector.
+        @param res_cal  calibration.ResolutionCalibration instance
+        """
+        for mean_idx, sigma_idx in self.peak_components():
+            self.tied[sigma_idx] = (mean_idx, res_cal.sigma, res_cal.dsigma)
+        self.model_params = self.apply_ties(self.model_params)
+
+    def untie(self):
+        self.tied = {}
+
+    def fix(self, idxs, values=None):
+        """!
+        @brief Hold params at fixed values during fits.
+        @param idxs  list of param indices
+        @param values  list of values.  Defaults to the current params.
+        """
+        if values is not None:
+            params = np.array(self.model_params, dtype=float)
+            params[list(idxs)] = values
+            self.model_params = self.apply_ties(params)
+        self.fixed.update(idxs)
+
+    def unfix(self, idxs=None):
+        """!
+        @brief Release fixed params (all by default).
+        """
+        if idxs is None:
+            self.fixed = set()
+        else:
+            self.fixed.difference_update(idxs)
+
+    @property
+    def free_idxs(self):
+        """!
+        @brief Indices of the parameters varied by the optimizer.
+        """
+        return [i for i in range(len(self.model_params))
+                if i not in self.tied and i not in self.fixed]
+
+    @property
+    def ifixb(self):
+        """!
+        @brief ODRPACK parameter mask: 1 for params varied by the
+        optimizer, 0 for tied and fixed params.
+        """
+        mask = np.zeros(len(self.model_params), dtype=int)
+        mask[self.free_idxs] = 1
+        return mask
+
+    def apply_ties(self, params):
+        """!
+        @brief Recompute tied params from their source params.
+        @param params  np_array (n_params,) or (n_batch, n_params)
+        """
+        params = np.array(params, dtype=float)
+        for i, (src, fn, dfn) in iteritems(self.tied):
+            params[..., i] = fn(params[..., src])
+        return params
+
+    def expand(self, free_params):
+        """!
+        @brief Full parameter vector(s) from the free parameters.
+        @param free_params  np_array (n_free,) or (n_batch, n_free)
+        """
+        free_params = np.asarray(free_params, dtype=float)
+        params = np.empty(free_params.shape[:-1] + (len(self.model_params),))
+        params[...] = self.model_params
+        params[..., self.free_idxs] = free_params
+        return self.apply_ties(params)
+
+    def reduce(self, params):
+        """!
+        @brief Free parameters from a full parameter vector.
+        """
+        return np.asarray(params, dtype=float)[..., self.free_idxs]
+
+    def free_bounds(self):
+        """!
+        @brief (lower, upper) bounds of the free parameters.
+        """
+        lower, upper = np.array(self.model_params_bounds, dtype=float)
+        return lower[self.free_idxs], upper[self.free_idxs]
+
+    def fold_ties(self, jac, params):
+        """!
+        @brief Chain rule for tied params: adds df/dtied * dtied/dsource
+        to the source columns of a full jacobian and zeros the tied columns.
+        """
+        params = np.asarray(params, dtype=float)
+        for i, (src, fn, dfn) in iteritems(self.tied):
+            jac[..., src] += jac[..., i] * np.asarray(dfn(params[..., src]))[..., np.newaxis]
+            jac[..., i] = 0.
+        return jac
+
+    def opti_eval_free(self, x, *free_params):
+        """!
+        @brief Model evaluated on the free parameters, f(x, *params) format.
+        """
+        free_params = free_params[0] if len(free_params) == 1 else free_params
+        return self.batch_eval(self.expand(free_params), x)
+
+    def opti_jac_free(self, x, *free_params):
+        """!
+        @brief Jacobian of the model wrt. the free parameters.
+        """
+        free_params = free_params[0] if len(free_params) == 1 else free_params
+        params = self.expand(free_params)
+        jac = self.fold_ties(self.batch_jac(params, x), params)
+        return jac[..., self.free_idxs]
+
+    def expand_cov(self, free_cov, free_params):
+        """!
+        @brief Propagate the covariance of the free params to all params.
+        \f[
+        C = E C_{free} E^T
+        \f]
+        Where $E$ is the jacobian of expand().
+        """
+        params = self.expand(free_params)
+        n = len(params)
+        e_mat = np.zeros((n, n))
+        e_mat[self.free_idxs, self.free_idxs] = 1.
+        for i, (src, fn, dfn) in iteritems(self.tied):
+            e_mat[i, src] = dfn(params[src])
+        e_mat = e_mat[:, self.free_idxs]
+        return np.dot(np.dot(e_mat, free_cov), e_mat.T)
+
+    def seed(self, x, y, n_edge=3, continuum=None):
+        """!
+        @brief Data driven initial guess of all parameters.
+        The background is guessed from the first and last n_edge
+        points of the data, peak heights from the data at each peak center.
+        @param x np_array ROI abscissa
+        @param y np_array ROI data
+        @param continuum  np_array estimated continuum at x.  If given the
+            background is guessed from it instead of the edge points.
+        """
+        if continuum is None:
+            edges = np.concatenate((np.arange(min(n_edge, len(x))),
+                                    np.arange(max(len(x) - n_edge, 0), len(x))))
+            bg_x, bg_y = x[edges], y[edges]
+        else:
+            bg_x, bg_y = x, continuum
+        params = np.array(self.model_params, dtype=float)
+        baseline = np.zeros(len(x))
+        for model_name, model in self.bg_models():
+            if not self.fixed.issuperset(model["idxs"]):
+                params[model["idxs"]] = model["model"].guess(bg_x, bg_y)
+            baseline += model["model"].eval(params[model["idxs"]], x)
+        for model_name, model in self.peak_models():
+            idxs = model["idxs"]
+            center_idx = np.argmin(np.abs(x - params[idxs[1]]))
+            params[idxs[0]] = max(y[center_idx] - baseline[center_idx], 1.)
+        params = self.apply_ties(params)
+        self.model_params = params
+        return params
+
+    def peak_models(self):
+        """!
+        @brief Sub-models which contribute to the net peak area.
+        """
+        return [(name, model) for name, model in iteritems(self.model_bank)
+                if model["model"].model_type == "peak"]
+
+    def bg_models(self):
+        """!
+        @brief Sub-models which make up the background.
+        """
+        return [(name, model) for name, model in iteritems(self.model_bank)
+                if model["model"].model_type != "peak"]
+
     def opti_eval(self, x, *params):
         """!
         @brief Evaluates all sub models.
         Automatically partitions *params list into sublists
         for each submodel.
         @param x np_array of abscissa to evaluate gauss model at
-        @param params  Gaussian model parameter array (len=3)
+        @param params  Full model parameter array.  A single array of
+            shape (n_batch, n_params) evaluates all rows at once and
+            returns an array of shape (n_batch, len(x)).
+        """
+        return self.batch_eval(params[0] if len(params) == 1 else params, x)
+
+    def batch_eval(self, params, x):
+        """!
+        @brief Evaluates the model for one parameter vector or a stack
+        of parameter vectors in a single call.
+        @param params  np_array (n_params,) or (n_batch, n_params)
+        @param x np_array of abscissa
+        """
+        params = np.asarray(params, dtype=float)
+        output = np.zeros(params.shape[:-1] + (len(x),))
+        for model_name, model in iteritems(self.model_bank):
+            output += model["model"].eval(params[..., model["idxs"]], x)
+        return output
+
+    def opti_jac(self, x, *params):
+        """!
+        @brief Analytic jacobian of the composed model wrt. all parameters.
+        Signature matches the jac argument of scipy.optimize.curve_fit.
+        @return np_array (len(x), n_params) or (n_batch, len(x), n_params)
+        """
+        return self.batch_jac(params[0] if len(params) == 1 else params, x)
+
+    def batch_jac(self, params, x):
+        params = np.asarray(params, dtype=float)
+        jac = np.zeros(params.shape[:-1] + (len(x), params.shape[-1]))
+        for model_name, model in iteritems(self.model_bank):
+            jac[..., model["idxs"]] = model["model"].jac(params[..., model["idxs"]], x)
+        return jac
+
+    def batch_deriv(self, params, x):
+        """!
+        @brief Derivative of the composed model wrt. the abscissa.
         """
-        output = np.zeros(len(x))
+        params = np.asarray(params, dtype=float)
+        output = np.zeros(params.shape[:-1] + (len(x),))
         for model_name, model in iteritems(self.model_bank):
-            output += model["model"].eval(np.array(params)[model["idxs"]], x)
+            output += model["model"].deriv(params[..., model["idxs"]], x)
         return output
 
+    def remap(self, params, g, dg, x):
+        """!
+        @brief Params on a new energy axis E' = g(E), see BaseModel.remap.
+        @param x  np_array of old ROI energies
+        """
+        new_params = np.array(params, dtype=float)
+        for model_name, model in iteritems(self.model_bank):
+            idxs = model["idxs"]
+            new_params[idxs] = model["model"].remap(new_params[idxs], g, dg, x)
+        return self.apply_ties(new_params)
+
+    def remap_cov(self, cov, params, g, dg, x):
+        """!
+        @brief Propagate a param covariance through remap, using a
+        central difference jacobian of the map.
+        """
+        params = np.asarray(params, dtype=float)
+        n = len(params)
+        jac = np.zeros((n, n))
+        for j in range(n):
+            h = 1e-6 * max(abs(params[j]), 1e-3)
+            step = np.zeros(n)
+            step[j] = h
+            jac[:, j] = (self.remap(params + step, g, dg, x) -
+                         self.remap(params - step, g, dg, x)) / (2. * h)
+        return np.dot(np.dot(jac, cov), jac.T)
+
     def set_params(self, params):
         """!
         @biref Freeze internal model parameters.
@@ -69,21 +323,17 @@ class FitModel(object):
         """!
         @biref Evaluate model.
         """
-        output = np.zeros(len(x))
-        for model_name, model in iteritems(self.model_bank):
-            output += model["model"].eval(np.array(self.model_params)[model["idxs"]], x)
-        return output
+        return self.batch_eval(self.model_params, x)
 
     def net_area(self):
         """!
         @brief Area with background subtracted.
         """
         peak_area_list, net_area = [], 0.
-        for model_name, model in iteritems(self.model_bank):
-            if "gauss" in model_name:
-                area = model["model"].area(np.array(self.model_params)[model["idxs"]])
-                net_area += area
-                peak_area_list.append(area)
+        for model_name, model in self.peak_models():
+            area = model["model"].area(np.array(self.model_params)[model["idxs"]])
+            net_area += area
+            peak_area_list.append(area)
         return net_area, peak_area_list
 
     def bg_area(self, lbound=None, ubound=None):
@@ -93,19 +343,18 @@ class FitModel(object):
         +/- 3sigma from the mean of the peak (~99.7% of the peak)
         @return Area of background
         """
-        bg_areas = []
-        for model_name, model in iteritems(self.model_bank):
-            if "gauss" not in model_name:
-                avg_model_mean = np.array(self.peak_means())
-                avg_model_sd = np.array(self.peak_sigmas())
-                a_s = avg_model_mean - 3. * avg_model_sd
-                b_s = avg_model_mean + 3. * avg_model_sd
-                for a, b in zip(a_s, b_s):
-                    if lbound is None or ubound is None:
-                        bg_areas.append(model["model"].integral(a, b, self.model_params[model["idxs"]]))
-                    else:
-                        bg_areas.append(model["model"].integral(lbound, ubound, self.model_params[model["idxs"]]))
-        bg_areas = np.array(bg_areas)
+        avg_model_mean = np.array(self.peak_means())
+        avg_model_sd = np.array(self.peak_sigmas())
+        a_s = avg_model_mean - 3. * avg_model_sd
+        b_s = avg_model_mean + 3. * avg_model_sd
+        bg_areas = np.zeros(len(a_s))
+        for model_name, model in self.bg_models():
+            for i, (a, b) in enumerate(zip(a_s, b_s)):
+                if lbound is None or ubound is None:
+                    bg_areas[i] += model["model"].integral(a, b, self.model_params[model["idxs"]])
+                else:
+                    bg_areas[i] += model["model"].integral(lbound, ubound,
+                                                           self.model_params[model["idxs"]])
         return np.sum(bg_areas), bg_areas
 
     def net_area_uncert(self, lbound, ubound, cov):
@@ -121,8 +370,8 @@ class FitModel(object):
         area_jac_all = np.array([])
         scaling_factor = 1.5
         for model_name, model in iteritems(self.model_bank):
-            if "gauss" in model_name:
-                # jacobian of a gaussian peak area
+            if model["model"].model_type == "peak":
+                # jacobian of the peak area
                 area_jac = model["model"].area_jac(np.array(self.model_params)[model["idxs"]])
             else:
                 # jacobian of area under the bg model
@@ -150,27 +399,32 @@ class FitModel(object):
         # return varience, not SD!
         return net_uncert, peak_area_uncerts, scaling_factor
 
+    def peak_components(self):
+        """!
+        @brief (mean index, sigma index) into model_params of every peak
+        component of the peak sub-models.  Multiplet models (multigauss)
+        have one entry per peak.
+        """
+        components = []
+        for model_name, model in self.peak_models():
+            idxs = model["idxs"]
+            components += [(idxs[mean_idx], idxs[sigma_idx])
+                           for mean_idx, sigma_idx in model["model"].peak_components]
+        return components
+
     def peak_means(self):
         """!
         @brief Mean of each subpeak
         """
-        peak_means = []
-        for model_name, model in iteritems(self.model_bank):
-            if "gauss" in model_name:
-                # mean of gaussian peak
-                peak_means.append(np.array(self.model_params)[model["idxs"]][1])
-        return peak_means
+        params = np.array(self.model_params)
+        return [params[mean_idx] for mean_idx, sigma_idx in self.peak_components()]
 
     def peak_sigmas(self):
         """!
-        @brief Mean of each subpeak
+        @brief Std. deviation of the gaussian core of each subpeak
         """
-        sigmas = []
-        for model_name, model in iteritems(self.model_bank):
-            if "gauss" in model_name:
-                # 1sd of gaussian peak
-                sigmas.append(np.abs(np.array(self.model_params)[model["idxs"]][2]))
-        return sigmas
+        params = np.array(self.model_params)
+        return [np.abs(params[sigma_idx]) for mean_idx, sigma_idx in self.peak_components()]
 
     def tot_area(self):
         """!
@@ -0,0 +1,228 @@
+"""!
+@brief Module mcmc
+Affine invariant ensemble sampler (Goodman & Weare stretch move) for
+posterior sampling of ROI fit parameters.
+All walkers of a half ensemble are advanced together, so the log
+probability is evaluated with a single vectorized FitModel call per
+half step.
+"""
+from __future__ import division
+import numpy as np
+import gammaspy.gammaData.poisson as poisson
+import gammaspy.gammaData.parallel as parallel
+
+
+class PoissonPosterior(object):
+    """!
+    @brief Log posterior of the free params of a FitModel given Poisson
+    distributed channel counts.  Flat prior inside the free param bounds.
+    """
+    def __init__(self, model, x, counts, widths):
+        self.model = model
+        self.x = x
+        self.counts = np.asarray(counts, dtype=float)
+        self.widths = widths
+        self.lower, self.upper = model.free_bounds()
+
+    def __call__(self, free_params):
+        """!
+        @param free_params  np_array (n_walkers, n_free)
+        @return np_array (n_walkers,) of log probabilities
+        """
+        free_params = np.atleast_2d(free_params)
+        inside = np.all((free_params >= self.lower) & (free_params <= self.upper), axis=1)
+        log_prob = np.full(len(free_params), -np.inf)
+        if np.any(inside):
+            mu = self.model.opti_eval_free(self.x, free_params[inside]) * self.widths
+            log_prob[inside] = poisson.log_likelihood(mu, self.counts)
+        return log_prob
+
+
+class EnsembleSampler(object):
+    """!
+    @brief Affine invariant ensemble MCMC sampler.
+    The ensemble is split in two halves.  Each walker of one half is moved
+    along the line to a random walker of the other half:
+    \f[
+    Y = X_j + z (X_k - X_j), \quad g(z) \propto 1 / \sqrt{z}, z \in [1/a, a]
+    \f]
+    and accepted with probability $min(1, z^{n-1} p(Y) / p(X_k))$.
+    @param log_prob  Callable mapping (n_walkers, n_dim) -> (n_walkers,)
+    @param n_walkers  Int. Even, at least 2 * n_dim
+    @param a  Float. Stretch scale
+    @param random_state  Int seed or np.random.RandomState
+    """
+    def __init__(self, log_prob, n_walkers, n_dim, a=2., random_state=None):
+        if n_walkers % 2 or n_walkers < 2 * n_dim:
+            raise ValueError("n_walkers must be even and at least 2 * n_dim")
+        self.log_prob = log_prob
+        self.n_walkers = n_walkers
+        self.n_dim = n_dim
+        self.a = a
+        if isinstance(random_state, np.random.RandomState):
+            self.rng = random_state
+        else:
+            self.rng = np.random.RandomState(random_state)
+        self.chain = None
+        self.log_prob_chain = None
+        self.n_accepted = np.zeros(n_walkers)
+        self.n_steps = 0
+
+    def _stretch(self, walkers, log_p, active, others):
+        n = len(active)
+        z = ((self.a - 1.) * self.rng.rand(n) + 1.) ** 2. / self.a
+        partners = walkers[others][self.rng.randint(len(others), size=n)]
+        proposal = partners + z[:, np.newaxis] * (walkers[active] - partners)
+        log_p_new = self.log_prob(proposal)
+        log_ratio = (self.n_dim - 1.) * np.log(z) + log_p_new - log_p[active]
+        accept = np.log(self.rng.rand(n)) < log_ratio
+        idx = active[accept]
+        walkers[idx] = proposal[accept]
+        log_p[idx] = log_p_new[accept]
+        self.n_accepted[idx] += 1
+
+    def run(self, p0, n_steps, burn=0, thin=1, callback=None):
+        """!
+        @brief Advance the ensemble n_steps steps from p0.
+        @param p0  np_array (n_walkers, n_dim) initial walker positions
+        @param burn  Int. Number of initial steps to discard
+        @param thin  Int. Keep every thin-th step
+        @param callback  Callable(step) called after each step.  Returning
+            True stops the run.
+        @return chain, np_array (n_kept, n_walkers, n_dim)
+        """
+        walkers = np.array(p0, dtype=float)
+        log_p = self.log_prob(walkers)
+        if not np.all(np.isfinite(log_p)):
+            raise ValueError("All initial walkers must have finite probability")
+        half = self.n_walkers // 2
+        first, second = np.arange(half), np.arange(half, self.n_walkers)
+        chain, log_prob_chain = [], []
+        self.n_accepted[:] = 0
+        for step in range(n_steps):
+            self._stretch(walkers, log_p, first, second)
+            self._stretch(walkers, log_p, second, first)
+            if step >= burn and (step - burn) % thin == 0:
+                chain.append(walkers.copy())
+                log_prob_chain.append(log_p.copy())
+            self.n_steps = step + 1
+            if callback is not None and callback(step):
+                break
+        self.chain = np.array(chain).reshape(-1, self.n_walkers, self.n_dim)
+        self.log_prob_chain = np.array(log_prob_chain).reshape(-1, self.n_walkers)
+        return self.chain
+
+    @property
+    def acceptance_fraction(self):
+        return self.n_accepted / max(self.n_steps, 1)
+
+    def flat_samples(self):
+        """!
+        @brief Kept samples of all walkers, np_array (n_samples, n_dim)
+        """
+        return self.chain.reshape(-1, self.n_dim)
+
+
+def autocorr_function(series):
+    """!
+    @brief Normalized autocorrelation function of each column, by FFT.
+    @param series  np_array (n_steps,) or (n_steps, n_series)
+    """
+    series = np.asarray(series, dtype=float)
+    n = series.shape[0]
+    n_fft = 1 << int(2 * n - 1).bit_length()
+    centered = series - np.mean(series, axis=0)
+    f = np.fft.rfft(centered, n=n_fft, axis=0)
+    acf = np.fft.irfft(f * np.conjugate(f), n=n_fft, axis=0)[:n]
+    acf /= np.where(acf[0] > 0., acf[0], 1.)
+    return acf
+
+
+def autocorr_time(chain, c=5.):
+    """!
+    @brief Integrated autocorrelation time of each parameter using the
+    walker averaged autocorrelation function and Sokal's automatic window.
+    @param chain  np_array (n_steps, n_walkers, n_dim)
+    @param c  Float. Window size in units of tau
+    @return np_array (n_dim,) of autocorrelation times (steps)
+    """
+    n_steps, n_walkers, n_dim = chain.shape
+    acf = np.mean(autocorr_function(chain.reshape(n_steps, -1)).reshape(n_steps, n_walkers, n_dim),
+                  axis=1)
+    taus = 2. * np.cumsum(acf, axis=0) - 1.
+    tau = np.empty(n_dim)
+    for i in range(n_dim):
+        window = np.arange(n_steps) < c * taus[:, i]
+        m = np.argmin(window) if not np.all(window) else n_steps - 1
+        tau[i] = taus[m, i]
+    return tau
+
+
+def gelman_rubin(chain):
+    """!
+    @brief Potential scale reduction factor R-hat of each parameter.
+    Each walker is treated as a chain and split in two halves.  Values
+    close to 1 (< 1.1) indicate convergence.
+    @param chain  np_array (n_steps, n_walkers, n_dim)
+    """
+    n_steps = chain.shape[0] // 2
+    if n_steps < 2:
+        return np.full(chain.shape[2], np.nan)
+    chains = np.concatenate((chain[:n_steps], chain[n_steps:2 * n_steps]), axis=1)
+    chain_means = np.mean(chains, axis=0)
+    within = np.mean(np.var(chains, axis=0, ddof=1), axis=0)
+    between = n_steps * np.var(chain_means, axis=0, ddof=1)
+    var_est = (n_steps - 1.) / n_steps * within + between / n_steps
+    return np.sqrt(var_est / np.where(within > 0., within, np.inf))
+
+
+def init_walkers(center, cov, n_walkers, lower, upper, rng, scale=1e-2):
+    """!
+    @brief Small gaussian ball of walkers around the best fit, kept inside
+    the bounds.
+    @param center  np_array (n_dim,) best fit free params
+    @param cov  np_array (n_dim, n_dim) covariance of the best fit
+    @param scale  Float. Fraction of the fit std. deviation used as spread
+    """
+    sd = np.sqrt(np.abs(np.diag(cov))) if cov is not None else np.zeros(len(center))
+    sd = np.where(np.isfinite(sd) & (sd > 0.), sd, 1e-4 * np.maximum(np.abs(center), 1.))
+    walkers = center + scale * sd * rng.randn(n_walkers, len(center))
+    span = np.where(np.isfinite(upper - lower), upper - lower, np.inf)
+    eps = np.minimum(1e-9 * np.maximum(np.abs(center), 1.), 0.5 * span)
+    return np.clip(walkers, lower + eps, upper - eps)
+
+
+def _fit_mcmc(args):
+    roi, fit_kwargs = args
+    state = roi.fit_state
+    roi.fit_mcmc(**fit_kwargs)
+    # ROIs without a converged fit are fit (and their widths recorded) first
+    return roi, roi.fit_state is not state
+
+
+def fit_mcmc_rois(rois, n_workers=None, backend="process", store=None, **fit_kwargs):
+    """!
+    @brief Run Roi.fit_mcmc for several ROIs concurrently.
+    With the process backend the returned rois are copies holding the
+    chains and posterior summaries, attached to the shared arrays if a
+    shared memory store is given (see roi.fit_rois).  The copies get the
+    shape calibration of their original back, with the widths of fits
+    run first in the workers recorded in it.
+    @param rois  List of roi.Roi instances
+    @param store  sharedspec.SharedSpectrumStore or None to pickle the data
+    @param fit_kwargs  Keyword args of Roi.fit_mcmc
+    @return List of fitted rois, same order as rois
+    """
+    if store is not None and backend == "process":
+        for roi in rois:
+            roi.share(store)
+    results = parallel.parallel_map(_fit_mcmc, [(roi, fit_kwargs) for roi in rois],
+                                    n_workers, backend)
+    fitted = []
+    for orig, (roi, refit) in zip(rois, results):
+        if roi is not orig:
+            roi.shape_cal = orig.shape_cal
+            if refit and roi.shape_cal is not None:
+                roi.shape_cal.add_fit(roi.model, roi.pcov, roi.r_sqrd)
+        fitted.append(roi)
+    return fitted
@@ -0,0 +1,129 @@
+"""!
+@brief Module multichannel
+Spectra of several detectors (channels) of one HDF5 file held in a single
+2-D array, with per-channel calibration and concurrent per-channel peak
+search and fitting.
+"""
+from __future__ import division
+import numpy as np
+import gammaspy.gammaData.reader as reader
+import gammaspy.gammaData.spectrum as spectrum
+import gammaspy.gammaData.parallel as parallel
+import gammaspy.gammaData.pipeline as pipeline
+
+
+def analyze_channel(args):
+    """!
+    @brief Peak search and fit of every peak of one channel
+    (pipeline.analyze_spectrum).
+    Module level so it can be shipped to a process pool.
+    @param args  (spectrum array, metadata, cwt_settings, fit_kwargs)
+    @return spectrum.GammaSpectrum holding the fitted peaks
+    """
+    spec_array, metadata, cwt_settings, fit_kwargs = args
+    return pipeline.analyze_spectrum(spectrum.GammaSpectrum(spec_array, metadata),
+                                     cwt_settings, fit_kwargs)
+
+
+class MultiChannelSpectrum(object):
+    """!
+    @brief All channels of a multi-detector measurement.
+    self.energy and self.density are (n_channels, n_bins) arrays, row i is
+    channel self.chans[i].  Each channel keeps its own metadata (e_cal,
+    fwhm_cal, live and real time).
+    @param energy  np_array (n_channels, n_bins) of bin energies (keV)
+    @param density  np_array (n_channels, n_bins) of counts / keV
+    @param metadata  list of metadata dicts, one per channel
+    @param chans  list of channel numbers (default: 0 .. n_channels-1)
+    """
+    def __init__(self, energy, density, metadata, chans=None):
+        self.energy = np.atleast_2d(np.asarray(energy, dtype=float))
+        self.density = np.atleast_2d(np.asarray(density, dtype=float))
+        if self.energy.shape != self.density.shape:
+            raise ValueError("energy and density arrays must have the same shape")
+        if len(metadata) != len(self.energy):
+            raise ValueError("One metadata dict is required per channel")
+        self.metadata = list(metadata)
+        self.chans = list(range(len(self.energy))) if chans is None else list(chans)
+        self.spectra = [None] * len(self.chans)
+
+    @classmethod
+    def from_hdf5(cls, fname, chans=None):
+        """!
+        @brief Load channels of an HDF5 file in one file operation.
+        All channels must have the same number of bins.
+        @param chans  list of channel numbers (default: all)
+        """
+        dreader = reader.DataReader()
+        if chans is None:
+            chans = dreader.channels(fname)
+        metadata, count_energy = dreader.read_channels(fname, chans)
+        n_bins = set(len(data) for data in count_energy)
+        if len(n_bins) > 1:
+            raise ValueError("Channels of %s have different numbers of bins" % fname)
+        data = np.array(count_energy, dtype=float)
+        return cls(data[:, :, 0], data[:, :, 1], metadata, chans)
+
+    def __len__(self):
+        return len(self.chans)
+
+    def spectrum_array(self, i):
+        """!
+        @brief New (n_bins, 2) array of [energy, counts / keV] of row i
+        """
+        return np.column_stack((self.energy[i], self.density[i]))
+
+    def channel(self, chan):
+        """!
+        @brief GammaSpectrum of a channel, created on first access.
+        @param chan  Int. Channel number
+        """
+        i = self.chans.index(chan)
+        if self.spectra[i] is None:
+            self.spectra[i] = spectrum.GammaSpectrum(self.spectrum_array(i), self.metadata[i])
+        return self.spectra[i]
+
+    def sum_spectrum(self):
+        """!
+        @brief Total density of all channels.  Requires a common energy
+        axis (identical calibrations).
+        """
+        if not np.allclose(self.energy, self.energy[0]):
+            raise ValueError("Channels have different energy calibrations")
+        return np.column_stack((self.energy[0], np.sum(self.density, axis=0)))
+
+    def analyze(self, chans=None, n_workers=None, backend="process", cwt_settings=None,
+                fit_kwargs=None):
+        """!
+        @brief Peak search and fit of all peaks of several channels, the
+        channels are analyzed concurrently.  Results replace the
+        GammaSpectrum of each channel.
+        @param chans  list of channel numbers (default: all)
+        @param backend  String. "process", "thread" or "serial"
+        @param cwt_settings  dict of keyword args of GammaSpectrum.find_cwt_peaks
+        @param fit_kwargs  dict of keyword args of Roi.fit_new
+        @return list of GammaSpectrum, same order as chans
+        """
+        chans = self.chans if chans is None else chans
+        rows = [self.chans.index(chan) for chan in chans]
+        tasks = [(self.spectrum_array(i), dict(self.metadata[i]), cwt_settings or {},
+                  fit_kwargs or {}) for i in rows]
+        results = parallel.parallel_map(analyze_channel, tasks, n_workers, backend)
+        for i, spec in zip(rows, results):
+            self.spectra[i] = spec
+            self.metadata[i] = spec.metadata
+        return results
+
+    def peak_tables(self):
+        """!
+        @brief Fitted peak table of every channel (None if not analyzed)
+        """
+        return [spec.peak_table() if spec is not None else None for spec in self.spectra]
+
+    def write(self, fname, mode='w'):
+        """!
+        @brief Write all channels and their fitted peaks in one file operation.
+        """
+        reader.DataReader().write_channels(
+            fname, self.metadata, [self.spectrum_array(i) for i in range(len(self))],
+            self.peak_tables(), self.chans, mode)
@@ -0,0 +1,102 @@
+"""!
+@brief Module multistart
+Multi-start global optimization: a space filling set of starting points
+(Latin hypercube or scrambled Sobol) is scored with one vectorized
+objective call and only the most promising points are refined by local
+fits, which run concurrently.  Results are reproducible for a given seed
+and the cost is bounded by the number of starts and refinements.
+"""
+from __future__ import division
+import numpy as np
+from scipy.optimize import OptimizeResult
+import gammaspy.gammaData.parallel as parallel
+try:
+    from scipy.stats import qmc
+except ImportError:
+    qmc = None
+
+
+def latin_hypercube(n, d, rng):
+    """!
+    @brief n points of a Latin hypercube in the unit cube [0, 1)^d
+    """
+    strata = np.array([rng.permutation(n) for _ in range(d)]).T
+    return (strata + rng.rand(n, d)) / n
+
+
+def sobol(n, d, rng):
+    """!
+    @brief n points of a scrambled Sobol sequence in [0, 1)^d.  Falls back
+    to a Latin hypercube without scipy.stats.qmc.
+    """
+    if qmc is None:
+        return latin_hypercube(n, d, rng)
+    sampler = qmc.Sobol(d, scramble=True, seed=rng.randint(2 ** 31))
+    return sampler.random(n)
+
+
+def search_box(x0, lower, upper, width=1.):
+    """!
+    @brief Finite sampling box inside the bounds around x0.  Infinite
+    bounds are replaced by x0 -/+ width * max(|x0|, 1).
+    """
+    x0 = np.asarray(x0, dtype=float)
+    span = width * np.maximum(np.abs(x0), 1.)
+    lo = np.maximum(lower, x0 - span)
+    hi = np.minimum(upper, x0 + span)
+    return lo, np.maximum(hi, lo)
+
+
+def start_points(x0, lower, upper, n_starts=64, sampling="lhs", random_state=0, width=1.,
+                 box=None):
+    """!
+    @brief x0 followed by n_starts points filling the search box.
+    @param sampling  String. "lhs" or "sobol"
+    @param random_state  Int seed or np.random.RandomState
+    @param box  (lo, hi) sampling box, default search_box(x0, lower, upper, width)
+    @return np_array (n_starts + 1, n_dim)
+    """
+    rng = random_state if isinstance(random_state, np.random.RandomState) \
+        else np.random.RandomState(random_state)
+    lo, hi = search_box(x0, lower, upper, width) if box is None else box
+    unit = sobol(n_starts, len(lo), rng) if sampling == "sobol" \
+        else latin_hypercube(n_starts, len(lo), rng)
+    return np.vstack((np.asarray(x0, dtype=float), lo + unit * (hi - lo)))
+
+
+def multistart(objective, local_fit, x0, lower, upper, n_starts=64, top_k=4, sampling="lhs",
+               random_state=0, width=1., box=None, n_workers=None, backend="thread"):
+    """!
+    @brief Multi-start minimization.
+    @param objective  Callable mapping points (n, n_dim) -> values (n,)
+    @param local_fit  Callable(start) -> (x, fun, converged, ...).  May
+        raise RuntimeError / ValueError / LinAlgError for a failed start.
+        Extra tuple items (e.g. a covariance) are kept in result.refined.
+    @param x0  np_array (n_dim,) initial guess, always among the starts
+    @param n_starts  Int. Number of sampled starting points
+    @param top_k  Int. Number of best starts refined by local_fit
+    @param box  (lo, hi) sampling box (see start_points)
+    @return OptimizeResult with x, fun, success, the starts, their
+        objective values, the refinement results and best, the index of
+        the chosen refinement (None if all failed)
+    """
+    starts = start_points(x0, lower, upper, n_starts, sampling, random_state, width, box)
+    values = np.asarray(objective(starts), dtype=float)
+    values = np.where(np.isfinite(values), values, np.inf)
+    best = np.argsort(values, kind="stable")[:top_k]
+
+    def refine(i):
+        try:
+            return local_fit(starts[i])
+        except (RuntimeError, ValueError, np.linalg.LinAlgError):
+            return None
+    refined = parallel.parallel_map(refine, best, n_workers, backend)
+    candidates = [(not res[2], res[1], k) for k, res in enumerate(refined)
+                  if res is not None and np.isfinite(res[1])]
+    if not candidates:
+        return OptimizeResult(x=starts[best[0]], fun=values[best[0]], success=False,
+                              starts=starts, values=values, refined=refined, best=None)
+    _, fun, k = min(candidates)
+    return OptimizeResult(x=refined[k][0], fun=fun, success=bool(refined[k][2]),
+                          start=starts[best[k]], starts=starts, values=values,
+                          refined=refined, best=k)
@@ -0,0 +1,52 @@
+"""!
+@brief Module parallel
+Small helpers to run independent analysis tasks concurrently.
+"""
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError
+import multiprocessing
+import os
+
+
+def default_workers(n_tasks=None):
+    """!
+    @brief Number of workers to use by default.
+    @param n_tasks  Int. Number of tasks, caps the worker count.
+    """
+    n_workers = os.cpu_count() or 1
+    if n_tasks is not None:
+        n_workers = max(1, min(n_workers, n_tasks))
+    return n_workers
+
+
+def make_executor(n_workers=None, backend="thread", initializer=None, initargs=()):
+    """!
+    @brief Create a concurrent.futures executor.
+    @param n_workers  Int. Number of workers (default: number of cpus)
+    @param backend  String. "thread" or "process"
+    @param initializer  Callable run once in each new worker
+    """
+    n_workers = n_workers or default_workers()
+    if backend == "process":
+        ctx = multiprocessing.get_context("spawn")
+        return ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx,
+                                   initializer=initializer, initargs=initargs)
+    return ThreadPoolExecutor(max_workers=n_workers, initializer=initializer,
+                              initargs=initargs)
+
+
+def parallel_map(fn, items, n_workers=None, backend="thread"):
+    """!
+    @brief Apply fn to every item concurrently.  Results are returned in
+    the order of items.  Runs serially when only a single worker is
+    requested or there is only one item.
+    @param fn  Callable.  Must be picklable for the process backend.
+    @param items  Iterable of arguments for fn
+    @param n_workers  Int. Number of workers
+    @param backend  String. "thread", "process" or "serial"
+    """
+    items = list(items)
+    n_workers = n_workers or default_workers(len(items))
+    if backend == "serial" or n_workers == 1 or len(items) <= 1:
+        return [fn(item) for item in items]
+    with make_executor(n_workers, backend) as executor:
+        return list(executor.map(fn, items))
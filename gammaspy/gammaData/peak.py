@@ -1,14 +1,35 @@
 """!
 @brief Module peak
-Contains peak model def
+Contains peak model defs
 """
 from __future__ import division
 import numpy as np
-import numdifftools as nd
-from scipy.special import erf
+from scipy.special import erf, erfc, erfcx
+from gammaspy.gammaData.basemodel import BaseModel, ModelRegistry, \
+    batch_params, batch_columns
 
+SQRT2 = np.sqrt(2.)
+## Smallest allowed peak width (keV)
+SIGMA_MIN = 1e-3
+SQRT2PI = np.sqrt(2. * np.pi)
+# ratio of the lorentzian HWHM to the gaussian std. deviation
+# for a gaussian and lorentzian of equal FWHM
+HWHM_SD = np.sqrt(2. * np.log(2.))
 
-class GaussModel(object):
+## Registry of all available peak shapes
+peak_models = ModelRegistry(default="gauss")
+
+
+def stack_jac(parts, shape):
+    """!
+    @brief Stack partial derivatives along the last axis, broadcasting
+    constant partials to the shape of the model output.
+    """
+    return np.stack([np.broadcast_to(d, shape) for d in parts], axis=-1)
+
+
+@peak_models.register("gauss")
+class GaussModel(BaseModel):
     """!
     @brief Gaussian model of the form:
     \f[
@@ -18,45 +39,40 @@ class GaussModel(object):
     $b$ is the mean
     and $c$ is the std. deviation.
     """
-    def __init__(self, init_params=[1., 1., 1.], **kwargs):
-        self.name = kwargs.pop("name", "gauss")
-        # ((min bounds), (max param bounds))
-        self.bounds = ((0., 0., 0.), (np.inf, 3000., 15.))
-        self._params = init_params
-        self.model_trust = 1
-
-    @property
-    def params(self):
-        return self._params
-
-    @params.setter
-    def params(self, params):
-        if params is None:
-            self._params = [100., 100., 100.]
-        else:
-            assert(len(params) == 3)
-            self._params = params
+    default_name = "gauss"
+    model_type = "peak"
+    default_params = [100., 100., 1.]
+    param_names = ["height", "mean", "sigma"]
+    shift_idx = 1
+    width_idxs = (2,)
+    height_idxs = (0,)
+    peak_components = ((1, 2),)
+
+    def default_bounds(self):
+        return ((0., 0., SIGMA_MIN), (np.inf, 3000., 15.))
 
     def eval(self, params, x):
         """!
         @brief Eval Gauss model for ODR pack.
         ODR pack likes f([params], x) argument arrangement.
-        @param params  Gaussian model parameter array (len=3)
+        @param params  Gaussian model parameter array (len=3) or stack
+            of parameter arrays (n_batch, 3)
         @param x np_array of abscissa to evaluate gauss model at
         @return np_array value of gauss model at specified points.
         """
-        gauss_f = params[0] * np.exp((-1. * (x - params[1]) ** 2) / (2. * params[2] ** 2))
+        p = batch_params(params)
+        gauss_f = p[0] * np.exp((-1. * (x - p[1]) ** 2) / (2. * p[2] ** 2))
         return gauss_f
 
-    def opti_eval(self, x, *params):
+    def jac(self, params, x):
         """!
-        @brief Identical to eval, with flipped argument positions.
-        Scipy optimization routines typically like f(x, *params) format.
-        @param x np_array of abscissa to evaluate gauss model at
-        @param params  Gaussian model parameter array (len=3)
+        @brief Analytic jacobian of the gaussian wrt. its parameters.
         """
-        gauss_f = params[0] * np.exp((-1. * (x - params[1]) ** 2) / (2. * params[2] ** 2))
-        return gauss_f
+        p = batch_params(params)
+        u = x - p[1]
+        g = np.exp(-u ** 2 / (2. * p[2] ** 2))
+        f = p[0] * g
+        return stack_jac([g, f * u / p[2] ** 2, f * u ** 2 / p[2] ** 3], f.shape)
 
     def integral(self, a, b, params):
         """!
@@ -65,28 +81,11 @@ class GaussModel(object):
         @param b End.
         @param params  Gaussian model parameter array (len=3)
         """
-        a = np.sqrt(np.pi / 2.) * -params[0] * params[2]
-        b_f = erf((params[1] - b) / (np.sqrt(2.) * params[2]))
-        b_i = erf((params[1] - a) / (np.sqrt(2.) * params[2]))
-        return a * (b_f - b_i)
-
-    def int_hess(self, a, b, params):
-        """!
-        @brief Computes hessian of gaussian integral for
-        area uncertainty calculations.
-        \f[
-        H^-1 \approx C
-        \f]
-        Where $C$ is the covar matrix and $H$ is the hessian.
-        """
-        reduced_int = lambda p: self.integral(a, b, p)
-        hess_matrix = nd.Hessian(reduced_int)(params)
-        return hess_matrix
-
-    def int_jac(self, a, b, params):
-        reduced_int = lambda p: self.integral(a, b, p)
-        jac = nd.Jacobian(reduced_int)(params)
-        return jac
+        p = batch_columns(params)
+        scale = np.sqrt(np.pi / 2.) * -p[0] * p[2]
+        b_f = erf((p[1] - b) / (SQRT2 * p[2]))
+        b_i = erf((p[1] - a) / (SQRT2 * p[2]))
+        return scale * (b_f - b_i)
 
     def area(self, params):
         """!
@@ -97,97 +96,289 @@ class GaussModel(object):
         \f]
         Where $H=f(\mu)$
         """
-        ar = self.eval(params, params[1]) * np.abs(params[2]) * np.sqrt(2. * np.pi)
+        p = batch_columns(params)
+        ar = p[0] * np.abs(p[2]) * SQRT2PI
         return ar
 
-    def area_hess(self, params):
+    def area_jac(self, params):
         """!
-        @brief Compute hessian of gaussian area function
+        @brief Analytic jacobian of the gaussian area.
         """
-        hess_matrix = nd.Hessian(self.area)(params)
-        return hess_matrix
-
-    def area_jac(self, params):
-        jac = nd.Jacobian(self.area, step=1e-6)(params)
-        return jac
+        p = batch_columns(params)
+        jac = [np.abs(p[2]) * SQRT2PI, np.zeros_like(p[1]),
+               p[0] * np.sign(p[2]) * SQRT2PI]
+        return np.stack(jac, axis=-1)
 
     def fwhm(self, params):
         """!
         @brief Compute full width half max of gaussian
         """
-        return 2.35482 * params[2]
-
-class DblGaussModel(object):
-    def __init__(self, init_params=[1., 1., 1., 2., 2., 2.], **kwargs):
-        self.name = kwargs.pop("name", "dblgauss")
-        self.bounds = ((0., 0., 0., 0., 0., 0.), (np.inf, np.inf, np.inf, np.inf, np.inf, np.inf))
-        self._params = init_params
-        self.gauss_1 = GaussModel(self._params[:3])
-        self.gauss_2 = GaussModel(self._params[3:])
-        self.model_trust = 0.5
+        return 2.35482 * batch_columns(params)[2]
 
-    @property
-    def params(self):
-        return self._params
 
-    @params.setter
-    def params(self, params):
-        if params is None:
-            self._params = [100., 100., 100., 120, 120, 120]
-        else:
-            assert(len(params) == 6)
-            self._params = params
+@peak_models.register("hypermet")
+class HypermetModel(BaseModel):
+    """!
+    @brief Gaussian with a low energy exponential tail (Hypermet style):
+    \f[
+    y(x) = a\ e^{\frac{-(x - \mu)^2}{2\sigma^2}} +
+        \frac{a t}{2}\ e^{(x - \mu) / \beta}\
+        \mathrm{erfc}\left(\frac{x - \mu}{\sqrt{2}\sigma} + \frac{\sigma}{\sqrt{2}\beta}\right)
+    \f]
+    Where $t$ is the tail amplitude relative to the peak height
+    and $\beta$ is the tail slope (keV).
+    The tail replaces the second gaussian that would otherwise be
+    needed to describe incomplete charge collection in HPGe detectors.
+    """
+    default_name = "hypermet"
+    model_type = "peak"
+    default_params = [100., 100., 1., 0.1, 1.]
+    param_names = ["height", "mean", "sigma", "tail_amp", "tail_slope"]
+    shift_idx = 1
+    width_idxs = (2, 4)
+    height_idxs = (0,)
+    peak_components = ((1, 2),)
+
+    def default_bounds(self):
+        return ((0., 0., SIGMA_MIN, 0., 0.05), (np.inf, 3000., 15., 1., 20.))
+
+    @staticmethod
+    def _tail(u, s, beta):
+        """!
+        @brief Numerically stable evaluation of the tail shape
+        T = exp(u/beta) * erfc(z) / 2.
+        For z > 0 the product is formed with the scaled complementary
+        error function to avoid overflow of exp(u/beta).
+        @return (T, g) where g = exp(-u^2/(2s^2) - s^2/(2beta^2))
+        """
+        z = u / (SQRT2 * s) + s / (SQRT2 * beta)
+        g = np.exp(-u ** 2 / (2. * s ** 2) - s ** 2 / (2. * beta ** 2))
+        t_pos = 0.5 * erfcx(np.maximum(z, 0.)) * g
+        t_neg = 0.5 * np.exp(np.minimum(u / beta, 0.)) * erfc(z)
+        return np.where(z > 0., t_pos, t_neg), g
 
     def eval(self, params, x):
-        gauss_f_1 = self.gauss_1.eval(params[:3], x)
-        gauss_f_2 = self.gauss_2.eval(params[3:], x)
-        return gauss_f_1 + gauss_f_2
+        p = batch_params(params)
+        u = x - p[1]
+        tail, _ = self._tail(u, p[2], p[4])
+        return p[0] * (np.exp(-u ** 2 / (2. * p[2] ** 2)) + p[3] * tail)
 
-    def opti_eval(self, x, *params):
-        gauss_f_1 = self.gauss_1.eval(params[:3], x)
-        gauss_f_2 = self.gauss_2.eval(params[3:], x)
-        return gauss_f_1 + gauss_f_2
+    def jac(self, params, x):
+        """!
+        @brief Analytic jacobian of the hypermet peak.
+        """
+        p = batch_params(params)
+        a, s, t, beta = p[0], p[2], p[3], p[4]
+        u = x - p[1]
+        gs = np.exp(-u ** 2 / (2. * s ** 2))
+        tail, g = self._tail(u, s, beta)
+        dt_du = tail / beta - g / (SQRT2PI * s)
+        dt_ds = -g * (1. / beta - u / s ** 2) / SQRT2PI
+        dt_db = -u * tail / beta ** 2 + g * s / (SQRT2PI * beta ** 2)
+        parts = [gs + t * tail,
+                 -a * (-u / s ** 2 * gs + t * dt_du),
+                 a * (u ** 2 / s ** 3 * gs + t * dt_ds),
+                 a * tail,
+                 a * t * dt_db]
+        return stack_jac(parts, np.broadcast(gs, tail).shape)
 
     def integral(self, a, b, params):
-        gauss_int_1 = self.gauss_1.integral(a, b, params[:3])
-        gauss_int_2 = self.gauss_2.integral(a, b, params[3:])
-        return gauss_int_1 + gauss_int_2
+        """!
+        @brief Definite integral of the hypermet peak on [a, b].
+        Uses the tail antiderivative
+        beta * T(u) + beta/2 * exp(-s^2/(2beta^2)) * erf(u/(sqrt(2)s))
+        """
+        p = batch_columns(params)
+        s, beta = p[2], p[4]
+        e_ = np.exp(-s ** 2 / (2. * beta ** 2))
 
-    def int_jac(self, a, b, params):
-        reduced_int = lambda p: self.integral(a, b, p)
-        jac = nd.Jacobian(reduced_int)(params)
-        return jac
+        def antideriv(x):
+            u = x - p[1]
+            tail, _ = self._tail(u, s, beta)
+            gauss_int = np.sqrt(np.pi / 2.) * s * erf(u / (SQRT2 * s))
+            tail_int = beta * tail + 0.5 * beta * e_ * erf(u / (SQRT2 * s))
+            return p[0] * (gauss_int + p[3] * tail_int)
+        return antideriv(b) - antideriv(a)
 
     def area(self, params):
-        gauss_area_1 = self.gauss_1.area(params[:3])
-        gauss_area_2 = self.gauss_2.area(params[3:])
-        return gauss_area_1 + gauss_area_2
+        """!
+        @brief Area of gaussian and tail on $(-\infty, \infty)$.
+        \f[
+        A = a (\sigma \sqrt{2\pi} + t \beta e^{-\sigma^2 / 2\beta^2})
+        \f]
+        """
+        p = batch_columns(params)
+        e_ = np.exp(-p[2] ** 2 / (2. * p[4] ** 2))
+        return p[0] * (np.abs(p[2]) * SQRT2PI + p[3] * p[4] * e_)
 
-    def area_hess(self, params):
-        hess_matrix = nd.Hessian(self.area)(params)
-        return hess_matrix
+    def area_jac(self, params):
+        p = batch_columns(params)
+        a, s, t, beta = p[0], p[2], p[3], p[4]
+        e_ = np.exp(-s ** 2 / (2. * beta ** 2))
+        jac = [np.abs(s) * SQRT2PI + t * beta * e_,
+               np.zeros_like(p[1]),
+               a * (np.sign(s) * SQRT2PI - t * s * e_ / beta),
+               a * beta * e_,
+               a * t * e_ * (1. + s ** 2 / beta ** 2)]
+        return np.stack(jac, axis=-1)
+
+    def fwhm(self, params):
+        """!
+        @brief FWHM of the gaussian core.
+        """
+        return 2.35482 * batch_columns(params)[2]
+
+
+@peak_models.register("pvoigt")
+class PseudoVoigtModel(BaseModel):
+    """!
+    @brief Pseudo-Voigt peak.  Linear mix of a gaussian and a lorentzian
+    of equal FWHM:
+    \f[
+    y(x) = a \left[\eta L(x) + (1 - \eta) G(x)\right]
+    \f]
+    Where $\sigma$ is the gaussian std. deviation and
+    the lorentzian HWHM is $\sqrt{2 \ln 2}\ \sigma$.
+    """
+    default_name = "pvoigt"
+    model_type = "peak"
+    default_params = [100., 100., 1., 0.1]
+    param_names = ["height", "mean", "sigma", "eta"]
+    shift_idx = 1
+    width_idxs = (2,)
+    height_idxs = (0,)
+    peak_components = ((1, 2),)
+
+    def default_bounds(self):
+        return ((0., 0., SIGMA_MIN, 0.), (np.inf, 3000., 15., 1.))
+
+    def eval(self, params, x):
+        p = batch_params(params)
+        u = x - p[1]
+        g = np.exp(-u ** 2 / (2. * p[2] ** 2))
+        l = 1. / (1. + (u / (HWHM_SD * p[2])) ** 2)
+        return p[0] * (p[3] * l + (1. - p[3]) * g)
+
+    def jac(self, params, x):
+        p = batch_params(params)
+        a, s, eta = p[0], p[2], p[3]
+        u = x - p[1]
+        g = np.exp(-u ** 2 / (2. * s ** 2))
+        q = u / (HWHM_SD * s)
+        l = 1. / (1. + q ** 2)
+        dl_du = -2. * q * l ** 2 / (HWHM_SD * s)
+        dl_ds = 2. * q ** 2 * l ** 2 / s
+        parts = [eta * l + (1. - eta) * g,
+                 -a * (eta * dl_du - (1. - eta) * u / s ** 2 * g),
+                 a * (eta * dl_ds + (1. - eta) * u ** 2 / s ** 3 * g),
+                 a * (l - g)]
+        return stack_jac(parts, g.shape)
+
+    def integral(self, a, b, params):
+        p = batch_columns(params)
+        s, eta = p[2], p[3]
+        gamma = HWHM_SD * s
+        l_int = gamma * (np.arctan((b - p[1]) / gamma) - np.arctan((a - p[1]) / gamma))
+        g_int = np.sqrt(np.pi / 2.) * s * (erf((b - p[1]) / (SQRT2 * s)) -
+                                           erf((a - p[1]) / (SQRT2 * s)))
+        return p[0] * (eta * l_int + (1. - eta) * g_int)
+
+    def area(self, params):
+        """!
+        @brief Area on $(-\infty, \infty)$:
+        $A = a |\sigma| [\eta \pi \sqrt{2 \ln 2} + (1 - \eta) \sqrt{2 \pi}]$
+        """
+        p = batch_columns(params)
+        return p[0] * np.abs(p[2]) * (p[3] * np.pi * HWHM_SD + (1. - p[3]) * SQRT2PI)
 
     def area_jac(self, params):
-        jac = nd.Jacobian(self.area)(params)
-        return jac
+        p = batch_columns(params)
+        a, s, eta = p[0], p[2], p[3]
+        shape_f = eta * np.pi * HWHM_SD + (1. - eta) * SQRT2PI
+        jac = [np.abs(s) * shape_f,
+               np.zeros_like(p[1]),
+               a * np.sign(s) * shape_f,
+               a * np.abs(s) * (np.pi * HWHM_SD - SQRT2PI)]
+        return np.stack(jac, axis=-1)
 
     def fwhm(self, params):
-        return self.gauss_1.fwhm(params[:3]), self.gauss_2.fwhm(params[3:])
+        return 2.35482 * batch_columns(params)[2]
+
+
+@peak_models.register("multigauss")
+class MultiGaussModel(BaseModel):
+    """!
+    @brief Sum of n_peaks gaussians (a multiplet) in one sub-model.
+    Parameters are [a_0, b_0, c_0, a_1, b_1, c_1, ...].
+    """
+    default_name = "multigauss"
+    model_type = "peak"
+    shift_idx = None
+
+    def __init__(self, init_params=None, **kwargs):
+        self.n_peaks = kwargs.pop("n_peaks", 2)
+        self.default_params = []
+        for i in range(self.n_peaks):
+            self.default_params += [100., 100. + 20. * i, 1.]
+        self.peak_components = tuple((3 * i + 1, 3 * i + 2) for i in range(self.n_peaks))
+        super(MultiGaussModel, self).__init__(init_params, **kwargs)
+        self.gauss = GaussModel()
+        self.model_trust = 1. / self.n_peaks
+
+    def default_bounds(self):
+        lower, upper = GaussModel().default_bounds()
+        return (tuple(lower) * self.n_peaks, tuple(upper) * self.n_peaks)
+
+    def _split(self, params):
+        p = np.asarray(params, dtype=float)
+        return [p[..., 3 * i: 3 * (i + 1)] for i in range(self.n_peaks)]
+
+    def eval(self, params, x):
+        return sum(self.gauss.eval(p, x) for p in self._split(params))
+
+    def jac(self, params, x):
+        return np.concatenate([self.gauss.jac(p, x) for p in self._split(params)], axis=-1)
+
+    def integral(self, a, b, params):
+        return sum(self.gauss.integral(a, b, p) for p in self._split(params))
+
+    def area(self, params):
+        return sum(self.gauss.area(p) for p in self._split(params))
+
+    def area_jac(self, params):
+        return np.concatenate([self.gauss.area_jac(p) for p in self._split(params)], axis=-1)
+
+    def fwhm(self, params):
+        return tuple(self.gauss.fwhm(p) for p in self._split(params))
+
+    def remap(self, params, g, dg, x):
+        return np.concatenate([self.gauss.remap(p, g, dg, x) for p in self._split(params)])
+
+
+@peak_models.register("dblgauss")
+class DblGaussModel(MultiGaussModel):
+    """!
+    @brief Sum of two gaussians.
+    """
+    default_name = "dblgauss"
+
+    def __init__(self, init_params=None, **kwargs):
+        kwargs["n_peaks"] = 2
+        super(DblGaussModel, self).__init__(init_params, **kwargs)
+        self.gauss_1 = self.gauss
+        self.gauss_2 = self.gauss
+        self.model_trust = 0.5
 
 
 def peak_model_factory(name, **kwargs):
     """!
     @brief Given string, return correct peak class.
-    @param name String.  "gauss" or "dblgauss"
-    @return GaussModel instance
+    @param name String.  One of peak_models.names(), e.g.
+        "gauss", "hypermet", "pvoigt", "dblgauss" or "multigauss"
+    @return peak model instance
     """
     init_params = kwargs.pop("params", None)
-    if name == "gauss":
-        return GaussModel(init_params)
-    elif name == "dblgauss":
-        return DblGaussModel(init_params)
-    else:
-        return GaussModel(init_params)
+    return peak_models.get(name)(init_params, **kwargs)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,233 @@
+"""!
+@brief Module peakindex
+Sorted table of the peaks (ROIs) of a spectrum.
+"""
+from __future__ import division
+import bisect
+import numpy as np
+
+
+class PeakIndex(object):
+    """!
+    @brief Peaks sorted by energy, each with a stable integer id.
+    Locations are kept in a sorted list so lookups, nearest peak and range
+    queries are bisections.  Inserts and deletes bisect for the position
+    and shift the list in place.  A numpy copy of the locations is cached
+    for vectorized use.
+
+    For compatibility with the old float keyed dict the index also
+    supports peak_bank[loc], loc in peak_bank, keys(), items(), pop(loc).
+    Locations passed as keys are matched within self.tol keV.
+    """
+    def __init__(self, tol=1e-6):
+        self.tol = tol
+        self._locs = []
+        self._ids = []
+        self._rois = {}
+        self._loc_by_id = {}
+        self._next_id = 0
+        self._locs_array = None
+
+    # ---- id based interface ---------------------------------------------- #
+    def add(self, loc, peak):
+        """!
+        @brief Insert a peak.
+        @param loc  Float. Peak energy (keV)
+        @param peak  roi.Roi
+        @return Int. New peak id
+        """
+        loc = float(loc)
+        pos = bisect.bisect_right(self._locs, loc)
+        peak_id = self._next_id
+        self._next_id += 1
+        self._locs.insert(pos, loc)
+        self._ids.insert(pos, peak_id)
+        self._rois[peak_id] = peak
+        self._loc_by_id[peak_id] = loc
+        self._locs_array = None
+        return peak_id
+
+    def remove(self, peak_id):
+        """!
+        @brief Delete and return the peak with id peak_id.
+        """
+        pos = self.position(peak_id)
+        del self._locs[pos]
+        del self._ids[pos]
+        del self._loc_by_id[peak_id]
+        self._locs_array = None
+        return self._rois.pop(peak_id)
+
+    def get(self, peak_id, default=None):
+        return self._rois.get(peak_id, default)
+
+    def replace(self, peak_id, peak):
+        """!
+        @brief Replace the roi of an existing peak (e.g. a fitted copy
+        returned by a worker process).
+        """
+        if peak_id not in self._rois:
+            raise KeyError(peak_id)
+        self._rois[peak_id] = peak
+
+    def loc(self, peak_id):
+        return self._loc_by_id[peak_id]
+
+    def position(self, peak_id):
+        """!
+        @brief Rank of the peak in energy order.
+        """
+        pos = bisect.bisect_left(self._locs, self._loc_by_id[peak_id])
+        while self._ids[pos] != peak_id:
+            pos += 1
+        return pos
+
+    def find(self, loc, tol=None):
+        """!
+        @brief Id of the peak at loc (within tol keV), or None.
+        """
+        peak_id, dist = self.nearest(loc)
+        tol = self.tol if tol is None else tol
+        if peak_id is None or dist > tol:
+            return None
+        return peak_id
+
+    def nearest(self, energy):
+        """!
+        @brief Peak closest to energy.
+        @return (peak id, distance in keV) or (None, inf) if empty
+        """
+        if not self._locs:
+            return None, np.inf
+        pos = bisect.bisect_left(self._locs, energy)
+        candidates = [p for p in (pos - 1, pos) if 0 <= p < len(self._locs)]
+        best = min(candidates, key=lambda p: abs(self._locs[p] - energy))
+        return self._ids[best], abs(self._locs[best] - energy)
+
+    def range(self, lo, hi):
+        """!
+        @brief Ids of the peaks with lo < loc < hi, in energy order.
+        """
+        i_lo = bisect.bisect_right(self._locs, lo)
+        i_hi = bisect.bisect_left(self._locs, hi)
+        return self._ids[i_lo:max(i_lo, i_hi)]
+
+    def locs_in(self, lo, hi):
+        """!
+        @brief Locations of the peaks with lo < loc < hi.
+        """
+        i_lo = bisect.bisect_right(self._locs, lo)
+        i_hi = bisect.bisect_left(self._locs, hi)
+        return self.locs[i_lo:max(i_lo, i_hi)]
+
+    def step(self, peak_id, n=1):
+        """!
+        @brief Id of the peak n positions after (n < 0: before) peak_id in
+        energy order, or None past either end.
+        """
+        pos = self.position(peak_id) + n
+        if 0 <= pos < len(self._ids):
+            return self._ids[pos]
+        return None
+
+    def relocate(self, peak_id, loc):
+        """!
+        @brief Move a peak to a new location, keeping its id.
+        """
+        pos = self.position(peak_id)
+        del self._locs[pos]
+        del self._ids[pos]
+        loc = float(loc)
+        pos = bisect.bisect_right(self._locs, loc)
+        self._locs.insert(pos, loc)
+        self._ids.insert(pos, peak_id)
+        self._loc_by_id[peak_id] = loc
+        self._locs_array = None
+
+    def remap(self, fn):
+        """!
+        @brief Move all peaks to fn(loc) in one vectorized call.  fn must
+        be monotonically increasing so the order is unchanged.
+        """
+        new_locs = np.asarray(fn(self.locs), dtype=float)
+        if len(new_locs) > 1 and np.any(np.diff(new_locs) < 0.):
+            raise ValueError("Peak location map must preserve the peak order")
+        self._locs = [float(loc) for loc in new_locs]
+        self._loc_by_id = dict(zip(self._ids, self._locs))
+        self._locs_array = None
+
+    def clear(self):
+        self._locs, self._ids, self._rois, self._loc_by_id = [], [], {}, {}
+        self._locs_array = None
+
+    @property
+    def locs(self):
+        """!
+        @brief np_array of sorted peak locations (read only)
+        """
+        if self._locs_array is None:
+            self._locs_array = np.array(self._locs, dtype=float)
+            self._locs_array.setflags(write=False)
+        return self._locs_array
+
+    @property
+    def ids(self):
+        """!
+        @brief Peak ids in energy order
+        """
+        return list(self._ids)
+
+    def peaks(self):
+        """!
+        @brief (id, roi) pairs in energy order
+        """
+        return [(peak_id, self._rois[peak_id]) for peak_id in self._ids]
+
+    # ---- location keyed (dict like) interface ---------------------------- #
+    def _id_for_key(self, loc):
+        peak_id = self.find(loc)
+        if peak_id is None:
+            raise KeyError(loc)
+        return peak_id
+
+    def __getitem__(self, loc):
+        return self._rois[self._id_for_key(loc)]
+
+    def __setitem__(self, loc, peak):
+        peak_id = self.find(loc)
+        if peak_id is None:
+            self.add(loc, peak)
+        else:
+            self._rois[peak_id] = peak
+
+    def __delitem__(self, loc):
+        self.remove(self._id_for_key(loc))
+
+    def __contains__(self, loc):
+        return self.find(loc) is not None
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        return iter(list(self._locs))
+
+    def keys(self):
+        return list(self._locs)
+
+    def values(self):
+        return [self._rois[peak_id] for peak_id in self._ids]
+
+    def items(self):
+        return list(zip(self._locs, self.values()))
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def pop(self, loc, *default):
+        peak_id = self.find(loc)
+        if peak_id is None:
+            if default:
+                return default[0]
+            raise KeyError(loc)
+        return self.remove(peak_id)
@@ -0,0 +1,64 @@
+"""!
+@brief Module pipeline
+Non interactive analysis of a spectrum: peak search, auto ROI, multiplet
+selection and fit of every peak.  Used by the multi-channel container
+and the directory watching service.
+"""
+import os
+import time
+import gammaspy.gammaData.reader as reader
+import gammaspy.gammaData.spectrum as spectrum
+
+
+def analyze_spectrum(spec, cwt_settings=None, fit_kwargs=None, peak_locs=None, skip=None,
+                     callback=None):
+    """!
+    @brief Find and fit all peaks of a spectrum (in place).  A failed
+    peak fit is reported and skipped.
+    @param spec  spectrum.GammaSpectrum
+    @param cwt_settings  dict of keyword args of GammaSpectrum.find_cwt_peaks
+    @param fit_kwargs  dict of keyword args of Roi.fit_new
+    @param peak_locs  list of peak energies to fit instead of a peak search
+    @param skip  Callable(peak_loc) -> Bool. Peaks not to fit (e.g. fitted
+        by an earlier, interrupted run)
+    @param callback  Callable(peak_id, peak, error) called after each fit,
+        error is None or the error message
+    @return spec
+    """
+    if peak_locs is None:
+        spec.auto_peaks(**(cwt_settings or {}))
+    else:
+        for peak_loc in peak_locs:
+            spec.add_peak(peak_loc)
+    for peak_id, peak in spec.peak_bank.peaks():
+        if skip is not None and skip(spec.peak_bank.loc(peak_id)):
+            continue
+        error = None
+        try:
+            peak.find_roi()
+            peak.check_neighboring_peaks(spec.peak_bank)
+            peak.fit_new(**(fit_kwargs or {}))
+        except Exception as e:
+            error = str(e)
+            print("Fit of peak at %f keV failed: %s" % (spec.peak_bank.loc(peak_id), error))
+        if callback is not None:
+            callback(peak_id, peak, error)
+    return spec
+
+
+def analyze_file(fname, chan=0, cwt_settings=None, fit_kwargs=None, cache=None):
+    """!
+    @brief Read and analyze one spectrum file.
+    Module level and returns plain data so it can run in a process pool.
+    @param cache  cache.SpectrumCache (or True) for CNF parsing
+    @return dict with keys path, chan, size, mtime, metadata, peaks
+        (spectrum.PEAK_TABLE_DTYPE array) and elapsed (s)
+    """
+    t0 = time.time()
+    st = os.stat(fname)
+    metadata, counts = reader.DataReader(cache=cache).read_counts(fname, chan)
+    spec = analyze_spectrum(spectrum.GammaSpectrum(metadata=metadata, counts=counts),
+                            cwt_settings, fit_kwargs)
+    return {"path": os.path.abspath(fname), "chan": chan, "size": st.st_size,
+            "mtime": st.st_mtime, "metadata": spec.metadata, "peaks": spec.peak_table(),
+            "elapsed": time.time() - t0}
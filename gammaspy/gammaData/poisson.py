@@ -0,0 +1,166 @@
+"""!
+@brief Module poisson
+Poisson maximum likelihood (Cash statistic) fitting of FitModels.
+Well suited for low count ROIs where least squares weights break down.
+"""
+from __future__ import division
+import numpy as np
+from scipy.optimize import minimize, OptimizeResult
+
+## Floor for the expected number of counts in a channel
+MU_MIN = 1e-10
+
+
+def cash_stat(mu, counts):
+    """!
+    @brief Poisson deviance (Cash statistic)
+    \f[
+    C = 2 \sum_i \mu_i - n_i + n_i \ln(n_i / \mu_i)
+    \f]
+    @param mu  np_array (n_x,) or (n_batch, n_x) of expected counts
+    @param counts  np_array (n_x,) of observed counts
+    @return C, scalar or (n_batch,)
+    """
+    mu = np.maximum(mu, MU_MIN)
+    n_log_n = np.where(counts > 0, counts * np.log(np.maximum(counts, 1.)), 0.)
+    return 2. * np.sum(mu - counts + n_log_n - counts * np.log(mu), axis=-1)
+
+
+def log_likelihood(mu, counts):
+    """!
+    @brief Poisson log likelihood up to a params independent constant
+    (-C / 2).  Vectorized over a stack of expected count arrays.
+    """
+    return -0.5 * cash_stat(mu, counts)
+
+
+def cash_grad(mu, counts, jac):
+    """!
+    @brief Gradient of the Cash statistic.
+    \f[
+    \nabla C = 2 \sum_i (1 - n_i / \mu_i) \nabla \mu_i
+    \f]
+    @param jac  np_array (n_x, n_params) jacobian of mu
+    """
+    mu = np.maximum(mu, MU_MIN)
+    return 2. * np.dot(1. - counts / mu, jac)
+
+
+def fisher_info(mu, jac):
+    """!
+    @brief Fisher information matrix $J^T diag(1/\mu) J$.
+    The inverse is the asymptotic covariance of the ML estimate.
+    """
+    mu = np.maximum(mu, MU_MIN)
+    return np.dot(jac.T / mu, jac)
+
+
+class CashObjective(object):
+    """!
+    @brief Cash statistic of a FitModel over its free parameters.
+    Model output is a density (counts / keV), so it is multiplied by the
+    bin widths to give expected counts.
+    """
+    def __init__(self, model, x, counts, widths):
+        self.model = model
+        self.x = x
+        self.counts = np.asarray(counts, dtype=float)
+        self.widths = widths
+
+    def mu(self, free_params):
+        return self.model.opti_eval_free(self.x, free_params) * self.widths
+
+    def jac(self, free_params):
+        return self.model.opti_jac_free(self.x, free_params) * self.widths[..., np.newaxis]
+
+    def __call__(self, free_params):
+        """!
+        @brief Value and gradient, for minimize(..., jac=True)
+        """
+        mu = self.mu(free_params)
+        return cash_stat(mu, self.counts), cash_grad(mu, self.counts, self.jac(free_params))
+
+    def value(self, free_params):
+        """!
+        @brief Value only.  Accepts a stack of free params (n_batch, n_free).
+        """
+        return cash_stat(self.mu(free_params), self.counts)
+
+    def fisher(self, free_params):
+        return fisher_info(self.mu(free_params), self.jac(free_params))
+
+
+def fisher_scoring(objective, x0, bounds, maxiter=50, tol=1e-8):
+    """!
+    @brief Newton type minimization of the Cash statistic using the
+    Fisher information as the (expected) hessian.  Steps are halved
+    until the statistic decreases and clipped to the bounds.
+    """
+    lower, upper = bounds
+    p = np.clip(np.asarray(x0, dtype=float), lower, upper)
+    c, g = objective(p)
+    n_iter = 0
+    for n_iter in range(1, maxiter + 1):
+        info = objective.fisher(p)
+        # levenberg style damping keeps the step well defined when
+        # the information matrix is near singular
+        info += 1e-9 * np.diag(np.diag(info)) + 1e-12 * np.eye(len(p))
+        step = np.linalg.solve(info, g) / 2.
+        scale = 1.
+        while scale > 1e-4:
+            trial = np.clip(p - scale * step, lower, upper)
+            c_trial, g_trial = objective(trial)
+            if c_trial <= c:
+                break
+            scale /= 2.
+        else:
+            break
+        converged = abs(c - c_trial) < tol * (1. + abs(c))
+        p, c, g = trial, c_trial, g_trial
+        if converged:
+            break
+    return p, c, n_iter
+
+
+def newton_method(fun, x0, args=(), bounds=None, maxiter=50, **unused_options):
+    """!
+    @brief Fisher scoring as a custom scipy.optimize.minimize method, so it
+    can be used as the local minimizer of basinhopping:
+    minimizer_kwargs={"method": newton_method, "bounds": ...}
+    @param fun  CashObjective
+    """
+    n = len(x0)
+    if bounds is None:
+        bounds = [(None, None)] * n
+    lower = np.array([-np.inf if b[0] is None else b[0] for b in bounds])
+    upper = np.array([np.inf if b[1] is None else b[1] for b in bounds])
+    p, c, n_iter = fisher_scoring(fun, x0, (lower, upper), maxiter)
+    return OptimizeResult(x=p, fun=c, nit=n_iter, nfev=n_iter, success=True)
+
+
+def fit_poisson(model, x, counts, widths, p0, method="newton", maxiter=200):
+    """!
+    @brief Poisson maximum likelihood fit of a FitModel.
+    @param model  FitModel
+    @param x np_array of abscissa
+    @param counts  np_array of observed counts per channel
+    @param widths  np_array of channel widths (keV)
+    @param p0  np_array initial full model params
+    @param method  String. "newton" (Fisher scoring) or "L-BFGS-B"
+        (analytic gradient)
+    @return (popt, pcov, cash statistic, number of iterations) where
+        popt and pcov are given for the full model params
+    """
+    objective = CashObjective(model, x, counts, widths)
+    lower, upper = model.free_bounds()
+    free_p0 = np.clip(model.reduce(p0), lower, upper)
+    if method == "newton":
+        free_popt, cash, n_iter = fisher_scoring(objective, free_p0, (lower, upper), maxiter)
+    else:
+        bounds = list(zip(np.where(np.isfinite(lower), lower, None),
+                          np.where(np.isfinite(upper), upper, None)))
+        res = minimize(objective, free_p0, jac=True, method="L-BFGS-B", bounds=bounds,
+                       options={"maxiter": maxiter})
+        free_popt, cash, n_iter = res.x, res.fun, res.nit
+    free_pcov = np.linalg.pinv(objective.fisher(free_popt))
+    return model.expand(free_popt), model.expand_cov(free_pcov, free_popt), cash, n_iter
@@ -7,6 +7,8 @@ from six import iteritems
 import xylib
 import h5py
 import numpy as np
+import gammaspy.gammaData.calibration as calibration
+import gammaspy.gammaData.cache as spec_cache
 
 
 class DataReader(object):
@@ -14,8 +16,14 @@ class DataReader(object):
     @biref Wapper around some parts of xylib to parse Genie *.CNF files.
     Also allows read/write to HDF5
     """
-    def __init__(self):
-        pass
+    def __init__(self, cache=None):
+        """!
+        @param cache  cache.SpectrumCache of parsed CNF files, True for a
+            cache in the default directory, None to always parse
+        """
+        if cache is True:
+            cache = spec_cache.SpectrumCache()
+        self.cache = cache or None
 
     def _export_metadata(self, meta):
         """!
@@ -31,6 +39,15 @@ class DataReader(object):
     def _readXY(self, fname, i=0):
         """!
         @brief Read data from CNF file
+        @return [metadata, count_energy]
+        """
+        metadata, count_energy = self._readXY_counts(fname, i)
+        return [metadata, self.conv_counts_per_enregy(count_energy)]
+
+    def _readXY_counts(self, fname, i=0):
+        """!
+        @brief Read raw energy vs counts data from CNF file
+        @return [metadata, np_2darray [[energy (kev), counts]]]
         """
         xy_data = xylib.load_file(fname)
         print("Reading data by xylib from file format: %s \n" % xy_data.fi.name)
@@ -56,7 +73,7 @@ class DataReader(object):
                 metadata['r_time'] = float(val)
             elif key.split(' ')[0] == 'energy':
                 metadata['e_cal'].append(float(val))
-        return [metadata, self.conv_counts_per_enregy(count_energy)]
+        return [metadata, count_energy]
 
     def conv_counts_per_enregy(self, count_energy):
         """!
@@ -73,6 +90,30 @@ class DataReader(object):
         counts_per_energy_vs_energy = np.array([energy, counts_per_energy]).T
         return counts_per_energy_vs_energy
 
+    def _read_channel(self, h5f, chan):
+        """!
+        @brief Read one channel group of an open HDF5 file.
+        @return [metadata, count_energy]
+        """
+        grp = h5f[str(chan)]
+        if 'spectrum' in grp:
+            count_energy = grp['spectrum'][:]
+        else:
+            # compact channel: raw counts + energy calibration
+            counts = grp['counts'][:]
+            energy = calibration.channel_energy(grp['e_cal'][:], len(counts))
+            count_energy = self.conv_counts_per_enregy(np.column_stack((energy, counts)))
+        metadata = {}
+        metadata['e_cal'] = grp['e_cal'][:].tolist() if 'e_cal' in grp else []
+        for key in ('l_time', 'r_time'):
+            if key in grp:
+                metadata[key] = float(grp[key][()])
+        if 'fwhm_cal' in grp:
+            metadata['fwhm_cal'] = grp['fwhm_cal'][:].tolist()
+        for key, val in iteritems(grp.attrs):
+            metadata[key] = val.decode() if isinstance(val, bytes) else val
+        return [metadata, count_energy]
+
     def _readHDF5(self, fname, chan=0):
         """!
         @brief Reads count vs energy data from HDF5 file and
@@ -80,14 +121,63 @@ class DataReader(object):
         @param fname String.  Name of file.
         @return [metadata, count_energy]
         """
-        h5f = h5py.File(fname, 'r')
-        count_energy = h5f[str(chan) + '/spectrum'][:]
-        metadata = {}
-        metadata['e_cal'] = h5f[str(chan) + '/e_cal'][:]
-        metadata['live_time'] = h5f[str(chan) + '/l_time']
-        metadata['real_time'] = h5f[str(chan) + '/r_time']
-        h5f.close()
-        return [metadata, count_energy]
+        with h5py.File(fname, 'r') as h5f:
+            return self._read_channel(h5f, chan)
+
+    def channels(self, fname):
+        """!
+        @brief Channel (detector) numbers stored in an HDF5 file
+        """
+        with h5py.File(fname, 'r') as h5f:
+            return sorted(int(key) for key in h5f.keys() if key.isdigit())
+
+    def read_channels(self, fname, chans=None):
+        """!
+        @brief Read several channels of an HDF5 file in one file operation.
+        @param chans  list of channel numbers (default: all)
+        @return [list of metadata dicts, list of count_energy arrays]
+        """
+        with h5py.File(fname, 'r') as h5f:
+            if chans is None:
+                chans = sorted(int(key) for key in h5f.keys() if key.isdigit())
+            data = [self._read_channel(h5f, chan) for chan in chans]
+        return [d[0] for d in data], [d[1] for d in data]
+
+    def read_counts(self, fname, chan=0):
+        """!
+        @brief Read raw integer channel counts and the energy calibration,
+        for compact GammaSpectrum storage (GammaSpectrum(counts=..)).
+        metadata['e_cal'] is refit if it does not reproduce the energies
+        in the file.
+        @return [metadata, np_array of uint32 counts]
+        """
+        if type(fname) is tuple:
+            fname = fname[0]
+        _, ext = os.path.splitext(fname)
+        if ext == '.h5' or ext == '.hdf5':
+            with h5py.File(fname, 'r') as h5f:
+                grp = h5f[str(chan)]
+                if 'counts' in grp:
+                    metadata, _ = self._read_channel(h5f, chan)
+                    return [metadata, grp['counts'][:].astype(np.uint32)]
+                metadata, count_energy = self._read_channel(h5f, chan)
+            energy = count_energy[:, 0]
+            widths = np.diff(energy)
+            widths = np.append(widths[:1], widths)
+            counts = count_energy[:, 1] * widths
+        elif self.cache is not None:
+            metadata, count_energy = self._readXY_cached(fname)
+            energy = count_energy[:, 0]
+            widths = np.diff(energy)
+            widths = np.append(widths[:1], widths)
+            counts = count_energy[:, 1] * widths
+        else:
+            metadata, count_energy = self._readXY_counts(fname)
+            energy, counts = count_energy[:, 0], count_energy[:, 1]
+        e_cal = metadata.get('e_cal')
+        order = max(len(e_cal) - 1, 1) if e_cal else 1
+        metadata['e_cal'] = calibration.fit_e_cal(energy, order, e_cal)
+        return [metadata, np.rint(counts).astype(np.uint32)]
 
     def read(self, fname, chan=0):
         """!
@@ -99,22 +189,72 @@ class DataReader(object):
         _, ext = os.path.splitext(fname)
         if ext == '.h5' or ext == '.hdf5':
             return self._readHDF5(fname, chan)
+        if self.cache is not None:
+            return self._readXY_cached(fname)
         return self._readXY(fname)
 
-    def write(self, fname, metadata, spectrum, peak_info=None):
+    def _readXY_cached(self, fname, i=0):
+        """!
+        @brief Read CNF file through the parsed file cache.  Cached spectra
+        are returned as read only memory maps.
+        """
+        cached = self.cache.get(fname, i)
+        if cached is not None:
+            return cached
+        metadata, count_energy = self._readXY(fname, i)
+        self.cache.put(fname, count_energy, metadata, i)
+        return [metadata, count_energy]
+
+    def _write_channel(self, h5f, chan, metadata, spectrum, peak_info=None):
+        grp = h5f.require_group(str(chan))
+        for key in list(grp.keys()):
+            del grp[key]
+        spectrum = np.asarray(spectrum)
+        if spectrum.ndim == 1:
+            # compact: raw channel counts, energies follow from e_cal
+            grp.create_dataset('counts', data=spectrum.astype(np.uint32), compression="gzip",
+                               compression_opts=9)
+        else:
+            grp.create_dataset('spectrum', data=spectrum, compression="gzip", compression_opts=9)
+        grp.create_dataset('e_cal', data=np.asarray(metadata.get('e_cal', []), dtype=float))
+        for key in ('l_time', 'r_time'):
+            if key in metadata:
+                grp.create_dataset(key, data=metadata[key])
+        if metadata.get('fwhm_cal') is not None:
+            grp.create_dataset('fwhm_cal', data=np.asarray(metadata['fwhm_cal'], dtype=float))
+        if metadata.get('detector') is not None:
+            grp.attrs['detector'] = metadata['detector']
+        if peak_info is not None:
+            grp.create_dataset('peaks', data=peak_info)
+
+    def write(self, fname, metadata, spectrum, peak_info=None, chan=0, mode='w'):
         """!
         @brief Write spectrum data and fitted peak info to HDF5 file
         @param fname String.  output filename
         @param metadata dict.
-        @param spectrum  Numpy 2D array (counts vs energy)
+        @param spectrum  Numpy 2D array (counts vs energy), or 1D array of
+            raw channel counts (compact, requires metadata['e_cal'])
         @param peak_info array of peak parameters
+        @param chan  Int. Channel (detector) number
+        @param mode  String. 'w' to overwrite the file, 'a' to add/replace
+            the channel in an existing file
+        """
+        with h5py.File(fname, mode) as h5f:
+            self._write_channel(h5f, chan, metadata, spectrum, peak_info)
+
+    def write_channels(self, fname, metadata, spectra, peak_info=None, chans=None, mode='w'):
+        """!
+        @brief Write several channels in one file operation.
+        @param metadata  list of metadata dicts
+        @param spectra  list of Numpy 2D arrays (counts vs energy)
+        @param peak_info  list of peak info arrays (or None)
+        @param chans  list of channel numbers (default: 0 .. n-1)
         """
-        h5f = h5py.File(fname, 'w')
-        h5f.create_dataset('0/spectrum', data=spectrum, compression="gzip", compression_opts=9)
-        h5f.create_dataset('0/e_cal', data=metadata['e_cal'])
-        h5f.create_dataset('0/l_time', data=metadata['l_time'])
-        h5f.create_dataset('0/r_time', data=metadata['r_time'])
-        h5f.close()
+        chans = range(len(spectra)) if chans is None else chans
+        peak_info = [None] * len(spectra) if peak_info is None else peak_info
+        with h5py.File(fname, mode) as h5f:
+            for chan, mdata, spec, info in zip(chans, metadata, spectra, peak_info):
+                self._write_channel(h5f, chan, mdata, spec, info)
 
 
 if __name__ == "__main__":
@@ -6,13 +6,27 @@ from __future__ import division
 import gammaspy.gammaData.fitmodel as fm
 import gammaspy.gammaData.peak as peak
 import gammaspy.gammaData.bg as bg
-from scipy.odr import Model, Data, ODR
+import gammaspy.gammaData.parallel as parallel
+import gammaspy.gammaData.poisson as poisson
+import gammaspy.gammaData.mcmc as mcmc
+import gammaspy.gammaData.multistart as multistart
+import gammaspy.gammaData.sharedspec as sharedspec
+from scipy.odr import Model, RealData, ODR
 from scipy.signal import savgol_filter
 from scipy.optimize import curve_fit, basinhopping, minimize
 import numpy as np
+import time
+from six import iteritems
 np.set_printoptions(linewidth=200)
 
 
+class FitCancelled(Exception):
+    """!
+    @brief Raised by Roi.fit_new when its cancel event is set.
+    """
+    pass
+
+
 class Roi(object):
     """!
     @brief Region of interest (ROI)
@@ -26,25 +40,96 @@ class Roi(object):
     |   l_bg   |   peak     |   r_bg   |
     @endverbatim
     """
-    def __init__(self, spectrum, centroid=1000.):
+    def __init__(self, spectrum, centroid=1000., peak_model="gauss", bg_model="linear",
+                 shape_cal=None):
         self._centroid = centroid
         self.bg_bounds = [self._centroid - 12.,
                           self._centroid - 1.,
                           self._centroid + 1.,
                           self._centroid + 12.]
         self.enabled_peak_models = {"gauss": True, "dblgauss": True}
-        self._peak_models = ["gauss"]
-        self._bg_models = ["linear"]
+        self.max_multiplet_order = 4
+        self.model_selection = []
+        self._peak_models = [peak_model]
+        self._bg_models = [bg_model]
+        # resolution curve for constrained (tied width) fits
+        self.res_cal = None
+        # fit objective: "lsq", "poisson" or "auto"
+        self.fit_method = "auto"
+        self.low_count_threshold = 10
+        # global search of fit_new: "basinhopping" or "multistart"
+        self.global_method = "basinhopping"
+        # energy std. deviation for ODR fits, None for the channel width / sqrt(12)
+        self.x_sigma = None
+        # whole spectrum continuum (see set_continuum)
+        self.continuum_orig = None
+        self.fix_bg = False
         # composition
         self.peak_model = peak.GaussModel([100., self._centroid, 1.])
         self.bg_model = bg.LinModel()
         self._init_params = np.concatenate((self.bg_model.params, self.peak_model.params))
-        self.model = fm.FitModel(bg_order=1, n_peaks=1, peak_centers=[self._centroid])
+        self.model = self.build_model(1, [self._centroid])
         # data stor
         self.roi_data_orig = spectrum
         self.roi_data = np.array([])
         self.update_data(spectrum)
         self.popt, self.pcov = None, None
+        # last converged fit, used to warm start the next one
+        self.fit_state = None
+        self.shape_cal = shape_cal
+        # (spectrum, continuum) sharedspec.SharedArray handles, see share()
+        self._shared = None
+
+    def __getstate__(self):
+        """!
+        @brief With shared spectrum data (see share) only the handles are
+        pickled, not the full spectrum and continuum.
+        """
+        state = self.__dict__.copy()
+        if self._shared is not None:
+            for key in ("roi_data_orig", "_bin_widths_orig", "continuum_orig", "roi_data",
+                        "bin_widths", "continuum"):
+                state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._shared = state.get("_shared")
+        if self._shared is not None:
+            spectrum_handle, continuum_handle = self._shared
+            spectrum = sharedspec.attach(spectrum_handle)
+            bin_widths = np.diff(spectrum[:, 0])
+            self._bin_widths_orig = np.append(bin_widths[:1], bin_widths) if len(bin_widths) \
+                else np.ones(len(spectrum))
+            self.roi_data_orig = spectrum
+            self.continuum_orig = None if continuum_handle is None else \
+                sharedspec.attach(continuum_handle)
+            self._slice_data()
+
+    def share(self, store, continuum_handle=None, spectrum_handle=None):
+        """!
+        @brief Put the full spectrum and continuum of the ROI in shared
+        memory, so pickled copies (process pool tasks and their results)
+        carry only handles and attach to the shared arrays.
+        @param store  sharedspec.SharedSpectrumStore
+        """
+        if spectrum_handle is None:
+            spectrum_handle = store.put(self.roi_data_orig)
+        if continuum_handle is None and self.continuum_orig is not None:
+            continuum_handle = store.put(self.continuum_orig)
+        self._shared = (spectrum_handle, continuum_handle)
+
+    def unshare(self, spectrum, continuum=None):
+        """!
+        @brief Move the ROI back to private arrays (e.g. before the shared
+        store is closed) without touching the model or fit results.
+        @param spectrum  np_array (n, 2), same energy grid as the shared one
+        """
+        self._shared = None
+        self.roi_data_orig = spectrum
+        if self.continuum_orig is not None:
+            self.continuum_orig = continuum
+        self._slice_data()
 
     @property
     def lbound(self):
@@ -52,8 +137,7 @@ class Roi(object):
 
     @lbound.setter
     def lbound(self, lbound):
-        self.bg_bounds[0] = lbound
-        self.update_data(self.roi_data_orig)
+        self.set_bounds(lbound, self.bg_bounds[-1])
 
     @property
     def ubound(self):
@@ -61,17 +145,188 @@ class Roi(object):
 
     @ubound.setter
     def ubound(self, ubound):
-        self.bg_bounds[-1] = ubound
-        self.update_data(self.roi_data_orig)
+        self.set_bounds(self.bg_bounds[0], ubound)
+
+    def set_bounds(self, lbound, ubound):
+        """!
+        @brief Move both ROI bounds at once, re-slicing the data a single
+        time.  Does nothing if the bounds are unchanged.
+        """
+        if lbound == self.bg_bounds[0] and ubound == self.bg_bounds[-1]:
+            return
+        self.bg_bounds[0], self.bg_bounds[-1] = lbound, ubound
+        self.update_data()
+
+    def remap_energy(self, energy_map, spectrum):
+        """!
+        @brief Move the ROI to a recalibrated energy axis without refitting.
+        Bounds, centroid and the model, fitted and warm start params are
+        transformed by the energy map (see FitModel.remap).  The continuum
+        is dropped and has to be set again for the new axis.
+        @param energy_map  calibration.EnergyMap
+        @param spectrum  np_array (n, 2) of the remapped full spectrum
+        """
+        g, dg = energy_map, energy_map.deriv
+        x_old = self.roi_data[:, 0]
+        if self.popt is not None:
+            if self.pcov is not None:
+                self.pcov = self.model.remap_cov(self.pcov, self.popt, g, dg, x_old)
+                self.perr = np.sqrt(np.abs(np.diag(self.pcov)))
+            self.popt = self.model.remap(self.popt, g, dg, x_old)
+        if self.fit_state is not None:
+            old_model = self.fit_state["model"]
+            self.fit_state["cov"] = old_model.remap_cov(self.fit_state["cov"],
+                                                        self.fit_state["params"], g, dg, x_old)
+            self.fit_state["params"] = old_model.remap(self.fit_state["params"], g, dg, x_old)
+        self.model.model_params = self.model.remap(self.model.model_params, g, dg, x_old)
+        self._centroid = float(g(self._centroid))
+        self.bg_bounds = [float(b) for b in g(np.array(self.bg_bounds))]
+        self.continuum_orig = None
+        self.model.unfix()
+        self.update_data(spectrum)
+        if hasattr(self, "y_hat"):
+            self.y_hat = self.model.eval(self.roi_data[:, 0])
 
     def update_data(self, spectrum=None):
         """!
-        @brief Updates data contained in ROI when self.bg_bounds changes
+        @brief Updates data contained in ROI when self.bg_bounds changes.
+        The energy axis is sorted, so the ROI is a contiguous slice found
+        by bisection.
+        @param spectrum  np_array (n, 2) of the full spectrum.  Defaults
+            to the spectrum the ROI was created from.
         """
-        if spectrum is None:
-            spectrum = self.roi_data
-        selection = (spectrum[:, 0] > self.bg_bounds[0]) & (spectrum[:, 0] < self.bg_bounds[-1])
-        self.roi_data = spectrum[selection]
+        if spectrum is not None:
+            # energy bin widths, same convention as DataReader.conv_counts_per_enregy
+            bin_widths = np.diff(spectrum[:, 0])
+            bin_widths = np.append(bin_widths[:1], bin_widths) if len(bin_widths) \
+                else np.ones(len(spectrum))
+            self.roi_data_orig = spectrum
+            self._bin_widths_orig = bin_widths
+        self._slice_data()
+        if self.continuum_orig is not None:
+            self.apply_continuum()
+
+    def _slice_data(self):
+        """!
+        @brief Views of the full spectrum arrays inside the ROI bounds
+        """
+        spectrum = self.roi_data_orig
+        i_lo = np.searchsorted(spectrum[:, 0], self.bg_bounds[0], side="right")
+        i_hi = np.searchsorted(spectrum[:, 0], self.bg_bounds[-1], side="left")
+        self.roi_data = spectrum[i_lo:max(i_lo, i_hi)]
+        self.bin_widths = self._bin_widths_orig[i_lo:max(i_lo, i_hi)]
+        if self.continuum_orig is not None:
+            self.continuum = self.continuum_orig[i_lo:max(i_lo, i_hi)]
+
+    @property
+    def roi_continuum(self):
+        """!
+        @brief Continuum in the ROI (counts / keV) or None
+        """
+        return self.continuum if self.continuum_orig is not None else None
+
+    def set_continuum(self, continuum, fix=False):
+        """!
+        @brief Use a precomputed whole spectrum continuum (see
+        continuum.estimate_continuum) to seed the background params of
+        every model built for this ROI.
+        @param continuum  np_array of counts / keV on the full spectrum
+            energy grid, or None to fit the background from scratch
+        @param fix  Bool. Hold the background params at the continuum
+            values, leaving only the peak params free.
+        """
+        self.continuum_orig = continuum
+        self.fix_bg = fix
+        if continuum is None:
+            self.model.unfix()
+            return
+        self.update_data()
+
+    def apply_continuum(self, model=None):
+        """!
+        @brief Seed (and optionally fix) the bg params of model from a fit
+        of the bg sub models to the continuum in the ROI.
+        """
+        model = self.model if model is None else model
+        if self.continuum_orig is None or len(self.roi_data) < 2:
+            return model
+        x = self.roi_data[:, 0]
+        params = np.array(model.model_params, dtype=float)
+        bg_idxs = []
+        for _, sub_model in model.bg_models():
+            params[sub_model["idxs"]] = sub_model["model"].guess(x, self.continuum)
+            bg_idxs += sub_model["idxs"]
+        model.model_params = model.apply_ties(params)
+        model.unfix(bg_idxs)
+        if self.fix_bg:
+            model.fix(bg_idxs)
+        return model
+
+    @property
+    def roi_counts(self):
+        """!
+        @brief Raw counts per channel in the ROI
+        """
+        return np.maximum(np.rint(self.roi_data[:, 1] * self.bin_widths), 0.)
+
+    def data_sigma(self):
+        """!
+        @brief Poisson std. deviation of the ROI data (counts / keV).
+        Channels with zero counts are given the uncertainty of one count.
+        """
+        return np.sqrt(np.maximum(self.roi_counts, 1.)) / self.bin_widths
+
+    def resolve_fit_method(self, method=None):
+        """!
+        @brief Choose the fit objective.  "auto" uses Poisson maximum
+        likelihood when any ROI channel holds fewer than
+        self.low_count_threshold counts and least squares otherwise.
+        @param method  String. "lsq", "poisson", "odr" or "auto".  Defaults to self.fit_method
+        """
+        method = self.fit_method if method is None else method
+        if method == "auto":
+            low_counts = np.min(self.roi_counts) < self.low_count_threshold
+            method = "poisson" if low_counts else "lsq"
+        return method
+
+    def local_fit(self, p0, method="lsq"):
+        """!
+        @brief Local fit of self.model from p0.  The Roi is not modified.
+        @param p0  np_array of initial full model params
+        @param method  String. "lsq", "poisson" or "odr"
+        @return (popt, pcov, info) of the full model params.  info is a dict
+            of backend details: cash and n_iter (poisson), fit_output (odr)
+        """
+        x = self.roi_data[:, 0]
+        if method == "poisson":
+            popt, pcov, cash, n_iter = poisson.fit_poisson(self.model, x, self.roi_counts,
+                                                           self.bin_widths, p0)
+            print("Poisson ML fit: C = %f after %d iterations" % (cash, n_iter))
+            return popt, pcov, {"cash": cash, "n_iter": n_iter}
+        if method == "odr":
+            popt, pcov, fit_output = self.odr(self.model, x, self.roi_data[:, 1], p0,
+                                              self.data_sigma(), self.energy_sigma())
+            return popt, pcov, {"fit_output": fit_output}
+        popt, pcov = self.curve_fit(self.model, x, self.roi_data[:, 1], p0, self.data_sigma())
+        return popt, pcov, {}
+
+    def preview_fit(self, method=None):
+        """!
+        @brief Cheap fit for interactive previews, e.g. while editing the
+        ROI bounds.  Only a local fit warm started from the last converged
+        fit is run.  The stored fit results are left untouched.
+        @return (x, y_hat) of the preview, or None if there is no previous
+            fit or the local fit fails.
+        """
+        warm_params = self.warm_start_params()
+        if warm_params is None or len(self.roi_data) < len(warm_params):
+            return None
+        x = self.roi_data[:, 0]
+        try:
+            popt, pcov, _ = self.local_fit(warm_params, self.resolve_fit_method(method))
+        except (RuntimeError, ValueError, np.linalg.LinAlgError):
+            return None
+        return x, self.model.opti_eval(x, *popt)
 
     def find_roi(self, threshold=50., wl=5, tailbuf=4., **kwargs):
         """!
@@ -91,14 +346,16 @@ class Roi(object):
         # start at centroid and walk right
         r_mask = (self.roi_data_orig[:, 0] >= self._centroid)
         r_data = roi_data_2div[r_mask]
+        lbound, ubound = self.lbound, self.ubound
         for i, l_2div in enumerate(l_data[::-1]):
             if l_2div[1] > threshold:
-                self.lbound = l_2div[0] - tailbuf
+                lbound = l_2div[0] - tailbuf
                 break
         for i, r_2div in enumerate(r_data):
             if r_2div[1] > threshold:
-                self.ubound = r_2div[0] + tailbuf
+                ubound = r_2div[0] + tailbuf
                 break
+        self.set_bounds(lbound, ubound)
         # self.update_data()
         print("Done fitting ROI")
         print("Lower Bound: %f, Upper Bound: %f" % (self.lbound, self.ubound))
@@ -117,6 +374,40 @@ class Roi(object):
         """
         return self._bg_models
 
+    def set_models(self, peak_model=None, bg_model=None):
+        """!
+        @brief Select the peak and background shapes used by fit_new.
+        @param peak_model  String. Registered peak model name (see peak.peak_models)
+        @param bg_model  String. Registered bg model name (see bg.bg_models)
+        """
+        if peak_model is not None:
+            self._peak_models = [peak_model]
+        if bg_model is not None:
+            self._bg_models = [bg_model]
+        centers = self._sub_model_centers()
+        self.model = self.build_model(len(centers), centers)
+
+    def _sub_model_centers(self):
+        """!
+        @brief Mean of the first component of each peak sub-model, to
+        rebuild the model with other shapes or constraints.
+        """
+        params = np.asarray(self.model.model_params, dtype=float)
+        return [params[sub_model["idxs"][sub_model["model"].peak_components[0][0]]]
+                for _, sub_model in self.model.peak_models()]
+
+    def build_model(self, n_peaks, peak_centers):
+        """!
+        @brief Composes the background and peak models selected for this ROI.
+        """
+        model = fm.FitModel(1, n_peaks, peak_centers, bg_model=self._bg_models[0],
+                            peak_model=self._peak_models[0])
+        if self.res_cal is not None:
+            model.tie_widths(self.res_cal)
+        if self.continuum_orig is not None:
+            self.apply_continuum(model)
+        return model
+
     @property
     def init_params(self):
         return self._init_params
@@ -125,56 +416,357 @@ class Roi(object):
     def init_params(self, init_params):
         self._init_params = init_params
 
-    def check_neighboring_peaks(self, all_peak_locs):
+    def check_neighboring_peaks(self, all_peak_locs, criterion="bic", n_workers=None):
         """!
         @brief Checks if any other peaks are inside the ROI.
-        If so, then try to fit a dblgauss model.
+        If so, candidate multiplet models with 1 .. N peaks are built,
+        seeded at the known neighbor locations, and the best order
+        is chosen by an information criterion (see select_model).
         This should be run before the self.fit() routine is run.
-        @param all_peak_locs 1d_array of all peak locations
-        """
-        is_neighbor_mask = (all_peak_locs > self.lbound) & (all_peak_locs < self.ubound)
-        if np.count_nonzero(is_neighbor_mask) > 1 and self.enabled_peak_models["dblgauss"]:
-            print("Double Gauss Model Enabled!")
-            self.model = fm.FitModel(1, 2, [self._centroid, self._centroid])
-        elif not self.enabled_peak_models["gauss"]:
-            print("Double Gauss Model Enabled!")
-            self.model = fm.FitModel(1, 2, [self._centroid, self._centroid])
+        @param all_peak_locs 1d_array of all peak locations or a
+            peakindex.PeakIndex
+        @param criterion  String. "aic" or "bic"
+        @param n_workers  Int. Number of threads used to fit the candidate orders
+        """
+        if hasattr(all_peak_locs, "locs_in"):
+            neighbors = all_peak_locs.locs_in(self.lbound, self.ubound)
+        else:
+            all_peak_locs = np.asarray(all_peak_locs, dtype=float).ravel()
+            is_neighbor_mask = (all_peak_locs > self.lbound) & (all_peak_locs < self.ubound)
+            neighbors = all_peak_locs[is_neighbor_mask]
+        # this peak first, then neighbors ordered by distance to it
+        neighbors = neighbors[np.abs(neighbors - self._centroid) > 1e-6]
+        neighbors = neighbors[np.argsort(np.abs(neighbors - self._centroid))]
+        centers = [self._centroid] + list(neighbors)
+        min_order = 1 if self.enabled_peak_models["gauss"] else 2
+        max_order = min(len(centers), self.max_multiplet_order) \
+            if self.enabled_peak_models["dblgauss"] else 1
+        max_order = max(min_order, max_order)
+        if max_order == 1:
+            self.model = self.build_model(1, [self._centroid])
+            self.model.seed(self.roi_data[:, 0], self.roi_data[:, 1], continuum=self.roi_continuum)
+            return
+        print("Multiplet Models Enabled! Orders: %d - %d" % (min_order, max_order))
+        self.select_model(centers, range(min_order, max_order + 1), criterion, n_workers)
+
+    @staticmethod
+    def curve_fit(model, x, y, p0, sigma, bounded=False, **kwargs):
+        """!
+        @brief Local non-linear least squares fit of model over its free
+        parameters (tied peak widths are not varied).
+        @param model  FitModel
+        @param p0  np_array of initial full model params
+        @param sigma  np_array of data std. deviations
+        @param bounded  Bool. Respect the model parameter bounds
+        @return (popt, pcov) of the full model params
+        """
+        free_p0 = model.reduce(p0)
+        if bounded:
+            lower, upper = model.free_bounds()
+            kwargs["bounds"] = (lower, upper)
+            free_p0 = np.clip(free_p0, lower + 1e-9, upper - 1e-9)
+        free_popt, free_pcov = curve_fit(model.opti_eval_free, x, y, p0=free_p0, sigma=sigma,
+                                         absolute_sigma=True, jac=model.opti_jac_free, **kwargs)
+        return model.expand(free_popt), model.expand_cov(free_pcov, free_popt)
+
+    @staticmethod
+    def odr(model, x, y, p0, sigma, sx, maxit=200, **kwargs):
+        """!
+        @brief Orthogonal distance regression fit of model, for data with
+        uncertain energies.  The analytic jacobians of the composed model
+        are passed to ODRPACK; tied params are held fixed by ifixb and
+        recomputed from their sources.
+        @param model  FitModel
+        @param p0  np_array of initial full model params
+        @param sigma  np_array of data std. deviations
+        @param sx  np_array of energy std. deviations
+        @return (popt, pcov, scipy.odr.Output) of the full model params
+        """
+        odr_model = Model(lambda beta, x: model.batch_eval(model.apply_ties(beta), x),
+                          fjacb=lambda beta, x: model.fold_ties(
+                              model.batch_jac(model.apply_ties(beta), x), beta).T,
+                          fjacd=lambda beta, x: model.batch_deriv(model.apply_ties(beta), x))
+        fitter = ODR(RealData(x, y, sx=sx, sy=sigma), odr_model, beta0=model.apply_ties(p0),
+                     ifixb=model.ifixb, maxit=maxit, **kwargs)
+        # analytic derivatives, not checked by ODRPACK
+        fitter.set_job(deriv=3)
+        output = fitter.run()
+        # last digit of info is the stopping condition, 1 - 3 is convergence
+        if output.info % 10 > 3:
+            raise RuntimeError("ODR failed: %s" % ", ".join(output.stopreason))
+        free_idxs = model.free_idxs
+        free_popt = output.beta[free_idxs]
+        free_pcov = output.cov_beta[np.ix_(free_idxs, free_idxs)]
+        return model.expand(free_popt), model.expand_cov(free_pcov, free_popt), output
+
+    def energy_sigma(self):
+        """!
+        @brief Std. deviation of the ROI channel energies.  Defaults to
+        that of a uniform distribution over each channel.
+        """
+        if self.x_sigma is not None:
+            return np.broadcast_to(self.x_sigma, self.bin_widths.shape)
+        return self.bin_widths / np.sqrt(12.)
+
+    def set_resolution(self, res_cal):
+        """!
+        @brief Constrained fitting mode.  Peak widths are tied to the
+        detector resolution curve instead of being fit independently.
+        @param res_cal  calibration.ResolutionCalibration or None to free the widths
+        """
+        self.res_cal = res_cal
+        centers = self._sub_model_centers()
+        self.model = self.build_model(len(centers), centers)
+
+    def _multiplet_centers(self, centers, n_peaks):
+        """!
+        @brief Initial centers for an n_peaks model.  Unknown components
+        are seeded on alternating sides of the centroid, spaced by one
+        nominal FWHM, rather than on top of each other.
+        """
+        centers = list(centers[:n_peaks])
+        offset = 2.35 * self.model.peak_sigmas()[0] if self.model.peak_sigmas() else 2.35
+        k = 1
+        while len(centers) < n_peaks:
+            centers.append(self._centroid + offset * ((k + 1) // 2) * (-1) ** k)
+            k += 1
+        return centers
+
+    def _fit_candidate(self, centers, n_peaks):
+        """!
+        @brief Local (non global) least squares fit of a candidate
+        multiplet order.  Safe to run concurrently for different orders.
+        @return (model, fit summary dict)
+        """
+        x = self.roi_data[:, 0]
+        y = self.roi_data[:, 1]
+        sigma = self.data_sigma()
+        model = self.build_model(n_peaks, self._multiplet_centers(centers, n_peaks))
+        p0 = model.seed(x, y, continuum=self.roi_continuum)
+        n_free = len(model.free_idxs)
+        info = {"n_peaks": n_peaks, "n_params": n_free, "success": True}
+        try:
+            popt, pcov = self.curve_fit(model, x, y, p0, sigma, bounded=True,
+                                        max_nfev=200 * n_free)
+        except (RuntimeError, ValueError, np.linalg.LinAlgError):
+            popt, info["success"] = p0, False
+        model.set_params(popt)
+        chi2 = np.sum(((model.eval(x) - y) / sigma) ** 2.)
+        info["chi2"] = chi2
+        info["aic"] = chi2 + 2. * n_free
+        info["bic"] = chi2 + n_free * np.log(len(x))
+        return model, info
+
+    def select_model(self, centers, orders, criterion="bic", n_workers=None, ic_tol=2.):
+        """!
+        @brief Multiplet model order selection.
+        All candidate orders are fit concurrently with a cheap local
+        solver.  The lowest order whose information criterion is within
+        ic_tol of the best one is kept (seeded with its local optimum), so
+        the expensive global search in fit_new runs for one order only.
+        @param centers  list of known peak locations, this peak first
+        @param orders  iterable of candidate numbers of peaks
+        @param criterion  String. "aic" or "bic"
+        @param n_workers  Int. Number of threads
+        @param ic_tol  Float. Information criterion tolerance
+        """
+        orders = list(orders)
+        results = parallel.parallel_map(lambda n: self._fit_candidate(centers, n),
+                                        orders, n_workers=n_workers)
+        ics = np.array([info[criterion] if info["success"] else np.inf
+                        for _, info in results])
+        if not np.any(np.isfinite(ics)):
+            chosen = 0
         else:
-            self.model = fm.FitModel(1, 1, [self._centroid])
+            chosen = int(np.flatnonzero(ics <= np.min(ics) + ic_tol)[0])
+        self.model_selection = [info for _, info in results]
+        for info in self.model_selection:
+            print("N peaks: %d, %s: %f, converged: %s" % (info["n_peaks"], criterion.upper(),
+                                                        info[criterion], info["success"]))
+        print("Selected %d peak model" % orders[chosen])
+        self.model = results[chosen][0]
+        return self.model
+
+    def _model_layout(self, model):
+        return [(name, sub_model["model"].default_name, len(sub_model["idxs"]))
+                for name, sub_model in iteritems(model.model_bank)]
+
+    def warm_start_params(self, model=None):
+        """!
+        @brief Starting point for model taken from the last converged fit.
+        If the model layout is unchanged the last parameters are reused
+        as is.  Otherwise background params and the params of peaks lying
+        close to a previously fitted peak are carried over, and the widths
+        of the remaining peaks come from the detector shape calibration.
+        @return np_array of params, or None if there is no previous fit.
+        """
+        model = self.model if model is None else model
+        if self.fit_state is None:
+            return None
+        old_params = self.fit_state["params"]
+        if self.fit_state["layout"] == self._model_layout(model):
+            return np.array(old_params, dtype=float)
+        params = self.seed_shapes(model)
+        old_model = self.fit_state["model"]
+        old_bg = dict((sub_model["model"].default_name, old_params[sub_model["idxs"]])
+                      for _, sub_model in old_model.bg_models())
+        for _, sub_model in model.bg_models():
+            kind = sub_model["model"].default_name
+            if kind in old_bg:
+                params[sub_model["idxs"]] = old_bg[kind]
+        old_peaks = [(sub_model["model"].default_name, old_params[sub_model["idxs"]])
+                     for _, sub_model in old_model.peak_models()]
+        for _, sub_model in model.peak_models():
+            idxs = sub_model["idxs"]
+            kind = sub_model["model"].default_name
+            for old_kind, old_peak in old_peaks:
+                if old_kind == kind and abs(old_peak[1] - params[idxs[1]]) < 2. * abs(old_peak[2]):
+                    params[idxs] = old_peak
+                    break
+        return params
+
+    def seed_shapes(self, model=None):
+        """!
+        @brief Seed peak widths and extra shape params of model from the
+        detector shape calibration.
+        @return np_array of params
+        """
+        model = self.model if model is None else model
+        params = np.array(model.model_params, dtype=float)
+        if self.shape_cal is None or self.shape_cal.n_points == 0:
+            return params
+        for mean_idx, sigma_idx in model.peak_components():
+            params[sigma_idx] = self.shape_cal.sigma(params[mean_idx], params[sigma_idx])
+        for _, sub_model in model.peak_models():
+            idxs = sub_model["idxs"]
+            shape_params = self.shape_cal.shape_params(sub_model["model"].default_name)
+            if shape_params is not None and len(sub_model["model"].peak_components) == 1 and \
+                    len(idxs) > 3:
+                params[idxs[3:]] = shape_params
+        params = model.apply_ties(params)
+        model.model_params = params
+        return params
+
+    @property
+    def last_fit(self):
+        """!
+        @brief (params, covariance) of the last converged fit or (None, None)
+        """
+        if self.fit_state is None:
+            return None, None
+        return self.fit_state["params"], self.fit_state["cov"]
+
+    def seed_from(self, other):
+        """!
+        @brief Use the last converged fit of another Roi (e.g. the same peak
+        in a previous count from the same detector) as the warm start.
+        """
+        self.fit_state = other.fit_state
 
-    def fit_new(self, temperature=1., stepsize=0.3, maxiter=100):
+    def r_squared(self, y_hat=None):
+        """!
+        @brief R^2 of the current model on the ROI data
+        """
+        y = self.roi_data[:, 1]
+        y_hat = self.model.eval(self.roi_data[:, 0]) if y_hat is None else y_hat
+        ss_tot = np.sum((y - np.mean(y)) ** 2.)
+        ss_res = np.sum((y_hat - y) ** 2.)
+        return 1. - ss_res / ss_tot
+
+    def _store_fit_state(self, r2=None):
+        self.fit_state = {"params": np.array(self.popt, dtype=float),
+                          "cov": np.array(self.pcov, dtype=float),
+                          "layout": self._model_layout(self.model),
+                          "model": self.model}
+        if self.shape_cal is not None:
+            # only well fitted, unpinned widths teach the calibration
+            self.shape_cal.add_fit(self.model, self.pcov, self.r_squared() if r2 is None else r2)
+
+    def fit_new(self, temperature=1., stepsize=0.3, maxiter=100, warm_start=True, method=None,
+                cancel=None, global_method=None, n_starts=64, top_k=4, random_state=0):
         """!
         @brief Fits bg and peak model simultaneously using
-        non-lin least squars.
+        non-lin least squars or Poisson maximum likelihood.
+        If a previous fit converged (see warm_start_params) a local fit
+        from its params is tried first and the global search only runs if
+        that fails.
+        @param warm_start  Bool. Start from the last converged fit
+        @param method  String. "lsq", "poisson" or "auto" (see resolve_fit_method)
+        @param cancel  threading.Event.  When set the global search is stopped
+            and FitCancelled is raised.
+        @param global_method  String. "basinhopping" or "multistart"
+            (see multistart_fit).  Defaults to self.global_method
+        @param n_starts  Int. Number of multistart starting points
+        @param top_k  Int. Number of multistart local refinements
+        @param random_state  Int. Seed of the multistart starting points
         """
         msg = "============FIT NEW PEAK=============\n "
         x = self.roi_data[:, 0]
         y = self.roi_data[:, 1]
-        def hop_model(params):
-            return np.sum((self.model.opti_eval(x, *params) - y) ** 2.)
+        method = self.resolve_fit_method(method)
+        msg += "Fit method: %s \n " % method
+        if method == "poisson":
+            hop_model = poisson.CashObjective(self.model, x, self.roi_counts, self.bin_widths)
+            lower, upper = self.model.free_bounds()
+            minimizer_kwargs = {"method": poisson.newton_method,
+                                "bounds": list(zip(np.where(np.isfinite(lower), lower, None),
+                                                   np.where(np.isfinite(upper), upper, None)))}
+        else:
+            def hop_model(params):
+                return np.sum((self.model.opti_eval_free(x, *params) - y) ** 2.)
+            minimizer_kwargs = {"method": "L-BFGS-B"}
+        warm_params = self.warm_start_params() if warm_start else None
+        if warm_params is None:
+            self.seed_shapes()
+        converged = False
         try:
-            bhop_res = basinhopping(hop_model, x0=np.array(self.model.model_params),
-                                    stepsize=stepsize, T=temperature,
-                                    minimizer_kwargs={"method": "L-BFGS-B"},
-                                    niter=maxiter,
-                                    interval=20, disp=True)
-            print("Basin hop optimal params guess: %s" % str(bhop_res.x))
-            self.popt, self.pcov = curve_fit(self.model.opti_eval, x, y, p0=bhop_res.x, sigma=np.sqrt(y), absolute_sigma=True)
+            if warm_params is not None:
+                try:
+                    self.popt, self.pcov, _ = self.local_fit(warm_params, method)
+                    converged = np.all(np.isfinite(self.pcov))
+                except (RuntimeError, ValueError, np.linalg.LinAlgError):
+                    converged = False
+                if converged:
+                    print("Warm started local fit converged")
+                    msg += "Warm started from previous fit \n "
+            global_method = self.global_method if global_method is None else global_method
+            if not converged and global_method == "multistart":
+                self.popt, self.pcov = self.multistart_fit(method, n_starts, top_k, random_state,
+                                                           cancel=cancel)
+                msg += "Multistart global search \n "
+            elif not converged:
+                bhop_res = basinhopping(hop_model, x0=self.model.reduce(self.model.model_params),
+                                        stepsize=stepsize, T=temperature,
+                                        minimizer_kwargs=minimizer_kwargs,
+                                        niter=maxiter,
+                                        interval=20, disp=False,
+                                        callback=lambda *args: cancel is not None and
+                                        cancel.is_set())
+                if cancel is not None and cancel.is_set():
+                    raise FitCancelled()
+                print("Basin hop optimal params guess: %s" % str(bhop_res.x))
+                self.popt, self.pcov, _ = self.local_fit(self.model.expand(bhop_res.x), method)
+            converged = np.all(np.isfinite(self.pcov))
+        except FitCancelled:
+            print("Fit cancelled")
+            raise
         except:
             print("Fit failed")
             msg += "FIT FAILED. ADJUST PEAK LOCATION MARKER \n"
             self.popt = self.model.model_params
             self.pcov = np.eye(len(self.popt))
+            converged = False
         self.perr = np.sqrt(np.diag(self.pcov))
         self.model.set_params(self.popt)
+        self.y_hat = self.model.eval(x)
+        r_sqrd = self.r_squared(self.y_hat)
+        self.r_sqrd = r_sqrd
+        if converged:
+            self._store_fit_state(r_sqrd)
         msg += "Optimal coeffs: \n "
         msg += str(self.popt); msg += "\n "
         msg += "Coeff covar matrix: \n "
         msg += str(self.pcov); msg += "\n "
-        self.y_hat = self.model.eval(x)
-        ss_tot = np.sum((self.y_hat - np.mean(y)) ** 2.)
-        ss_res = np.sum((self.y_hat - y) ** 2.)
-        r_sqrd = 1. - ss_res / ss_tot
         msg += "R^2 = %f\n" % r_sqrd
         msg += "==================================== \n "
         msg += self.net_area_new()
@@ -182,6 +774,70 @@ class Roi(object):
         msg += self.print_peak_sigmas()
         return msg
 
+    def multistart_fit(self, method=None, n_starts=64, top_k=4, random_state=0, sampling="lhs",
+                       n_workers=None, cancel=None):
+        """!
+        @brief Global fit by multistart.multistart: n_starts peak param
+        sets (means inside the ROI, heights up to the data range, widths
+        within a factor 2 of the current ones; bg params at their seed) are
+        scored in one vectorized objective call and the top_k best are
+        refined by concurrent bounded local fits.  Deterministic for a
+        given random_state.
+        @param method  String. "lsq" or "poisson"
+        @param sampling  String. "lhs" or "sobol"
+        @return (popt, pcov) of the full model params
+        """
+        x = self.roi_data[:, 0]
+        y = self.roi_data[:, 1]
+        method = self.resolve_fit_method(method)
+        if method == "poisson":
+            objective = poisson.CashObjective(self.model, x, self.roi_counts, self.bin_widths).value
+        else:
+            sigma = self.data_sigma()
+
+            def objective(free_params):
+                return np.sum(((self.model.opti_eval_free(x, free_params) - y) / sigma) ** 2.,
+                              axis=-1)
+
+        def local(start):
+            if cancel is not None and cancel.is_set():
+                raise FitCancelled()
+            if method == "lsq":
+                popt, pcov = self.curve_fit(self.model, x, y, self.model.expand(start), sigma,
+                                            bounded=True)
+            else:
+                popt, pcov, _ = self.local_fit(self.model.expand(start), method)
+            free_popt = self.model.reduce(popt)
+            return (free_popt, objective(free_popt[np.newaxis])[0],
+                    np.all(np.isfinite(pcov)), popt, pcov)
+        lower, upper = self.model.free_bounds()
+        x0 = self.model.model_params
+        lo, hi = multistart.search_box(x0, *np.array(self.model.model_params_bounds, dtype=float))
+        for model_name, sub_model in iteritems(self.model.model_bank):
+            idxs, model = np.asarray(sub_model["idxs"]), sub_model["model"]
+            if model.model_type != "peak":
+                # bg params stay at their seed, the local fits free them
+                lo[idxs], hi[idxs] = x0[idxs], x0[idxs]
+                continue
+            # peaks anywhere in the ROI, up to the ROI data range high
+            if model.shift_idx is not None:
+                lo[idxs[model.shift_idx]], hi[idxs[model.shift_idx]] = self.lbound, self.ubound
+            for i in idxs[list(model.height_idxs)]:
+                lo[i], hi[i] = 0., 1.2 * (np.max(y) - np.min(y))
+            for i in idxs[list(model.width_idxs)]:
+                lo[i], hi[i] = 0.5 * x0[i], 2. * x0[i]
+        lo, hi = self.model.reduce(lo), self.model.reduce(hi)
+        box = (np.clip(lo, lower, upper), np.clip(hi, lower, upper))
+        res = multistart.multistart(objective, local, self.model.reduce(x0), lower, upper,
+                                    n_starts, top_k, sampling, random_state, box=box,
+                                    n_workers=n_workers)
+        if cancel is not None and cancel.is_set():
+            raise FitCancelled()
+        if res.best is None:
+            raise RuntimeError("All multistart local fits failed")
+        print("Multistart: best of %d starts, objective = %f" % (len(res.starts), res.fun))
+        return res.refined[res.best][3], res.refined[res.best][4]
+
     def net_area_new(self):
         """!
         @brief Computes all peak areas and uncertainties.
@@ -262,40 +918,146 @@ class Roi(object):
         """
         pass
 
-    def odr_fit(self):
+    def odr_fit(self, warm_start=True):
         """!
         @brief Fit model via orthogonal dist regression.
-        Simulataneously fits background and peak
+        Simulataneously fits background and peak.  Use
+        fit_new(method="odr") to add the global search.
         """
-        self.set_odr_peak_model()
+        self.set_odr_peak_model(warm_start)
         # 1SD uncert in fitted params = self.fit_output.sd_beta
         # fitted func values at input x = self.fit_output.y
-        self.fit_output = self.odr_model.run()
+        self.popt, self.pcov, self.fit_output = self.odr(self.model, self.roi_data[:, 0],
+                                                         self.roi_data[:, 1], self.odr_p0,
+                                                         self.data_sigma(), self.energy_sigma())
+        self.perr = np.sqrt(np.diag(self.pcov))
+        self.model.set_params(self.popt)
         print("================================")
-        print(self.fit_output.pprint())
+        self.fit_output.pprint()
         print("================================")
-        self.y_hat = self.tot_model(self.fit_output.beta, self.roi_data[:, 0])
+        self.y_hat = self.model.eval(self.roi_data[:, 0])
+        if np.all(np.isfinite(self.pcov)):
+            self._store_fit_state()
+        return self.net_area_new()
 
-    def set_odr_peak_model(self):
+    def set_odr_peak_model(self, warm_start=True):
         """!
-        @brief Set ODR model
+        @brief Set ODR initial params, taken from the last converged fit
+        if available.
         """
-        x = self.roi_data[:, 0]
-        y = self.roi_data[:, 1]
-        data = Data(x, y)
-        #
-        bgn = len(self.bg_model.params)
-        self.tot_model = lambda p, X: self.bg_model.eval(p[:bgn], X) + self.peak_model.eval(p[bgn:], X)
-        #self.tot_model = lambda p, X: self.bg_model.eval(p[:bgn], X)
+        p0 = self.warm_start_params() if warm_start else None
+        if p0 is None:
+            p0 = self.model.model_params
         print("Initial Model Params")
-        print(self._init_params)
-        self.odr_model = ODR(data, Model(self.tot_model), beta0=self._init_params, ifixb=[1, 1, 1, 0, 1], maxit=800, taufac=0.8)
+        print(p0)
+        self.odr_p0 = np.array(p0, dtype=float)
 
-    def fit_mcmc(self):
+    def benchmark_backends(self, methods=("lsq", "poisson", "odr"), repeat=3, p0=None):
         """!
-        @brief Fit peak by marcov chain monte carlo
+        @brief Compare the cost and results of the local fit backends,
+        all started from the same params.  The stored fit is not changed.
+        @param p0  np_array of initial full model params.  Defaults to the
+            warm start params or the current model params.
+        @return dict of method -> {"time": best wall time (s), "popt",
+            "perr", "net_area", "net_area_uncert", "chi2": reduced chi^2}
         """
-        pass
+        if p0 is None:
+            p0 = self.warm_start_params()
+        if p0 is None:
+            p0 = self.model.model_params
+        x, y = self.roi_data[:, 0], self.roi_data[:, 1]
+        sigma = self.data_sigma()
+        dof = max(len(x) - len(self.model.free_idxs), 1)
+        results = {}
+        for method in methods:
+            times = []
+            try:
+                for i in range(repeat):
+                    t0 = time.time()
+                    popt, pcov, _ = self.local_fit(np.array(p0, dtype=float), method)
+                    times.append(time.time() - t0)
+            except (RuntimeError, ValueError, np.linalg.LinAlgError) as e:
+                print("Backend %s failed: %s" % (method, str(e)))
+                continue
+            area_jac = np.zeros(len(popt))
+            net_area = 0.
+            for model_name, model in self.model.peak_models():
+                idxs = model["idxs"]
+                net_area += model["model"].area(popt[idxs])
+                area_jac[idxs] += model["model"].area_jac(popt[idxs])
+            results[method] = {"time": min(times),
+                               "popt": popt,
+                               "perr": np.sqrt(np.abs(np.diag(pcov))),
+                               "net_area": net_area,
+                               "net_area_uncert": np.sqrt(np.dot(area_jac, np.dot(pcov, area_jac))),
+                               "chi2": np.sum(((self.model.opti_eval(x, popt) - y) / sigma) ** 2.) /
+                               dof}
+            print("%8s: %8.3f ms, net area = %f +/- %f, chi2/dof = %f" %
+                  (method, 1e3 * results[method]["time"], net_area,
+                   results[method]["net_area_uncert"], results[method]["chi2"]))
+        return results
+
+    def fit_mcmc(self, n_steps=2500, burn=500, thin=1, n_walkers=None, a=2.,
+                 random_state=None, cancel=None):
+        """!
+        @brief Fit peak by marcov chain monte carlo.
+        Samples the posterior of the free model params given Poisson
+        distributed counts, with the walkers started around the best fit
+        (fit_new is run first if there is no converged fit).  Gives
+        posterior samples of the peak areas instead of the linearized
+        covariance estimate.
+        @param n_steps  Int. Number of ensemble steps, including burn in
+        @param burn  Int. Number of burn in steps discarded
+        @param thin  Int. Keep every thin-th step
+        @param n_walkers  Int. Number of walkers (default: 4 * n_free params)
+        @param random_state  Int seed or np.random.RandomState
+        @param cancel  threading.Event.  When set FitCancelled is raised.
+        @return String report
+        """
+        msg = "============FIT MCMC=============\n "
+        if self.fit_state is None:
+            msg += self.fit_new(cancel=cancel)
+        free_idxs = self.model.free_idxs
+        center = self.model.reduce(self.popt)
+        cov = np.asarray(self.pcov)[np.ix_(free_idxs, free_idxs)]
+        n_dim = len(center)
+        n_walkers = n_walkers or max(4 * n_dim, 16)
+        n_walkers += n_walkers % 2
+        posterior = mcmc.PoissonPosterior(self.model, self.roi_data[:, 0], self.roi_counts,
+                                          self.bin_widths)
+        sampler = mcmc.EnsembleSampler(posterior, n_walkers, n_dim, a=a, random_state=random_state)
+        lower, upper = self.model.free_bounds()
+        p0 = mcmc.init_walkers(center, cov, n_walkers, lower, upper, sampler.rng, scale=0.1)
+        chain = sampler.run(p0, n_steps, burn=burn, thin=thin,
+                            callback=lambda step: cancel is not None and cancel.is_set())
+        if cancel is not None and cancel.is_set():
+            raise FitCancelled()
+        samples = self.model.expand(sampler.flat_samples())
+        area_samples = np.array([sub_model["model"].area(samples[:, sub_model["idxs"]])
+                                 for _, sub_model in self.model.peak_models()]).T
+        tau = mcmc.autocorr_time(chain) * thin
+        self.mcmc = {"samples": samples,
+                     "log_prob": sampler.log_prob_chain.ravel(),
+                     "area_samples": area_samples,
+                     "acceptance": np.mean(sampler.acceptance_fraction),
+                     "tau": tau,
+                     "r_hat": mcmc.gelman_rubin(chain),
+                     "n_eff": len(samples) * thin / np.max(tau)}
+        net_area_samples = np.sum(area_samples, axis=1)
+        lo, med, hi = np.percentile(net_area_samples, [15.87, 50., 84.13])
+        self.net_peak_area_mcmc = med
+        self.net_peak_area_mcmc_interval = (lo, hi)
+        peak_lo, peak_med, peak_hi = np.percentile(area_samples, [15.87, 50., 84.13], axis=0)
+        msg += "Walkers: %d, Steps: %d (burn in %d) \n" % (n_walkers, sampler.n_steps, burn)
+        msg += "Acceptance fraction: %f \n" % self.mcmc["acceptance"]
+        msg += "Autocorr. time: %s (steps) \n" % str(tau)
+        msg += "R-hat: %s \n" % str(self.mcmc["r_hat"])
+        if sampler.n_steps - burn < 50 * np.max(tau):
+            msg += "WARNING: chain shorter than 50 autocorr. times \n"
+        msg += "Net Area (posterior median) = %f (+%f / -%f)\n" % (med, hi - med, med - lo)
+        msg += "Peak Areas (posterior median): %s\n" % str(peak_med)
+        msg += "Peak Area 68%% intervals: %s\n" % str(np.array([peak_lo, peak_hi]).T)
+        return msg
 
     @property
     def centroid(self):
@@ -304,6 +1066,45 @@ class Roi(object):
         """
         return self._centroid
 
+
+def _fit_roi(args):
+    roi, fit_kwargs = args
+    state = roi.fit_state
+    try:
+        roi.fit_new(**fit_kwargs)
+    except (RuntimeError, ValueError, np.linalg.LinAlgError) as e:
+        print("Fit of peak at %f keV failed: %s" % (roi.centroid, str(e)))
+    # a new fit state means the fit converged and its widths were recorded
+    return roi, roi.fit_state is not state
+
+
+def fit_rois(rois, n_workers=None, backend="process", store=None, **fit_kwargs):
+    """!
+    @brief Run Roi.fit_new for several ROIs concurrently.
+    With the process backend and a shared memory store the tasks and
+    results only carry handles of the spectrum (see Roi.share), the
+    returned rois are copies attached to the shared arrays.  Copies fit in
+    other processes get the shape calibration of their original back, and
+    the widths they learned are recorded in it.
+    @param rois  List of Roi instances
+    @param store  sharedspec.SharedSpectrumStore or None to pickle the data
+    @param fit_kwargs  Keyword args of Roi.fit_new
+    @return List of fitted rois, same order as rois
+    """
+    if store is not None and backend == "process":
+        for roi in rois:
+            roi.share(store)
+    results = parallel.parallel_map(_fit_roi, [(roi, fit_kwargs) for roi in rois],
+                                    n_workers, backend)
+    fitted = []
+    for orig, (roi, refit) in zip(rois, results):
+        if roi is not orig:
+            roi.shape_cal = orig.shape_cal
+            if refit and roi.shape_cal is not None:
+                roi.shape_cal.add_fit(roi.model, roi.pcov, roi.r_sqrd)
+        fitted.append(roi)
+    return fitted
+
 if __name__ == "__main__":
     import gammaspy.gammaData.reader as rd
     reader = rd.DataReader()
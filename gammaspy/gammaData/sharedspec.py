@@ -0,0 +1,143 @@
+"""!
+@brief Module sharedspec
+Spectra in shared memory for process pool workers.  The parent puts the
+arrays in a SharedSpectrumStore and ships only SharedArray descriptors
+(name, shape, dtype); workers attach by name once and use NumPy views, so
+neither the task arguments nor the results copy the full spectrum.
+"""
+from __future__ import division
+import collections
+import weakref
+import numpy as np
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+## Picklable handle of an array in shared memory
+SharedArray = collections.namedtuple("SharedArray", ["name", "shape", "dtype"])
+
+# segments mapped by this process: name -> (SharedMemory, np_array view)
+_attached = {}
+
+
+def _open(name, create=False, size=0):
+    if shared_memory is None:
+        raise RuntimeError("multiprocessing.shared_memory requires python >= 3.8")
+    try:
+        # attaching processes must not unlink the segment at exit (3.13+)
+        return shared_memory.SharedMemory(name=name, create=create, size=size, track=create)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name, create=create, size=size)
+
+
+def _release(shm):
+    try:
+        shm.close()
+    except BufferError:
+        # views are still alive, the mapping goes away with them
+        pass
+
+
+def _unlink_segments(segments):
+    for name, shm in segments.items():
+        _attached.pop(name, None)
+        _release(shm)
+        try:
+            shm.unlink()
+        except (OSError, IOError):
+            pass
+    segments.clear()
+
+
+def attach(handle):
+    """!
+    @brief Read only view of a shared array.  The segment is mapped once
+    per process and kept until detach.
+    @param handle  SharedArray
+    @return np_array
+    """
+    if handle.name not in _attached:
+        shm = _open(handle.name)
+        arr = np.ndarray(handle.shape, dtype=np.dtype(handle.dtype), buffer=shm.buf)
+        arr.flags.writeable = False
+        _attached[handle.name] = (shm, arr)
+    return _attached[handle.name][1]
+
+
+def detach(name):
+    """!
+    @brief Unmap a segment attached by this process
+    """
+    shm, _ = _attached.pop(name, (None, None))
+    if shm is not None:
+        _release(shm)
+
+
+def detach_all():
+    for name in list(_attached):
+        detach(name)
+
+
+class SharedSpectrumStore(object):
+    """!
+    @brief Owner of shared spectrum arrays.  Segments are unlinked by
+    close(), at the end of a with block, when the store is garbage
+    collected or at interpreter exit.
+    @verbatim
+    with SharedSpectrumStore() as store:
+        handle = store.put(spectrum)
+        results = parallel.parallel_map(task, [(handle, i_lo, i_hi)], backend="process")
+    @endverbatim
+    """
+    def __init__(self):
+        if shared_memory is None:
+            raise RuntimeError("multiprocessing.shared_memory requires python >= 3.8")
+        self._segments = collections.OrderedDict()
+        self._by_id = {}
+        self._finalizer = weakref.finalize(self, _unlink_segments, self._segments)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self._segments)
+
+    @property
+    def nbytes(self):
+        return sum(shm.size for shm in self._segments.values())
+
+    def put(self, arr):
+        """!
+        @brief Copy an array into a new shared segment.  Putting the same
+        array object again returns the existing handle.
+        @return SharedArray
+        """
+        key = id(arr)
+        if key in self._by_id and self._by_id[key][0] is arr:
+            return self._by_id[key][1]
+        src = np.ascontiguousarray(arr)
+        shm = _open(None, create=True, size=max(src.nbytes, 1))
+        view = np.ndarray(src.shape, dtype=src.dtype, buffer=shm.buf)
+        view[...] = src
+        view.flags.writeable = False
+        handle = SharedArray(shm.name, src.shape, src.dtype.str)
+        self._segments[shm.name] = shm
+        # the owner attaches to its own segments without a second mapping
+        _attached[shm.name] = (shm, view)
+        self._by_id[key] = (arr, handle)
+        return handle
+
+    def get(self, handle):
+        return attach(handle)
+
+    def close(self):
+        """!
+        @brief Unmap and unlink all segments.  Views into them must not be
+        used afterwards.
+        """
+        _unlink_segments(self._segments)
+        self._by_id.clear()
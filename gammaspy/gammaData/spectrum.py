@@ -4,25 +4,216 @@ find all peaks in spectrum
 """
 import gammaspy.gammaData.peak as pk
 import gammaspy.gammaData.roi as roi
+import gammaspy.gammaData.calibration as calibration
+import gammaspy.gammaData.continuum as cont
+import gammaspy.gammaData.mcmc as mcmc
+import gammaspy.gammaData.peakindex as peakindex
+import gammaspy.gammaData.sharedspec as sharedspec
+import gammaspy.gammaData.triage as ptriage
+import gammaspy.gammaData.unmix as unmix
 import numpy as np
 from scipy.signal import find_peaks_cwt
 from six import iteritems
 
+PEAK_TABLE_DTYPE = [('peak_id', 'i8'), ('loc', 'f8'), ('mean', 'f8'), ('mean_err', 'f8'),
+                    ('sigma', 'f8'), ('sigma_err', 'f8'), ('area', 'f8'), ('area_err', 'f8'),
+                    ('r2', 'f8')]
+
 
 class GammaSpectrum(object):
-    def __init__(self, spectrum=np.array([]), metadata={}):
-        self.spectrum = spectrum
-        self.metadata = metadata
-        self.peak_bank = {}
+    """!
+    @brief A spectrum and its peaks.
+    The spectrum is stored either densely as an (n, 2) float array of
+    [energy, counts / keV], or compactly as raw uint32 channel counts plus
+    the energy calibration metadata['e_cal'] (pass counts=).  In compact
+    mode self.spectrum is derived on first access and cached; call
+    release_cache() to drop the dense copy again.
+    @param spectrum  np_array (n, 2) of [energy (keV), counts / keV]
+    @param metadata  dict (e_cal, l_time, r_time, ...)
+    @param counts  np_array (n,) of raw channel counts (compact mode)
+    @param shape_cal  calibration.ShapeCalibration.  Defaults to the one of
+        metadata['detector'], or a new one if no detector is given.
+    """
+    def __init__(self, spectrum=np.array([]), metadata=None, shape_cal=None, counts=None):
+        self.metadata = dict(metadata or {})
+        self._counts = None
+        if counts is not None:
+            self.set_counts(counts)
+        else:
+            self.spectrum = spectrum
+        self.peak_bank = peakindex.PeakIndex()
+        # peak shape calibration, shared by all spectra of the same
+        # detector only if metadata names the detector
+        if shape_cal is None:
+            shape_cal = calibration.shape_calibration(self.metadata.get('detector'))
+        self.shape_cal = shape_cal
+        # resolution curve peak widths are tied to (constrained fitting mode)
+        self.res_cal = None
+        # SNIP continuum settings. continuum_bg is "off", "seed" or "fix"
+        # the ROI background params
+        self.continuum_iterations = 20
+        self.continuum_bg = "seed"
+        self._continuum = None
+        # result of the last peak candidate triage
+        self.triage_report = None
+
+    @property
+    def spectrum(self):
+        """!
+        @brief np_array (n, 2) of [energy (keV), counts / keV]
+        """
+        if self._spectrum is None and self._counts is not None:
+            energy = calibration.channel_energy(self.metadata['e_cal'], len(self._counts))
+            widths = np.diff(energy)
+            widths = np.append(widths[:1], widths) if len(widths) else np.ones(len(energy))
+            self._spectrum = np.column_stack((energy, self._counts / widths))
+        return self._spectrum
+
+    @spectrum.setter
+    def spectrum(self, spectrum):
+        # a dense spectrum replaces the compact counts
+        self._spectrum = spectrum
+        self._counts = None
+
+    def set_counts(self, counts, e_cal=None):
+        """!
+        @brief Store raw channel counts (compact mode).
+        @param e_cal  Energy calibration coefficients, defaults to metadata['e_cal']
+        """
+        if e_cal is not None:
+            self.metadata['e_cal'] = list(e_cal)
+        if not len(self.metadata.get('e_cal', [])):
+            raise ValueError("Compact spectra require an energy calibration (e_cal)")
+        self._counts = np.asarray(counts).astype(np.uint32, copy=False)
+        self._spectrum = None
+
+    @property
+    def is_compact(self):
+        return self._counts is not None
+
+    @property
+    def counts(self):
+        """!
+        @brief np_array of counts per channel
+        """
+        if self._counts is not None:
+            return self._counts
+        spec = self.spectrum
+        widths = np.diff(spec[:, 0])
+        widths = np.append(widths[:1], widths) if len(widths) else np.ones(len(spec))
+        return spec[:, 1] * widths
+
+    @property
+    def energy(self):
+        """!
+        @brief np_array of channel energies (keV)
+        """
+        if self._counts is not None and self._spectrum is None:
+            return calibration.channel_energy(self.metadata['e_cal'], len(self._counts))
+        return self.spectrum[:, 0]
+
+    def to_compact(self, tol=1e-3):
+        """!
+        @brief Switch a dense spectrum to compact storage.  The counts must
+        be integers (not e.g. background subtracted) and the energy column
+        a polynomial of the channel number.
+        @param tol  Float. Max deviation of the counts from integers
+        """
+        if self._counts is not None:
+            return
+        counts = self.counts
+        int_counts = np.rint(counts)
+        if np.any(np.abs(counts - int_counts) > tol) or np.any(int_counts < 0):
+            raise ValueError("Spectrum counts are not non-negative integers")
+        e_cal = self.metadata.get('e_cal')
+        order = max(len(e_cal) - 1, 1) if e_cal else 1
+        self.metadata['e_cal'] = calibration.fit_e_cal(self.spectrum[:, 0], order, e_cal)
+        self.set_counts(int_counts)
+
+    def release_cache(self):
+        """!
+        @brief Drop the derived dense spectrum and continuum of a compact
+        spectrum.  Peaks keep their own ROI data.
+        """
+        if self._counts is not None:
+            self._spectrum = None
+            self._continuum = None
+
+    @property
+    def nbytes(self):
+        """!
+        @brief Memory held by the spectrum arrays (bytes)
+        """
+        n = 0 if self._counts is None else self._counts.nbytes
+        return n + (0 if self._spectrum is None else self._spectrum.nbytes)
 
     def add_peak(self, peak_loc, peak_model='gauss', bg_model='linear'):
-        self.peak_bank[peak_loc] = roi.Roi(self.spectrum, peak_loc)
+        """!
+        @brief Add (or replace) the peak at peak_loc.
+        @return Int. Peak id in self.peak_bank
+        """
+        new_peak = roi.Roi(self.spectrum, peak_loc, peak_model, bg_model, shape_cal=self.shape_cal)
+        if self.res_cal is not None:
+            new_peak.set_resolution(self.res_cal)
+        if self.continuum_bg != "off":
+            new_peak.set_continuum(self.continuum(), fix=self.continuum_bg == "fix")
+        peak_id = self.peak_bank.find(peak_loc)
+        if peak_id is None:
+            return self.peak_bank.add(peak_loc, new_peak)
+        self.peak_bank.replace(peak_id, new_peak)
+        return peak_id
+
+    def continuum(self, n_iter=None):
+        """!
+        @brief SNIP continuum of the spectrum (counts / keV).  Computed once
+        and cached until the spectrum or the number of iterations changes.
+        @param n_iter  Int. Max clipping window (channels).  Defaults to
+            self.continuum_iterations
+        """
+        n_iter = self.continuum_iterations if n_iter is None else n_iter
+        if self._continuum is None or self._continuum[0] is not self.spectrum \
+                or self._continuum[1] != n_iter:
+            self._continuum = (self.spectrum, n_iter,
+                               cont.estimate_continuum(self.spectrum, n_iter))
+        return self._continuum[2]
+
+    def set_continuum_bg(self, mode="seed"):
+        """!
+        @brief Use the continuum for the background of all ROIs.
+        @param mode  String. "off", "seed" the bg params from the continuum,
+            or "fix" them at the continuum values.
+        """
+        self.continuum_bg = mode
+        for peak_loc, peak in iteritems(self.peak_bank):
+            if mode == "off":
+                peak.set_continuum(None)
+            else:
+                peak.set_continuum(self.continuum(), fix=mode == "fix")
+
+    def warm_start_from(self, other, tol=1., add_missing=True):
+        """!
+        @brief Use the converged fits of another spectrum (e.g. the previous
+        count from the same detector) as starting points for this one.
+        @param other  GammaSpectrum
+        @param tol  Float. Max distance (keV) between matching peak locations
+        @param add_missing  Bool. Add peaks of other that are not in this spectrum
+        """
+        for other_loc, other_roi in iteritems(other.peak_bank):
+            peak_id, dist = self.peak_bank.nearest(other_loc)
+            if dist >= tol:
+                if not add_missing:
+                    continue
+                peak_id = self.add_peak(other_loc, other_roi.peak_models[0], other_roi.bg_models[0])
+                self.peak_bank.get(peak_id).set_bounds(other_roi.lbound, other_roi.ubound)
+            self.peak_bank.get(peak_id).seed_from(other_roi)
 
     def mod_peak(self, peak_loc, peak_model='gauss', bg_model='linear'):
         """!
         @brief Modify selected peak's background and or peak model
+        @param peak_model  String. Registered peak model name (see peak.peak_models)
+        @param bg_model  String. Registered bg model name (see bg.bg_models)
         """
-        pass
+        self.peak_bank[peak_loc].set_models(peak_model, bg_model)
 
     def pop_peak(self, peak_loc):
         """!
@@ -37,11 +228,13 @@ class GammaSpectrum(object):
         print("-----------------------------------------")
 
     def del_all_peaks(self):
-        self.peak_bank = {}
+        self.peak_bank.clear()
 
     def peak_locs(self):
-        peak_locs = np.array(self.peak_bank.keys())
-        return peak_locs
+        """!
+        @brief Sorted np_array of all peak locations
+        """
+        return self.peak_bank.locs
 
     def find_cwt_peaks(self, **kwargs):
         """!
@@ -54,7 +247,12 @@ class GammaSpectrum(object):
         noise = kwargs.get("noise_perc", 7.)
         mask = (self.spectrum[:, 0] > ei) & (self.spectrum[:, 0] < ef)
         cut = kwargs.pop("cut", 80)  # max number of peaks to retain
-        cwt_peaks_idxs = find_peaks_cwt(self.spectrum[:, 1][mask], widths=widths, min_snr=min_snr, noise_perc=noise)
+        signal = self.spectrum[:, 1]
+        if kwargs.get("detrend", True):
+            # remove the compton continuum so only peaks remain
+            signal = signal - self.continuum()
+        cwt_peaks_idxs = find_peaks_cwt(signal[mask], widths=widths, min_snr=min_snr,
+                                        noise_perc=noise)
         print("N auto Peak Locations = %d" % len(cwt_peaks_idxs))
         print("-----------------------")
         cwt_peaks = self.spectrum[mask][cwt_peaks_idxs, 0]
@@ -64,17 +262,44 @@ class GammaSpectrum(object):
     def find_gradient_peaks(self, **kwargs):
         pass
 
-    def auto_peaks(self, method='cwt', **kwargs):
+    def auto_peaks(self, method='cwt', triage=False, triage_kwargs=None, **kwargs):
         """!
         @brief Auto find all peaks in spectrum.
+        @param triage  Bool. Screen the candidates (see triage_peaks) and
+            only add the accepted ones, most significant first.  Off by
+            default, so every CWT candidate is added (and fit); the CLIs
+            enable it with --triage.
+        @param triage_kwargs  dict of keyword args of triage.triage_peaks
         """
-        for peak_loc in self.find_cwt_peaks(**kwargs):
+        peak_locs = self.find_cwt_peaks(**kwargs)
+        if triage:
+            report = self.triage_peaks(peak_locs, **(triage_kwargs or {}))
+            print(ptriage.format_report(report))
+            peak_locs = report['loc'][report['accept']]
+        for peak_loc in peak_locs:
             self.add_peak(peak_loc)
 
+    def triage_peaks(self, peak_locs, **kwargs):
+        """!
+        @brief Vectorized pre-fit screening of peak candidates: Currie
+        critical level of the net counts, local curvature and width
+        consistency with the resolution curve.
+        @param peak_locs  np_array candidate peak energies
+        @return triage report (triage.TRIAGE_DTYPE), sorted by decreasing
+            significance.  Also kept in self.triage_report.
+        """
+        energy = self.energy
+        widths = np.diff(energy)
+        widths = np.append(widths[:1], widths) if len(widths) else np.ones(len(energy))
+        report = ptriage.triage_peaks(energy, self.counts, self.continuum() * widths,
+                                      peak_locs, self.resolution(), **kwargs)
+        self.triage_report = report[np.argsort(-report['significance'], kind='stable')]
+        return self.triage_report
+
     def auto_roi(self, peak_locs=[]):
         """!
         @brief Attempt auto ROI for all selected peaks.
-        @brief peak_locs  list of peaks to attempt auto ROI estimation
+        @param peak_locs  list of peaks to attempt auto ROI estimation, None for all
         """
         if peak_locs is None:
             peak_locs = self.peak_locs()
@@ -91,6 +316,209 @@ class GammaSpectrum(object):
         except:
             print("Peak fitting failed.")
 
+    def fit_mcmc_peaks(self, peak_locs=None, n_workers=None, backend="process", shared=True,
+                       **kwargs):
+        """!
+        @brief MCMC fit of several peaks, chains of different ROIs run
+        concurrently.  The process backend uses shared memory as fit_peaks.
+        @param peak_locs  list of peaks to fit (default: all)
+        @param backend  String. "process", "thread" or "serial"
+        @param shared  Bool. Use shared memory for the process backend
+        @param kwargs  Keyword args of Roi.fit_mcmc
+        """
+        self._fit_rois(mcmc.fit_mcmc_rois, peak_locs, n_workers, backend, shared, **kwargs)
+
+    def fit_peaks(self, peak_locs=None, n_workers=None, backend="process", shared=True, **kwargs):
+        """!
+        @brief Roi.fit_new of several peaks, ROIs are fit concurrently.
+        With the process backend the spectrum and continuum are put in
+        shared memory once and workers attach to them, so each task ships
+        only the ROI model and a handle.
+        @param peak_locs  list of peaks to fit (default: all)
+        @param backend  String. "process", "thread" or "serial"
+        @param shared  Bool. Use shared memory for the process backend
+        @param kwargs  Keyword args of Roi.fit_new
+        """
+        self._fit_rois(roi.fit_rois, peak_locs, n_workers, backend, shared, **kwargs)
+
+    def _fit_rois(self, fit_fn, peak_locs, n_workers, backend, shared, **kwargs):
+        """!
+        @brief Fit ROIs with fit_fn (roi.fit_rois or mcmc.fit_mcmc_rois) and
+        put the fitted ROIs in the peak bank.
+        """
+        if peak_locs is None:
+            peak_ids = self.peak_bank.ids
+        else:
+            peak_ids = [self.peak_bank.find(peak_loc) for peak_loc in peak_locs]
+        rois = [self.peak_bank.get(peak_id) for peak_id in peak_ids]
+        if not (shared and backend == "process"):
+            for peak_id, fitted in zip(peak_ids, fit_fn(rois, n_workers, backend, **kwargs)):
+                self.peak_bank.replace(peak_id, fitted)
+            return
+        with sharedspec.SharedSpectrumStore() as store:
+            results = fit_fn(rois, n_workers, backend, store=store, **kwargs)
+            # back to the private arrays before the shared ones go away
+            for peak_id, orig, fitted in zip(peak_ids, rois, results):
+                fitted.unshare(orig.roi_data_orig, orig.continuum_orig)
+                orig.unshare(orig.roi_data_orig, orig.continuum_orig)
+                self.peak_bank.replace(peak_id, fitted)
+
+    def recalibrate(self, reference_lines, order=1, tol=2., min_lines=2):
+        """!
+        @brief Energy recalibration from fitted peaks.
+        The fitted means of converged ROIs are matched to known reference
+        lines and a polynomial map E' = g(E) is fit to the pairs and
+        applied with apply_energy_map.  Peaks are not refit.
+        @param reference_lines  list of line energies (keV)
+        @param order  Int. Polynomial order of the map
+        @param tol  Float. Max distance of a peak from its reference line (keV)
+        @param min_lines  Int. Min number of matched lines
+        @return calibration.EnergyMap or None
+        """
+        measured, weight = [], []
+        for peak_loc, peak in iteritems(self.peak_bank):
+            if peak.fit_state is None:
+                continue
+            for mean_idx, sigma_idx in peak.model.peak_components():
+                var = peak.pcov[mean_idx, mean_idx]
+                measured.append(peak.popt[mean_idx])
+                weight.append(1. / var if np.isfinite(var) and var > 0. else 1.)
+        m_idxs, r_idxs = calibration.match_lines(measured, reference_lines, tol)
+        print("Energy recalibration using %d matched lines" % len(m_idxs))
+        if len(m_idxs) < min_lines:
+            print("WARNING: too few matched lines for energy recalibration")
+            return None
+        reference = np.sort(np.asarray(reference_lines, dtype=float))[r_idxs]
+        energy_map = calibration.EnergyMap.from_lines(np.array(measured)[m_idxs], reference,
+                                                      order, np.array(weight)[m_idxs])
+        print("E' = %s" % str(energy_map.poly))
+        self.apply_energy_map(energy_map)
+        return energy_map
+
+    def apply_energy_map(self, energy_map):
+        """!
+        @brief Move the spectrum and all ROIs to the energy axis
+        E' = g(E).  Counts per channel are conserved, so densities are
+        divided by g'(E).  New arrays are created, the old spectrum (which
+        may be memory mapped or shared) is never written to.
+        @param energy_map  calibration.EnergyMap
+        """
+        energy = self.energy
+        if not energy_map.is_monotonic(energy):
+            raise ValueError("Energy map is not monotonic over the spectrum")
+        if self._counts is not None:
+            # channel counts are unchanged, only the calibration moves
+            self.metadata['e_cal'] = energy_map.compose_e_cal(self.metadata['e_cal'])
+            self._spectrum = None
+        else:
+            self.spectrum = np.column_stack((energy_map(energy),
+                                             self.spectrum[:, 1] / energy_map.deriv(energy)))
+            if 'e_cal' in self.metadata:
+                self.metadata['e_cal'] = energy_map.compose_e_cal(self.metadata['e_cal'])
+        for peak_loc, peak in iteritems(self.peak_bank):
+            peak.remap_energy(energy_map, self.spectrum)
+            if self.continuum_bg != "off":
+                peak.set_continuum(self.continuum(), fix=self.continuum_bg == "fix")
+        # peak ids are kept, locations move in one vectorized call
+        self.peak_bank.remap(energy_map)
+
+    def calibrate_resolution(self, min_r2=0.95, max_rel_err=0.2, min_peaks=2, constrain=True):
+        """!
+        @brief Fit the detector resolution curve FWHM(E) = sqrt(a + bE + cE^2)
+        to the well fitted singlet peaks in the peak bank.  The coefficients
+        are stored in metadata['fwhm_cal'].
+        @param min_r2  Float. Min R^2 of an ROI fit to be used
+        @param max_rel_err  Float. Max relative 1sigma uncert of the fitted width
+        @param min_peaks  Int. Min number of usable peaks
+        @param constrain  Bool. Tie the widths of all ROIs to the new curve
+        @return calibration.ResolutionCalibration or None
+        """
+        energy, fwhm, weight = [], [], []
+        for peak_loc, peak in iteritems(self.peak_bank):
+            # singlets only, a multigauss sub-model is a multiplet
+            components = peak.model.peak_components()
+            if peak.fit_state is None or len(components) != 1:
+                continue
+            if getattr(peak, "r_sqrd", 0.) < min_r2 or peak.model.tied:
+                continue
+            mean_idx, sigma_idx = components[0]
+            sigma, var = abs(peak.popt[sigma_idx]), peak.pcov[sigma_idx, sigma_idx]
+            if not (var > 0. and np.sqrt(var) < max_rel_err * sigma):
+                continue
+            energy.append(peak.popt[mean_idx])
+            fwhm.append(calibration.FWHM_SD * sigma)
+            weight.append(1. / (calibration.FWHM_SD ** 2 * var))
+        print("Resolution calibration using %d singlet peaks" % len(energy))
+        if len(energy) < min_peaks:
+            print("WARNING: too few well fitted singlets for resolution calibration")
+            return None
+        res_cal = calibration.ResolutionCalibration.from_peaks(energy, fwhm, weight)
+        self.metadata['fwhm_cal'] = list(res_cal.coeffs)
+        print("FWHM(E) = sqrt(%e + %e E + %e E^2)" % tuple(res_cal.coeffs))
+        if constrain:
+            self.constrain_widths(res_cal)
+        return res_cal
+
+    def constrain_widths(self, res_cal=None):
+        """!
+        @brief Tie the peak widths of all ROIs to a resolution curve.
+        @param res_cal  calibration.ResolutionCalibration.  Defaults to the
+            curve stored in metadata['fwhm_cal'].  Use False to free the widths.
+        """
+        if res_cal is None:
+            res_cal = calibration.ResolutionCalibration.from_metadata(self.metadata)
+        self.res_cal = res_cal or None
+        for peak_loc, peak in iteritems(self.peak_bank):
+            peak.set_resolution(self.res_cal)
+
+    def screen_nuclides(self, unmixer=None, **kwargs):
+        """!
+        @brief Quick whole spectrum nuclide screening by NNLS unmixing of
+        line templates (see unmix.TemplateUnmixer.unmix).
+        @param unmixer  unmix.TemplateUnmixer.  Reuse one to keep its
+            template cache across spectra.
+        """
+        if unmixer is None:
+            unmixer = unmix.TemplateUnmixer()
+        return unmixer.unmix(self, **kwargs)
+
+    def resolution(self):
+        """!
+        @brief Best available resolution curve: the constrained width curve,
+        metadata['fwhm_cal'], the learned shape calibration or a typical
+        HPGe curve.  Curves with FWHM^2 <= 0 anywhere on the energy range
+        of the spectrum are skipped.
+        @return calibration.ResolutionCalibration
+        """
+        energy = self.energy
+        e_range = (max(energy[0], 0.), energy[-1]) if len(energy) else (0., 0.)
+        candidates = [self.res_cal, calibration.ResolutionCalibration.from_metadata(self.metadata)]
+        if self.shape_cal is not None and self.shape_cal.n_points >= 3 and \
+                self.shape_cal.fit() is not None:
+            candidates.append(calibration.ResolutionCalibration(self.shape_cal.coeffs))
+        for res_cal in candidates:
+            if res_cal is not None and res_cal.is_physical(*e_range):
+                return res_cal
+        return calibration.ResolutionCalibration(calibration.DEFAULT_FWHM_COEFFS)
+
+    def peak_table(self):
+        """!
+        @brief Fit results of all fitted peaks as a numpy structured array,
+        one row per peak model of each ROI (stored in HDF5 files).
+        """
+        rows = []
+        for peak_id, peak in self.peak_bank.peaks():
+            if getattr(peak, "peak_area_list", None) is None:
+                continue
+            sub_models = list(peak.model.peak_models())
+            for i, (model_name, sub_model) in enumerate(sub_models):
+                mean_idx, sigma_idx = sub_model["idxs"][1], sub_model["idxs"][2]
+                rows.append((peak_id, self.peak_bank.loc(peak_id), peak.popt[mean_idx],
+                             peak.perr[mean_idx], abs(peak.popt[sigma_idx]), peak.perr[sigma_idx],
+                             peak.peak_area_list[i], peak.peak_area_uncert_list[i],
+                             getattr(peak, "r_sqrd", np.nan)))
+        return np.array(rows, dtype=PEAK_TABLE_DTYPE)
+
     def pprint_peak_info(self):
         msg = ""
         for name, peak in iteritems(self.peak_bank):
@@ -0,0 +1,149 @@
+"""!
+@brief Module triage
+Cheap pre-fit screening of peak candidates.  For all candidates at once
+(cumulative sums over the channels, no loops) it computes
+ - the net counts in a +/- 1.25 FWHM window over a flat background
+   (continuum or side bands) and the Currie critical level
+   \f$ L_C = k_\alpha \sqrt{2 B} \f$,
+ - the significance of the local curvature (a peak is concave),
+ - the ratio of the measured width (second moment of the net counts) to
+   the width expected from the resolution curve,
+so that only real peaks are handed to the (expensive) fits.
+"""
+from __future__ import division
+import numpy as np
+import gammaspy.gammaData.calibration as calibration
+
+TRIAGE_DTYPE = [('loc', 'f8'), ('gross', 'f8'), ('background', 'f8'), ('net', 'f8'),
+                ('l_c', 'f8'), ('significance', 'f8'), ('curvature', 'f8'),
+                ('fwhm_expected', 'f8'), ('width_ratio', 'f8'), ('accept', '?'),
+                ('reason', 'U32')]
+
+## Max expected FWHM as a fraction of the energy (NaI is ~7 % at 662 keV)
+MAX_REL_FWHM = 0.5
+
+
+def _window_sums(cum, lo, hi):
+    """!
+    @brief Sums of channels lo..hi-1 from a cumulative sum with leading 0
+    """
+    return cum[hi] - cum[lo]
+
+
+def expected_fwhm(res_cal, locs, bin_width):
+    """!
+    @brief FWHM of the resolution curve at locs.  Values below one channel
+    or above MAX_REL_FWHM of the energy (a bad learned curve) are replaced
+    by the typical HPGe curve, clipped to the same range.
+    """
+    fwhm = np.asarray(res_cal.fwhm(locs), dtype=float)
+    lo, hi = bin_width, np.maximum(MAX_REL_FWHM * np.abs(locs), bin_width)
+    bad = ~np.isfinite(fwhm) | (fwhm < lo) | (fwhm > hi)
+    if np.any(bad):
+        print("WARNING: resolution curve out of range at %d candidates, using %s" %
+              (np.count_nonzero(bad), str(calibration.DEFAULT_FWHM_COEFFS)))
+        default = calibration.ResolutionCalibration(calibration.DEFAULT_FWHM_COEFFS).fwhm(locs)
+        fwhm = np.where(bad, np.clip(default, lo, hi), fwhm)
+    return fwhm
+
+
+def triage_peaks(energy, counts, continuum, locs, res_cal, k_alpha=1.645, min_curvature=3.,
+                 width_range=(0.5, 2.)):
+    """!
+    @brief Screen peak candidates.
+    @param energy  np_array channel energies (keV)
+    @param counts  np_array counts per channel
+    @param continuum  np_array continuum counts per channel
+    @param locs  np_array candidate peak energies
+    @param res_cal  calibration.ResolutionCalibration expected widths
+    @param k_alpha  Float. One sided false positive quantile (1.645: 5 %)
+    @param min_curvature  Float. Min significance of the negative curvature.
+        The candidates are local maxima, so noise passes a 1 sigma cut.
+    @param width_range  (min, max) accepted measured / expected width ratio
+    @return np structured array (TRIAGE_DTYPE), one row per candidate in
+        the order of locs
+    """
+    energy = np.asarray(energy, dtype=float)
+    counts = np.asarray(counts, dtype=float)
+    locs = np.atleast_1d(np.asarray(locs, dtype=float))
+    n = len(energy)
+    zero = np.zeros(1)
+    cum = np.concatenate((zero, np.cumsum(counts)))
+    cum_e = np.concatenate((zero, np.cumsum(counts * energy)))
+    cum_e2 = np.concatenate((zero, np.cumsum(counts * energy ** 2)))
+    cum_x = np.concatenate((zero, np.cumsum(energy)))
+    cum_x2 = np.concatenate((zero, np.cumsum(energy ** 2)))
+
+    center = np.clip(np.searchsorted(energy, locs), 0, n - 1)
+    bin_width = np.abs(np.gradient(energy))[center] if n > 1 else np.ones(len(locs))
+    fwhm = expected_fwhm(res_cal, locs, bin_width)
+
+    # +/- 1.25 FWHM peak window
+    half = np.maximum(np.round(1.25 * fwhm / bin_width).astype(int), 1)
+    lo = np.clip(center - half, 0, n)
+    hi = np.clip(center + half + 1, 0, n)
+    n_peak = hi - lo
+    gross = _window_sums(cum, lo, hi)
+    # flat background per channel: the continuum, or where it is lower
+    # (SNIP is biased low on noisy data) the mean of the quieter of the
+    # two side bands.  Using the quieter band is robust to a neighbour.
+    n_side = np.maximum(half // 2, 1)
+    lo_side, hi_side = np.clip(lo - n_side, 0, n), np.clip(hi + n_side, 0, n)
+    left = _window_sums(cum, lo_side, lo) / np.maximum(lo - lo_side, 1)
+    right = _window_sums(cum, hi, hi_side) / np.maximum(hi_side - hi, 1)
+    side = np.minimum(np.where(lo > 0, left, right), np.where(hi < n, right, left))
+    cum_cont = np.concatenate((zero, np.cumsum(continuum)))
+    level = _window_sums(cum_cont, lo, hi) / np.maximum(n_peak, 1)
+    level = np.maximum(level, side)
+    background = level * n_peak
+    net = gross - background
+    l_c = k_alpha * np.sqrt(2. * np.maximum(background, 0.))
+    significance = net / np.sqrt(np.maximum(gross + background, 1.))
+
+    # curvature: centre FWHM wide sum vs. the two neighbouring FWHM sums
+    h = np.maximum(np.round(0.5 * fwhm / bin_width).astype(int), 1)
+    s_c = _window_sums(cum, np.clip(center - h, 0, n), np.clip(center + h + 1, 0, n))
+    s_l = _window_sums(cum, np.clip(center - 3 * h - 1, 0, n), np.clip(center - h, 0, n))
+    s_r = _window_sums(cum, np.clip(center + h + 1, 0, n), np.clip(center + 3 * h + 2, 0, n))
+    curvature = (2. * s_c - s_l - s_r) / np.sqrt(np.maximum(4. * s_c + s_l + s_r, 1.))
+
+    # width from the second moment of the net counts in the window
+    with np.errstate(invalid='ignore', divide='ignore'):
+        m0 = net
+        m1 = _window_sums(cum_e, lo, hi) - level * _window_sums(cum_x, lo, hi)
+        m2 = _window_sums(cum_e2, lo, hi) - level * _window_sums(cum_x2, lo, hi)
+        var = m2 / m0 - (m1 / m0) ** 2
+        # the moment of a gaussian truncated at +/- 2.94 sigma is 0.96 sigma
+        width_ratio = np.sqrt(np.maximum(var, 0.)) / (0.96 * fwhm / 2.3548)
+    width_ratio = np.where(net > 0., width_ratio, np.nan)
+
+    ok_lc = net > l_c
+    ok_curv = curvature > min_curvature
+    ok_width = (width_ratio >= width_range[0]) & (width_ratio <= width_range[1])
+    report = np.zeros(len(locs), dtype=TRIAGE_DTYPE)
+    report['loc'] = locs
+    report['gross'] = gross
+    report['background'] = background
+    report['net'] = net
+    report['l_c'] = l_c
+    report['significance'] = significance
+    report['curvature'] = curvature
+    report['fwhm_expected'] = fwhm
+    report['width_ratio'] = width_ratio
+    report['accept'] = ok_lc & ok_curv & ok_width
+    report['reason'] = [",".join(r for r, ok in zip(("below L_C", "flat", "width"), oks) if not ok)
+                        for oks in zip(ok_lc, ok_curv, ok_width)]
+    return report
+
+
+def format_report(report):
+    """!
+    @brief Printable table of a triage report
+    """
+    msg = "%10s %10s %10s %8s %8s %8s  %s\n" % ("loc", "net", "L_C", "signif", "curv", "width",
+                                                "decision")
+    for row in report:
+        msg += "%10.2f %10.1f %10.1f %8.2f %8.2f %8.2f  %s\n" % (
+            row['loc'], row['net'], row['l_c'], row['significance'], row['curvature'],
+            row['width_ratio'], "fit" if row['accept'] else "skip (%s)" % row['reason'])
+    return msg
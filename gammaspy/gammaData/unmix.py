@@ -0,0 +1,315 @@
+"""!
+@brief Module unmix
+Whole spectrum nuclide screening.  Each candidate nuclide gets a response
+template (its gamma lines broadened by the detector resolution and
+integrated over the channels) and the continuum subtracted spectrum is
+decomposed into non-negative template amplitudes in a single NNLS solve.
+Templates are sparse and cached per energy grid, so screening a spectrum
+takes milliseconds.
+"""
+from __future__ import division
+import collections
+import csv
+import hashlib
+import io
+import os
+import zipfile
+import numpy as np
+from scipy import sparse
+from scipy.optimize import nnls, lsq_linear
+from scipy.special import erf
+
+## Bundled nuclide line library
+ISOTOPE_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "isotope_db",
+                          "isotope_db.zip")
+
+## Strong lines of common calibration and NORM nuclides, (keV, gammas per decay).
+## Used when the bundled library is unavailable.
+COMMON_LINES = {
+    "Am-241": [(59.54, 0.359)],
+    "Cs-137": [(661.66, 0.851)],
+    "Co-60": [(1173.23, 0.9985), (1332.49, 0.9998)],
+    "K-40": [(1460.82, 0.1066)],
+    "Pb-212": [(238.63, 0.436), (300.09, 0.0318)],
+    "Pb-214": [(241.99, 0.0727), (295.22, 0.184), (351.93, 0.356)],
+    "Bi-214": [(609.31, 0.455), (1120.29, 0.149), (1764.49, 0.153)],
+    "Tl-208": [(583.19, 0.850), (860.56, 0.125), (2614.51, 0.998)],
+    "Ac-228": [(338.32, 0.113), (911.20, 0.258), (968.97, 0.158)],
+}
+
+
+def _parse_lines(text):
+    """!
+    @brief Lines from CSV / whitespace separated text with (nuclide,
+    energy, intensity) columns.  A header naming the columns is optional;
+    intensities above 1 are taken to be percent.
+    """
+    rows = [row for row in csv.reader(io.StringIO(text.replace("\t", ",")))
+            if row and not row[0].lstrip().startswith("#")]
+    if rows and len(rows[0]) == 1:
+        rows = [row[0].split() for row in rows]
+    cols = (0, 1, 2)
+    if rows:
+        header = [h.strip().lower() for h in rows[0]]
+        try:
+            float(header[1])
+        except (ValueError, IndexError):
+            def find(*names):
+                return next(i for i, h in enumerate(header) if any(n in h for n in names))
+            try:
+                cols = (find("nuclide", "isotope", "name"), find("energy"),
+                        find("intensity", "yield", "abundance", "branching"))
+            except StopIteration:
+                raise ValueError("Line data needs nuclide, energy and intensity columns")
+            rows = rows[1:]
+    lines = collections.OrderedDict()
+    for row in rows:
+        try:
+            name = row[cols[0]].strip()
+            energy, intensity = float(row[cols[1]]), float(row[cols[2]])
+        except (ValueError, IndexError):
+            continue
+        lines.setdefault(name, []).append((energy, intensity))
+    if lines and max(i for v in lines.values() for e, i in v) > 1.:
+        lines = collections.OrderedDict((k, [(e, i / 100.) for e, i in v])
+                                        for k, v in lines.items())
+    return lines
+
+
+def load_lines(path=ISOTOPE_DB):
+    """!
+    @brief Read nuclide line data from a CSV/text file or a zip archive of
+    such files.
+    @return OrderedDict nuclide -> list of (energy keV, gammas per decay)
+    """
+    with open(path, "rb") as f:
+        head = f.read(64)
+    if head.startswith(b"version https://git-lfs"):
+        raise IOError("%s is a git-lfs pointer, run 'git lfs pull' to fetch it" % path)
+    if zipfile.is_zipfile(path):
+        lines = collections.OrderedDict()
+        with zipfile.ZipFile(path) as zf:
+            for name in zf.namelist():
+                if os.path.splitext(name)[1].lower() in (".csv", ".txt", ".dat"):
+                    text = zf.read(name).decode("utf-8", "replace")
+                    for nuc, nuc_lines in _parse_lines(text).items():
+                        lines.setdefault(nuc, []).extend(nuc_lines)
+        return lines
+    with open(path) as f:
+        return _parse_lines(f.read())
+
+
+class NuclideLibrary(object):
+    """!
+    @brief Gamma lines of the candidate nuclides.
+    @param lines  dict nuclide -> list of (energy keV, gammas per decay)
+    """
+    def __init__(self, lines):
+        self.lines = collections.OrderedDict(
+            (name, np.array(sorted(nuc_lines), dtype=float).reshape(-1, 2))
+            for name, nuc_lines in lines.items())
+
+    @classmethod
+    def default(cls):
+        """!
+        @brief The bundled isotope_db, or COMMON_LINES if it cannot be read
+        """
+        try:
+            lines = load_lines(ISOTOPE_DB)
+            if lines:
+                return cls(lines)
+        except (IOError, OSError, ValueError) as e:
+            print("WARNING: isotope_db unavailable (%s), using common lines" % str(e))
+        return cls(COMMON_LINES)
+
+    @property
+    def nuclides(self):
+        return list(self.lines.keys())
+
+    def select(self, nuclides):
+        return NuclideLibrary(collections.OrderedDict(
+            (name, self.lines[name]) for name in nuclides))
+
+    def key(self):
+        h = hashlib.sha1()
+        for name, nuc_lines in self.lines.items():
+            h.update(name.encode())
+            h.update(nuc_lines.tobytes())
+        return h.hexdigest()
+
+
+class TemplateUnmixer(object):
+    """!
+    @brief NNLS decomposition of spectra into nuclide response templates.
+    Template column j holds the expected counts per channel of nuclide j
+    for one decay seen with unit efficiency:
+    \f[
+    T_{ij} = \sum_l I_l \epsilon(E_l) \int_{bin_i} N(E; E_l, \sigma(E_l)) dE
+    \f]
+    so the amplitudes are numbers of detected decays (/ efficiency).
+    @param library  NuclideLibrary (default NuclideLibrary.default())
+    @param efficiency  Callable efficiency(E) (default 1)
+    @param n_sigma  Float. Template support half width in sigma
+    @param min_intensity  Float. Ignore weaker lines (gammas per decay)
+    @param max_cached  Int. Number of cached template matrices
+    """
+    def __init__(self, library=None, efficiency=None, n_sigma=5., min_intensity=1e-3,
+                 max_cached=8):
+        self.library = library if library is not None else NuclideLibrary.default()
+        self.efficiency = efficiency
+        self.n_sigma = n_sigma
+        self.min_intensity = min_intensity
+        self.max_cached = max_cached
+        self._cache = collections.OrderedDict()
+
+    def templates(self, energy, res_cal):
+        """!
+        @brief Sparse (n_channels, n_nuclides) template matrix of an energy
+        grid, cached by grid, resolution and library.
+        """
+        return self._template_data(energy, res_cal)[0]
+
+    def _template_data(self, energy, res_cal):
+        """!
+        @brief (template matrix, list of (i_lo, i_hi) channel windows of
+        the lines)
+        """
+        energy = np.asarray(energy, dtype=float)
+        key = (hashlib.sha1(np.ascontiguousarray(energy).tobytes()).hexdigest(),
+               tuple(np.round(res_cal.coeffs, 12)), self.library.key(), id(self.efficiency))
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        # channel energies are bin centres, as for the peak models
+        mid = 0.5 * (energy[1:] + energy[:-1])
+        first, last = (energy[0] - (mid[0] - energy[0]), energy[-1] + (energy[-1] - mid[-1])) \
+            if len(mid) else (energy[0] - 0.5, energy[-1] + 0.5)
+        edges = np.concatenate(([first], mid, [last]))
+        rows, cols, vals, windows = [], [], [], []
+        for j, (name, nuc_lines) in enumerate(self.library.lines.items()):
+            for e_line, intensity in nuc_lines:
+                if intensity < self.min_intensity or not (edges[0] < e_line < edges[-1]):
+                    continue
+                sigma = float(res_cal.sigma(e_line))
+                i_lo = max(np.searchsorted(edges, e_line - self.n_sigma * sigma) - 1, 0)
+                i_hi = min(np.searchsorted(edges, e_line + self.n_sigma * sigma) + 1, len(edges))
+                cdf = 0.5 * erf((edges[i_lo:i_hi] - e_line) / (np.sqrt(2.) * sigma))
+                eff = 1. if self.efficiency is None else float(self.efficiency(e_line))
+                rows.append(np.arange(i_lo, i_hi - 1))
+                cols.append(np.full(i_hi - 1 - i_lo, j))
+                vals.append(intensity * eff * np.diff(cdf))
+                windows.append((i_lo, i_hi - 1))
+        n_nuc = len(self.library.lines)
+        if rows:
+            mat = sparse.coo_matrix(
+                (np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                shape=(len(energy), n_nuc)).tocsc()
+        else:
+            mat = sparse.csc_matrix((len(energy), n_nuc))
+        self._cache[key] = (mat, windows)
+        while len(self._cache) > self.max_cached:
+            self._cache.popitem(last=False)
+        return mat, windows
+
+    @staticmethod
+    def baseline_segments(windows, n_channels, margin=1.):
+        """!
+        @brief Channel segments of the local baselines: the line windows,
+        widened on both sides by margin times their half width (side
+        bands), with overlapping windows merged.
+        @return list of (i_lo, i_hi) channel ranges (i_hi exclusive)
+        """
+        segments = []
+        for i_lo, i_hi in sorted(windows):
+            pad = int(np.ceil(0.5 * margin * (i_hi - i_lo)))
+            i_lo, i_hi = max(i_lo - pad, 0), min(i_hi + pad, n_channels)
+            if segments and i_lo <= segments[-1][1]:
+                segments[-1] = (segments[-1][0], max(segments[-1][1], i_hi))
+            else:
+                segments.append((i_lo, i_hi))
+        return segments
+
+    def unmix(self, spec, subtract_continuum=True, solver="nnls", baseline=True, margin=1.):
+        """!
+        @brief Template amplitudes of a spectrum.
+        The SNIP continuum is biased low, so with baseline=True a local
+        linear baseline (constant and slope, any sign) is fit jointly with
+        the templates on each segment of the line windows plus side bands.
+        Residual continuum is taken up by the baselines instead of the
+        templates, and the amplitude errors include the baseline
+        uncertainty.
+        @param spec  spectrum.GammaSpectrum
+        @param subtract_continuum  Bool. Remove the SNIP continuum first
+        @param solver  String. "nnls" (dense NNLS over the template
+            support) or "lsq_linear" (sparse bounded least squares)
+        @param baseline  Bool. Fit local linear baselines
+        @param margin  Float. Side band width of the baseline segments, in
+            half widths of the line windows
+        @return dict with nuclides, amplitude, amplitude_err, rate (/ s, if
+            the live time is known), significance and reduced chi2
+        """
+        energy = spec.energy
+        mat, windows = self._template_data(energy, spec.resolution())
+        widths = np.diff(energy)
+        widths = np.append(widths[:1], widths) if len(widths) else np.ones(len(energy))
+        counts = np.asarray(spec.counts, dtype=float)
+        net = counts - spec.continuum() * widths if subtract_continuum else counts
+        sigma = np.sqrt(np.maximum(counts, 1.))
+        n_nuc = mat.shape[1]
+        if baseline:
+            segments = self.baseline_segments(windows, len(energy), margin)
+            support = np.concatenate([np.arange(i_lo, i_hi) for i_lo, i_hi in segments]) \
+                if segments else np.array([], dtype=int)
+            b_rows, b_cols, b_vals = [], [], []
+            for k, (i_lo, i_hi) in enumerate(segments):
+                chans = np.arange(i_lo, i_hi)
+                slope = (chans - 0.5 * (i_lo + i_hi - 1)) / max(0.5 * (i_hi - i_lo), 1.)
+                b_rows += [chans, chans]
+                b_cols += [np.full(len(chans), 2 * k), np.full(len(chans), 2 * k + 1)]
+                b_vals += [np.ones(len(chans)), slope]
+            n_base = 2 * len(segments)
+            if n_base:
+                base = sparse.coo_matrix(
+                    (np.concatenate(b_vals), (np.concatenate(b_rows), np.concatenate(b_cols))),
+                    shape=(len(energy), n_base)).tocsc()
+                mat = sparse.hstack((mat, base)).tocsc()
+        else:
+            # only channels covered by a template constrain the amplitudes
+            support = np.flatnonzero(np.asarray(abs(mat).sum(axis=1)).ravel() > 0.)
+            n_base = 0
+        a_w = sparse.diags(1. / sigma[support]).dot(mat[support])
+        b_w = net[support] / sigma[support]
+        # unit column norms keep the solvers well conditioned
+        norm = np.sqrt(np.asarray(a_w.multiply(a_w).sum(axis=0)).ravel())
+        norm[norm == 0.] = 1.
+        a_n = a_w.dot(sparse.diags(1. / norm))
+        lower = np.concatenate((np.zeros(n_nuc), np.full(n_base, -np.inf)))
+        if solver == "lsq_linear":
+            coeffs = lsq_linear(a_n, b_w, bounds=(lower, np.inf), lsmr_tol="auto").x / norm
+        else:
+            # signed baseline coefficients as differences of two non-negative ones
+            dense = a_n.toarray()
+            x = nnls(np.hstack((dense, -dense[:, n_nuc:])), b_w)[0]
+            coeffs = np.concatenate((x[:n_nuc], x[n_nuc:n_nuc + n_base] - x[n_nuc + n_base:]))
+            coeffs = coeffs / norm
+        amplitude = coeffs[:n_nuc]
+        resid = b_w - a_w.dot(coeffs)
+        chi2 = float(np.dot(resid, resid))
+        dof = max(len(support) - np.count_nonzero(amplitude) - n_base, 1)
+        # covariance from the unconstrained normal equations, baselines included
+        fisher = a_w.T.dot(a_w)
+        fisher = fisher.toarray() if sparse.issparse(fisher) else np.asarray(fisher)
+        try:
+            amplitude_err = np.sqrt(np.abs(np.diag(np.linalg.pinv(fisher))))[:n_nuc]
+        except np.linalg.LinAlgError:
+            amplitude_err = np.full(n_nuc, np.nan)
+        has_err = amplitude_err > 0.
+        significance = np.where(has_err, amplitude / np.where(has_err, amplitude_err, 1.), 0.)
+        result = {"nuclides": self.library.nuclides, "amplitude": amplitude,
+                  "amplitude_err": amplitude_err, "significance": significance,
+                  "chi2_red": chi2 / dof}
+        live_time = spec.metadata.get("l_time")
+        if live_time:
+            result["rate"] = amplitude / live_time
+            result["rate_err"] = amplitude_err / live_time
+        return result
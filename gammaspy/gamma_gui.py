@@ -7,6 +7,7 @@ import os
 import sys
 # gammaspy imports
 from gammaspy.gammaData import reader, spectrum
+from gammaspy import gui_jobs
 
 
 ## Define main window class from template
@@ -14,6 +15,8 @@ pg.mkQApp()
 path = os.path.dirname(os.path.abspath(__file__))
 uiFile = os.path.join(path, 'gammaspy_gui_lite.ui')
 WindowTemplate, TemplateBaseClass = pg.Qt.loadUiType(uiFile)
+## List widget item data role holding the peak id
+PEAK_ID_ROLE = QtCore.Qt.UserRole
 
 
 class MainWindow(TemplateBaseClass):
@@ -29,6 +32,9 @@ class MainWindow(TemplateBaseClass):
         self.setup_menu_items()
         self.setup_buttons()
         self.setup_inputs()
+        # background analysis jobs
+        self.jobs = gui_jobs.JobManager(self)
+        self.jobs.busy_changed.connect(self.show_busy)
         # internal data
         self.last_clicked = []
         self.proxy = pg.SignalProxy(self.ui.plotSpectrum.scene().sigMouseMoved,
@@ -54,6 +60,19 @@ class MainWindow(TemplateBaseClass):
         # peak movement actions
         self.ui.actionNext_Peak.triggered.connect(self.next_peak)
         self.ui.actionPrev_Peak.triggered.connect(self.prev_peak)
+        # background job actions
+        self.actionFit_All_Peaks = QtGui.QAction("Fit All Peaks", self)
+        self.actionFit_All_Peaks.setShortcut("Ctrl+F")
+        self.actionFit_All_Peaks.triggered.connect(self.fit_all_peaks)
+        self.ui.menuFit.addAction(self.actionFit_All_Peaks)
+        self.actionCancel_Jobs = QtGui.QAction("Cancel Running Jobs", self)
+        self.actionCancel_Jobs.setShortcut("Esc")
+        self.actionCancel_Jobs.triggered.connect(self.cancel_jobs)
+        self.ui.menuFit.addAction(self.actionCancel_Jobs)
+        self.actionLive_Preview = QtGui.QAction("Live Fit Preview", self)
+        self.actionLive_Preview.setCheckable(True)
+        self.actionLive_Preview.setChecked(True)
+        self.ui.menuFit.addAction(self.actionLive_Preview)
 
     def setup_buttons(self):
         """!
@@ -81,6 +100,7 @@ class MainWindow(TemplateBaseClass):
         self.ui.cwt2.editingFinished.connect(self.update_cwt_settings)
         self.ui.cwt3.editingFinished.connect(self.update_cwt_settings)
         self.ui.cwt4.editingFinished.connect(self.update_cwt_settings)
+        self.ui.cwtTriage.toggled.connect(self.update_cwt_settings)
         self.update_cwt_settings()
         self.ui.roi1.editingFinished.connect(self.update_roi_settings)
         self.ui.roi2.editingFinished.connect(self.update_roi_settings)
@@ -93,6 +113,7 @@ class MainWindow(TemplateBaseClass):
             self.cwt_settings["ef"] = float(self.ui.cwt2.text())
             self.cwt_settings["min_snr"] = float(self.ui.cwt3.text())
             self.cwt_settings["noise_perc"] = float(self.ui.cwt4.text())
+            self.cwt_settings["triage"] = self.ui.cwtTriage.isChecked()
         except:
             print("Invalid entry")
 
@@ -108,37 +129,103 @@ class MainWindow(TemplateBaseClass):
 
     def auto_add_peaks(self):
         """!
-        @brief Runs automated peak finding routine.  Adds
+        @brief Runs automated peak finding routine in the background.  Adds
         all found peaks to the peak_bank
         """
-        self.spectrum.auto_peaks('cwt', **self.cwt_settings)
+        if not hasattr(self, 'spectrum'):
+            return
+        spec = self.spectrum
+        self.jobs.submit_call(gui_jobs.find_peaks, spec, dict(self.cwt_settings),
+                              key="auto_peaks",
+                              on_result=lambda locs: self.add_found_peaks(locs, spec),
+                              on_error=self.show_job_error)
+
+    def add_found_peaks(self, peak_locs, spec=None):
+        if spec is not None and spec is not self.spectrum:
+            # finished after another file was imported
+            return
+        for peak_loc in peak_locs:
+            self.spectrum.add_peak(peak_loc)
         # show the peaks
         self.show_peak_locs()
         self.update_list_item_db()
 
     def setup_plot(self):
         self.current_vline_loc = None
+        plot_item = self.ui.plotSpectrum.getPlotItem()
+        # min/max decimation of the visible range only.  Keeps pan/zoom
+        # responsive for large (64k channel) spectra.
+        plot_item.setDownsampling(auto=True, mode='peak')
+        plot_item.setClipToView(True)
+        # persistent items, updated in place with setData
+        self.spectrum_curve = self.ui.plotSpectrum.plot(clickable=True)
+        # all peak markers are drawn as one item of disconnected segments
+        self.peak_markers = pg.PlotCurveItem(pen='y', connect='pairs')
+        self.ui.plotSpectrum.addItem(self.peak_markers, ignoreBounds=True)
+        self.fit_curves = {}
+        self.preview_curve = pg.PlotCurveItem(pen='m')
+        self.ui.plotSpectrum.addItem(self.preview_curve, ignoreBounds=True)
+        self.scatter_plot = None
+        self.label = pg.LabelItem()
+        self.ui.plotSpectrum.addItem(self.label)
+        view_box = plot_item.getViewBox()
+        view_box.sigYRangeChanged.connect(self.update_peak_markers)
+        view_box.sigXRangeChanged.connect(self.update_scatter)
 
     def clean_plot(self):
         if hasattr(self, 'spectrum'):
-            for item in self.ui.plotSpectrum.allChildItems():
-                if type(item) == pg.graphicsItems.InfiniteLine.InfiniteLine or \
-                        type(item) == pg.graphicsItems.PlotCurveItem.PlotCurveItem:
-                    print("cleaned: %s" % type(item))
-                    self.ui.plotSpectrum.removeItem(item)
-            self.ui.plotSpectrum.plot(self.spectrum.spectrum, clean=True, clickable=True)
-            self.label = pg.LabelItem()
-            self.ui.plotSpectrum.addItem(self.label)
+            for fit_curve in self.fit_curves.values():
+                self.ui.plotSpectrum.removeItem(fit_curve)
+            self.fit_curves = {}
+            self.del_selected_peak_line()
+            self.del_selected_roi()
+            if hasattr(self, 'vert_line'):
+                self.ui.plotSpectrum.removeItem(self.vert_line)
+                del self.vert_line
+            self.peak_markers.setData([], [])
+            self.preview_curve.setData([], [])
+            self.spectrum_curve.setData(self.spectrum.spectrum[:, 0],
+                                        self.spectrum.spectrum[:, 1])
 
     def moved_line(self):
         # print("Hey, you moved me")
         self.current_vline_loc = self.mousePoint.x()
 
     def show_peak_locs(self):
-        for peak_loc in self.spectrum.peak_bank.keys():
-            # draw vert lines on screen at peak locs
-            peak_line = pg.InfiniteLine(pos=peak_loc, movable=False, pen='y')
-            self.ui.plotSpectrum.addItem(peak_line)
+        """!
+        @brief Draw vert lines at all peak locs.  Replaces the previously
+        drawn markers.
+        """
+        self.update_peak_markers()
+
+    def update_peak_markers(self, *args):
+        """!
+        @brief Refresh the batched peak markers.  The vertical segments
+        span the current view y range, so they are rebuilt when it changes.
+        """
+        if not hasattr(self, 'spectrum') or not len(self.spectrum.peak_bank):
+            self.peak_markers.setData([], [])
+            return
+        peak_locs = self.spectrum.peak_locs()
+        y_lo, y_hi = self.ui.plotSpectrum.getPlotItem().getViewBox().viewRange()[1]
+        x = np.repeat(peak_locs, 2)
+        y = np.tile([y_lo, y_hi], len(peak_locs))
+        self.peak_markers.setData(x, y)
+
+    def plot_fit(self, peak_id, peak):
+        """!
+        @brief Draw (or redraw in place) the fitted model of a peak.
+        """
+        if peak_id in self.fit_curves:
+            self.fit_curves[peak_id].setData(peak.roi_data[:, 0], peak.y_hat)
+        else:
+            fit_curve = pg.PlotCurveItem(x=peak.roi_data[:, 0], y=peak.y_hat, pen='r')
+            self.ui.plotSpectrum.addItem(fit_curve)
+            self.fit_curves[peak_id] = fit_curve
+
+    def remove_fit(self, peak_id):
+        if peak_id in self.fit_curves:
+            self.ui.plotSpectrum.removeItem(self.fit_curves.pop(peak_id))
 
     def new_vline(self):
         if hasattr(self, 'mousePoint'):
@@ -152,13 +239,28 @@ class MainWindow(TemplateBaseClass):
             self.current_vline_loc = self.mousePoint.x()
 
     # ======== Scatter Plot ================================================= #
-    def add_scatter(self):
-        scatterPlot = pg.ScatterPlotItem(x=self.spectrum.spectrum[:, 0],
-                                         y=self.spectrum.spectrum[:, 1],
-                                         size=5)
-        scatterPlot.sigClicked.connect(self.selected_data)
-        self.ui.plotSpectrum.addItem(scatterPlot)
-
+    def add_scatter(self, max_points=2000):
+        """!
+        @brief Clickable scatter of the channels in view.  Only the visible
+        range is drawn, decimated to at most max_points points.
+        """
+        if self.scatter_plot is None:
+            self.scatter_plot = pg.ScatterPlotItem(size=5)
+            self.scatter_plot.sigClicked.connect(self.selected_data)
+            self.ui.plotSpectrum.addItem(self.scatter_plot, ignoreBounds=True)
+        self.scatter_max_points = max_points
+        self.update_scatter()
+
+    def update_scatter(self, *args):
+        if self.scatter_plot is None or not hasattr(self, 'spectrum'):
+            return
+        energy = self.spectrum.spectrum[:, 0]
+        x_lo, x_hi = self.ui.plotSpectrum.getPlotItem().getViewBox().viewRange()[0]
+        i_lo, i_hi = np.searchsorted(energy, [x_lo, x_hi])
+        stride = max(1, int(np.ceil((i_hi - i_lo) / float(self.scatter_max_points))))
+        self.last_clicked = []
+        self.scatter_plot.setData(x=energy[i_lo:i_hi:stride],
+                                  y=self.spectrum.spectrum[i_lo:i_hi:stride, 1])
 
     def selected_data(self, plot, points):
         for p in self.last_clicked:
@@ -175,7 +277,7 @@ class MainWindow(TemplateBaseClass):
         if self.ui.plotSpectrum.sceneBoundingRect().contains(pos) and hasattr(self, 'spectrum') and hasattr(self, 'label'):
             mousePoint = self.ui.plotSpectrum.plotItem.vb.mapSceneToView(pos)
             self.mousePoint = mousePoint
-            index = int(mousePoint.x())
+            index = np.searchsorted(self.spectrum.spectrum[:, 0], mousePoint.x())
             if index > 0 and index < len(self.spectrum.spectrum[:, 0]):
                 self.label.setText("<span style='font-size: 12pt'>x=%0.1f, \
                                    <span style='color: red'>y1=%0.1f</span>, \
@@ -192,44 +294,55 @@ class MainWindow(TemplateBaseClass):
         self.update_list_item_db()
 
     def update_list_item_db(self):
+        """!
+        @brief Rebuild the list from the peak index.  Rows are in energy
+        order and hold the peak id.
+        """
         self.ui.listWidget.clear()
-        for peak_loc in self.spectrum.peak_bank.keys():
-            # new_item = QtGui.QListWidgetItem("Peak E(KeV)=" + str(peak_loc))
-            new_item = QtGui.QListWidgetItem(str(int(peak_loc)))
-            new_item.setText("Peak E(KeV)=" + str(int(peak_loc)))
-            # new_item.setTextAlignment(2)
-            # args: (role, value)
-            new_item.setData(0, float(peak_loc))
+        for peak_id in self.spectrum.peak_bank.ids:
+            peak_loc = self.spectrum.peak_bank.loc(peak_id)
+            new_item = QtGui.QListWidgetItem("Peak E(KeV)=" + str(int(peak_loc)))
+            new_item.setData(PEAK_ID_ROLE, peak_id)
             self.ui.listWidget.addItem(new_item)
 
     def delete_list_item(self):
         del_flagged_item = self.ui.listWidget.currentItem()
-        del_peak_loc = del_flagged_item.data(0)
-        self.spectrum.pop_peak(del_peak_loc)
-        row = self.ui.listWidget.currentRow()
-        self.ui.listWidget.takeItem(row)
-        #
+        if del_flagged_item is None:
+            return
+        del_peak_id = del_flagged_item.data(PEAK_ID_ROLE)
+        self.spectrum.pop_peak(self.spectrum.peak_bank.loc(del_peak_id))
+        self.remove_fit(del_peak_id)
         self.update_list_item_db()
         self.del_selected_peak_line()
         self.del_selected_roi()
+        self.update_peak_markers()
+
+    def select_peak(self, peak_id):
+        """!
+        @brief Select the list row of a peak.
+        """
+        if peak_id is None:
+            return
+        row = self.spectrum.peak_bank.position(peak_id)
+        self.ui.listWidget.setCurrentRow(row)
 
     def next_peak(self):
-        row = self.ui.listWidget.currentRow()
-        row += 1
-        next_item = self.ui.listWidget.item(row)
-        self.ui.listWidget.setCurrentItem(next_item)
-        self.list_item_clicked(next_item)
+        if hasattr(self, 'selected_peak_id') and \
+                self.selected_peak_id in self.spectrum.peak_bank.ids:
+            self.select_peak(self.spectrum.peak_bank.step(self.selected_peak_id, 1))
+        elif len(self.spectrum.peak_bank):
+            self.select_peak(self.spectrum.peak_bank.ids[0])
 
     def prev_peak(self):
-        row = self.ui.listWidget.currentRow()
-        row -= 1
-        prev_item = self.ui.listWidget.item(row)
-        self.ui.listWidget.setCurrentItem(prev_item)
-        self.list_item_clicked(prev_item)
+        if hasattr(self, 'selected_peak_id') and \
+                self.selected_peak_id in self.spectrum.peak_bank.ids:
+            self.select_peak(self.spectrum.peak_bank.step(self.selected_peak_id, -1))
+        elif len(self.spectrum.peak_bank):
+            self.select_peak(self.spectrum.peak_bank.ids[-1])
 
     def del_all_peaks(self):
         self.ui.listWidget.clear()
-        self.spectrum.peak_bank = {}
+        self.spectrum.del_all_peaks()
         self.clean_plot()
 
     def del_selected_peak_line(self):
@@ -245,53 +358,150 @@ class MainWindow(TemplateBaseClass):
             del self.selected_roi
 
     def list_item_clicked(self, arg=None):
-        # role=0 is energy loc
         if arg:
+            peak_id = arg.data(PEAK_ID_ROLE)
+            peak_loc = self.spectrum.peak_bank.loc(peak_id)
             # Display selected peak info
-            print("Selected Peak: %f" % arg.data(0))
+            print("Selected Peak: %f" % peak_loc)
             # Display peak centroid
             self.del_selected_peak_line()
-            self.selected_peak_line = pg.InfiniteLine(pos=arg.data(0), movable=False, pen='r')
+            self.selected_peak_line = pg.InfiniteLine(pos=peak_loc, movable=False, pen='r')
             self.ui.plotSpectrum.addItem(self.selected_peak_line)
             # Display peak ROI
             self.del_selected_roi()
-            self.selected_peak = self.spectrum.peak_bank[arg.data(0)]
-            values = [self.spectrum.peak_bank[arg.data(0)].lbound,
-                      self.spectrum.peak_bank[arg.data(0)].ubound]
+            self.preview_curve.setData([], [])
+            self.selected_peak = self.spectrum.peak_bank.get(peak_id)
+            self.selected_peak_id = peak_id
+            values = [self.selected_peak.lbound, self.selected_peak.ubound]
             self.manual_roi(values)
             self.peak_model_update()
 
     def update_selected_roi(self):
-        updated_roi_bounds = self.selected_roi.getRegion()
-        self.selected_peak.lbound = updated_roi_bounds[0]
-        self.selected_peak.ubound = updated_roi_bounds[-1]
+        """!
+        @brief Apply the edited ROI bounds once dragging stops.  Both
+        bounds are set at once so the ROI data is sliced a single time.
+        """
+        lbound, ubound = self.selected_roi.getRegion()
+        self.selected_peak.set_bounds(lbound, ubound)
+        if self.actionLive_Preview.isChecked():
+            self.submit_preview(self.selected_peak_id)
 
     def manual_roi(self, values=[990, 1100]):
         self.selected_roi = pg.LinearRegionItem(values=values, movable=True)
-        self.selected_roi.sigRegionChanged.connect(self.update_selected_roi)
+        self.selected_roi.sigRegionChangeFinished.connect(self.update_selected_roi)
         self.ui.plotSpectrum.addItem(self.selected_roi)
+
+    def submit_preview(self, peak_id):
+        """!
+        @brief Warm started local re-fit of a peak for a quick look at the
+        effect of the new ROI bounds.
+        """
+        spec = self.spectrum
+        peak = spec.peak_bank.get(peak_id)
+        self.jobs.submit(lambda job: peak.preview_fit(), key=("peak", peak_id),
+                         on_result=lambda preview: self.show_preview(preview, spec),
+                         on_error=self.show_job_error)
+
+    def show_preview(self, preview, spec=None):
+        if spec is not None and spec is not self.spectrum:
+            return
+        if preview is None:
+            self.preview_curve.setData([], [])
+            self.statusBar().showMessage("No converged fit to preview, fit the peak first")
+            return
+        self.preview_curve.setData(*preview)
     #========= End List Widget ================================================ #
 
     def fit_selected_peak(self):
         if hasattr(self, 'selected_peak'):
-            # msg = self.selected_peak.fit()
-            self.selected_peak.check_neighboring_peaks(np.array(list(self.spectrum.peak_bank.keys())))
-            maxiter, tempearture, stepsize = self.read_fit_settings()
-            msg = self.selected_peak.fit_new(tempearture, stepsize, maxiter)
-            y = self.selected_peak.y_hat
-            x = self.selected_peak.roi_data[:, 0]
-            fit_plot = pg.PlotCurveItem(x=x, y=y, pen='r')
-            self.ui.plotSpectrum.addItem(fit_plot)
-            self.ui.textBrowser.insertPlainText(msg)
-            self.ui.textBrowser.verticalScrollBar().setValue(
-                self.ui.textBrowser.verticalScrollBar().maximum())
+            self.submit_fit(self.selected_peak_id)
+
+    def fit_all_peaks(self):
+        """!
+        @brief Fit every peak in the peak bank concurrently.
+        """
+        if not hasattr(self, 'spectrum'):
+            return
+        self.fit_all_count = [0, len(self.spectrum.peak_bank)]
+        for peak_id in self.spectrum.peak_bank.ids:
+            self.submit_fit(peak_id, fit_all=True)
+
+    def submit_fit(self, peak_id, fit_all=False):
+        """!
+        @brief Queue a fit of a peak on the job pool.  Fits, previews and
+        ROI searches of a peak share the job key ("peak", peak_id), so a new
+        one cancels the running one instead of working on the same Roi
+        concurrently.
+        """
+        spec = self.spectrum
+        peak = spec.peak_bank.get(peak_id)
+        peak_locs = spec.peak_locs()
+        maxiter, tempearture, stepsize = self.read_fit_settings()
+        fit_kwargs = {"temperature": tempearture, "stepsize": stepsize, "maxiter": maxiter}
+        on_result = lambda result: self.show_fit_result(peak_id, result, fit_all, spec)
+        if self.jobs.backend == "process":
+            self.jobs.submit_call(gui_jobs.fit_roi, peak, peak_locs, fit_kwargs,
+                                  key=("peak", peak_id), on_result=on_result,
+                                  on_error=self.show_job_error)
+        else:
+            self.jobs.submit(lambda job: gui_jobs.fit_roi(peak, peak_locs, fit_kwargs,
+                                                          job.cancelled),
+                             key=("peak", peak_id), on_result=on_result,
+                             on_error=self.show_job_error)
+
+    def show_fit_result(self, peak_id, result, fit_all=False, spec=None):
+        """!
+        @brief Plot a finished fit and print its report.  Runs on the GUI thread.
+        @param spec  GammaSpectrum the fit was submitted for.  Results of a
+            spectrum that has since been replaced are dropped (peak ids
+            restart at 0 for every spectrum).
+        """
+        peak, msg = result
+        if spec is not None and spec is not self.spectrum:
+            return
+        if self.spectrum.peak_bank.get(peak_id) is None:
+            return
+        # fits run in another process return a copy of the roi
+        self.spectrum.peak_bank.replace(peak_id, peak)
+        if getattr(self, 'selected_peak_id', None) == peak_id:
+            self.selected_peak = peak
+        self.plot_fit(peak_id, peak)
+        self.ui.textBrowser.insertPlainText(msg)
+        self.ui.textBrowser.verticalScrollBar().setValue(
+            self.ui.textBrowser.verticalScrollBar().maximum())
+        if fit_all:
+            self.fit_all_count[0] += 1
+            self.statusBar().showMessage("Fit %d / %d peaks" % tuple(self.fit_all_count))
+
+    def show_job_error(self, error):
+        self.ui.textBrowser.insertPlainText("JOB FAILED: %s \n" % str(error))
+
+    def show_busy(self, n_jobs):
+        if n_jobs:
+            self.statusBar().showMessage("Running %d job(s)... (Esc to cancel)" % n_jobs)
+        else:
+            self.statusBar().showMessage("Ready")
+
+    def cancel_jobs(self):
+        self.jobs.cancel_all()
+        self.statusBar().showMessage("Cancelled")
 
     def selected_peak_fit_roi(self):
         if hasattr(self, 'selected_peak'):
-            self.selected_peak.find_roi()
-            # redaw roi
-            current_item = self.ui.listWidget.currentItem()
-            self.list_item_clicked(current_item)
+            peak_id, spec = self.selected_peak_id, self.spectrum
+            self.jobs.submit_call(gui_jobs.find_roi, self.selected_peak, {},
+                                  key=("peak", peak_id),
+                                  on_result=lambda peak: self.show_found_roi(peak_id, peak, spec),
+                                  on_error=self.show_job_error)
+
+    def show_found_roi(self, peak_id, peak, spec=None):
+        if spec is not None and spec is not self.spectrum:
+            return
+        if self.spectrum.peak_bank.get(peak_id) is not None:
+            self.spectrum.peak_bank.replace(peak_id, peak)
+        # redaw roi
+        current_item = self.ui.listWidget.currentItem()
+        self.list_item_clicked(current_item)
 
     def peak_model_update(self):
         if hasattr(self, 'selected_peak'):
@@ -308,6 +518,8 @@ class MainWindow(TemplateBaseClass):
         # read file
         dreader = reader.DataReader()
         mdata, edata = dreader.read(name)
+        # jobs of the previous spectrum would write into the new peak bank
+        self.jobs.cancel_all()
         # init the spectrum
         self.spectrum = spectrum.GammaSpectrum(edata, mdata)
         self.clean_plot()
@@ -329,7 +541,7 @@ class MainWindow(TemplateBaseClass):
         fname = QtGui.QFileDialog.getSaveFileName(self, 'Save File')
         dreader = reader.DataReader()
         metadata, spec = self.spectrum.metadata, self.spectrum.spectrum
-        dreader.write(fname, metadata, spec)
+        dreader.write(fname, metadata, spec, self.spectrum.peak_table())
 
     def write_peak_report(self):
         fname = QtGui.QFileDialog.getSaveFileName(self, 'Save File')
@@ -341,6 +553,7 @@ class MainWindow(TemplateBaseClass):
         """!
         @brief Exit
         """
+        self.jobs.shutdown()
         sys.exit(0)
 
 def main():
@@ -0,0 +1,186 @@
+"""!
+@brief Background analysis jobs for the GammaSpy GUI.
+Peak search and fitting run on a QThreadPool (or a process pool) so the
+Qt event loop stays responsive.  Results, errors and progress are
+delivered back to the GUI thread through Qt signals.
+"""
+import threading
+from pyqtgraph.Qt import QtCore
+from gammaspy.gammaData import parallel
+from gammaspy.gammaData import triage as ptriage
+from gammaspy.gammaData.roi import FitCancelled
+
+
+def fit_roi(peak, peak_locs, fit_kwargs, cancel=None):
+    """!
+    @brief Multiplet selection and fit of a single ROI.
+    Module level so it can be shipped to a process pool.
+    @param peak  roi.Roi instance
+    @param peak_locs  1d_array of all peak locations
+    @param fit_kwargs  dict of keyword args for Roi.fit_new
+    @param cancel  threading.Event
+    @return (fitted roi.Roi, fit report)
+    """
+    peak.check_neighboring_peaks(peak_locs)
+    msg = peak.fit_new(cancel=cancel, **fit_kwargs)
+    return peak, msg
+
+
+def find_peaks(spec, cwt_settings):
+    """!
+    @brief CWT peak search of a spectrum.  With cwt_settings["triage"]
+    only the candidates accepted by spec.triage_peaks are returned.
+    """
+    cwt_settings = dict(cwt_settings)
+    triage = cwt_settings.pop("triage", False)
+    peak_locs = spec.find_cwt_peaks(**cwt_settings)
+    if triage:
+        report = spec.triage_peaks(peak_locs)
+        print(ptriage.format_report(report))
+        peak_locs = report['loc'][report['accept']]
+    return peak_locs
+
+
+def find_roi(peak, roi_kwargs):
+    """!
+    @brief Auto ROI bounds of a single ROI.
+    """
+    peak.find_roi(**roi_kwargs)
+    return peak
+
+
+class JobSignals(QtCore.QObject):
+    """!
+    @brief Signals of a Job.  QRunnable is not a QObject and cannot
+    own signals itself.
+    """
+    progress = QtCore.Signal(object)
+    result = QtCore.Signal(object)
+    error = QtCore.Signal(object)
+    finished = QtCore.Signal()
+
+
+class Job(QtCore.QRunnable):
+    """!
+    @brief A cancellable unit of work run on a QThreadPool.
+    The job function is called as fn(job, *args) and may call
+    job.report(msg) and check job.cancelled.is_set().
+    """
+    def __init__(self, fn, *args, **kwargs):
+        super(Job, self).__init__()
+        self.fn = fn
+        self.args = args
+        self.key = kwargs.pop("key", None)
+        self.signals = JobSignals()
+        self.cancelled = threading.Event()
+        self.setAutoDelete(False)
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def report(self, msg):
+        if not self.cancelled.is_set():
+            self.signals.progress.emit(msg)
+
+    def run(self):
+        try:
+            result = self.fn(self, *self.args)
+            if not self.cancelled.is_set():
+                self.signals.result.emit(result)
+        except FitCancelled:
+            pass
+        except Exception as e:
+            if not self.cancelled.is_set():
+                self.signals.error.emit(e)
+        finally:
+            self.signals.finished.emit()
+
+
+class JobManager(QtCore.QObject):
+    """!
+    @brief Owns the worker pool and the set of running jobs.
+    With backend="process" the work of each job is run in a process pool
+    and the QThreadPool thread only waits for it, so fits are not limited
+    by the GIL.
+    """
+    busy_changed = QtCore.Signal(int)
+
+    def __init__(self, parent=None, n_workers=None, backend="thread"):
+        super(JobManager, self).__init__(parent)
+        self.pool = QtCore.QThreadPool()
+        self.pool.setMaxThreadCount(n_workers or parallel.default_workers())
+        self.backend = backend
+        self._executor = None
+        self.jobs = {}
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = parallel.make_executor(self.pool.maxThreadCount(), "process")
+        return self._executor
+
+    def submit(self, fn, *args, **kwargs):
+        """!
+        @brief Queue fn(job, *args) on the pool.
+        @param key  Hashable.  A running job with the same key is
+            cancelled first (e.g. re-fitting the same peak).
+        @param on_result  Callable(result) run on the GUI thread
+        @param on_error  Callable(exception) run on the GUI thread
+        @param on_progress  Callable(msg) run on the GUI thread
+        @return Job
+        """
+        key = kwargs.pop("key", None)
+        job = Job(fn, *args, key=key)
+        for name in ("result", "error", "progress"):
+            slot = kwargs.pop("on_" + name, None)
+            if slot is not None:
+                getattr(job.signals, name).connect(slot)
+        job.signals.finished.connect(lambda: self._finished(job))
+        if key is not None and key in self.jobs:
+            self.jobs[key].cancel()
+        self.jobs[key if key is not None else id(job)] = job
+        self.busy_changed.emit(len(self.jobs))
+        self.pool.start(job)
+        return job
+
+    def submit_call(self, fn, *args, **kwargs):
+        """!
+        @brief Queue fn(*args) on the configured backend.  fn does not
+        receive the job; with the process backend fn and args must be
+        picklable and cancellation only prevents not yet started work.
+        """
+        if self.backend != "process":
+            return self.submit(lambda job, *a: fn(*a), *args, **kwargs)
+
+        def run_in_process(job, *a):
+            future = self.executor.submit(fn, *a)
+            while True:
+                try:
+                    return future.result(timeout=0.1)
+                except parallel.TimeoutError:
+                    if job.cancelled.is_set():
+                        future.cancel()
+                        raise FitCancelled()
+        return self.submit(run_in_process, *args, **kwargs)
+
+    def _finished(self, job):
+        for key, running_job in list(self.jobs.items()):
+            if running_job is job:
+                del self.jobs[key]
+        self.busy_changed.emit(len(self.jobs))
+
+    def cancel_all(self):
+        """!
+        @brief Cancel queued and running jobs.  Their results are discarded.
+        """
+        self.pool.clear()
+        for key, job in list(self.jobs.items()):
+            job.cancel()
+        self.jobs = {}
+        self.busy_changed.emit(0)
+
+    def shutdown(self):
+        self.cancel_all()
+        self.pool.waitForDone(2000)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
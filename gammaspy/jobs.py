@@ -0,0 +1,498 @@
+"""!
+@brief gammaspy-jobs: durable, resumable (re)processing campaigns.
+A campaign is a set of (file, channel) jobs in an SQLite ledger together
+with its analysis settings.  Workers claim jobs under a time limited lease,
+checkpoint every fitted peak in the ledger and write the results of a
+finished spectrum to an HDF5 file.  After a crash the expired lease makes
+the job claimable again and only the peaks without a checkpoint are fit.
+Failed jobs are retried with exponential backoff.  Several worker
+processes, or machines sharing the ledger file, can work on one campaign;
+static shards (--shard k/n) split it without contention.
+
+SQLite locking is not reliable on every network file system, keep the
+ledger on a local disk or a file system with working POSIX locks.
+"""
+from __future__ import print_function
+import argparse
+import fnmatch
+import hashlib
+import json
+import os
+import random
+import socket
+import sqlite3
+import time
+import numpy as np
+from gammaspy.gammaData import parallel, pipeline, reader, spectrum
+from gammaspy.gammaData.cache import SpectrumCache, file_hash
+from gammaspy.watch import DEFAULT_PATTERNS
+
+## Job states
+PENDING, RUNNING, DONE, PARTIAL, DEAD = "pending", "running", "done", "partial", "dead"
+
+
+class LeaseLost(Exception):
+    """!
+    @brief Raised when a worker's lease on a job expired and another worker
+    took the job over.
+    """
+    pass
+
+
+def bucket_of(path):
+    """!
+    @brief Stable hash of a path used for sharding
+    """
+    return int(hashlib.sha1(path.encode("utf-8")).hexdigest()[:8], 16)
+
+
+class JobLedger(object):
+    """!
+    @brief SQLite ledger of campaigns, jobs and per-peak checkpoints.
+    Each process must open its own ledger.
+    @param path  String. SQLite file
+    @param timeout  Float. Time (s) to wait for a lock held by another worker
+    """
+    peak_columns = [name for name, dtype in spectrum.PEAK_TABLE_DTYPE]
+
+    def __init__(self, path, timeout=60.):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=timeout)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS campaigns (name TEXT PRIMARY KEY, settings TEXT, "
+                "created REAL)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, campaign TEXT, "
+                "path TEXT, chan INTEGER, bucket INTEGER, state TEXT, attempts INTEGER, "
+                "next_attempt REAL, owner TEXT, lease_expires REAL, input_hash TEXT, "
+                "output TEXT, error TEXT, n_peaks INTEGER, n_failed INTEGER, elapsed REAL, "
+                "updated REAL, UNIQUE (campaign, path, chan))")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (campaign, state)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS peaks (job_id INTEGER, state TEXT, error TEXT, "
+                "attempt INTEGER, %s)" %
+                ", ".join("%s %s" % (name, "INTEGER" if name == "peak_id" else "REAL")
+                          for name in self.peak_columns))
+            self.conn.execute("CREATE INDEX IF NOT EXISTS peaks_job ON peaks (job_id)")
+
+    def close(self):
+        self.conn.close()
+
+    # ---- campaigns --------------------------------------------------------- #
+    def add_campaign(self, name, settings=None):
+        """!
+        @brief Create a campaign.  The settings of an existing campaign are
+        kept, so re-adding files never changes how a campaign is analyzed.
+        @param settings  dict: cwt_settings, fit_kwargs, out_dir, cache_dir
+        @return settings of the campaign
+        """
+        with self.conn:
+            self.conn.execute("INSERT OR IGNORE INTO campaigns VALUES (?, ?, ?)",
+                              (name, json.dumps(settings or {}), time.time()))
+        return self.settings(name)
+
+    def settings(self, name):
+        row = self.conn.execute("SELECT settings FROM campaigns WHERE name=?", (name,)).fetchone()
+        if row is None:
+            raise KeyError("No campaign %s" % name)
+        return json.loads(row[0])
+
+    def add_jobs(self, campaign, paths, chans=(0,)):
+        """!
+        @brief Add (file, channel) jobs to a campaign.  Jobs already in the
+        campaign are left as they are.
+        @return Int. Number of new jobs
+        """
+        now = time.time()
+        rows = [(campaign, os.path.abspath(path), chan, bucket_of(os.path.abspath(path)),
+                 PENDING, 0, 0., now) for path in paths for chan in chans]
+        with self.conn:
+            before = self.conn.total_changes
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO jobs (campaign, path, chan, bucket, state, attempts, "
+                "next_attempt, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            return self.conn.total_changes - before
+
+    def status(self, campaign):
+        """!
+        @brief Number of jobs in each state
+        """
+        return dict(self.conn.execute(
+            "SELECT state, COUNT(*) FROM jobs WHERE campaign=? GROUP BY state", (campaign,)))
+
+    def retry(self, campaign, states=(PARTIAL, DEAD)):
+        """!
+        @brief Give finished jobs in the given states a new set of attempts
+        @return Int. Number of jobs requeued
+        """
+        with self.conn:
+            cur = self.conn.execute(
+                "UPDATE jobs SET state=?, attempts=0, next_attempt=0, owner=NULL, updated=? "
+                "WHERE campaign=? AND state IN (%s)" % ", ".join("?" * len(states)),
+                (PENDING, time.time(), campaign) + tuple(states))
+            return cur.rowcount
+
+    # ---- worker side ------------------------------------------------------- #
+    def claim(self, campaign, owner, lease=600., shard=None, n_shards=1, max_attempts=3):
+        """!
+        @brief Atomically take the next due job: a pending job whose retry
+        time has come or a running job whose lease expired (its worker
+        died).  Expired jobs out of attempts are marked dead.
+        @param shard  Int. Only take jobs of this shard (of n_shards)
+        @return dict with id, path, chan, attempts (this one included) and
+            input_hash, or None if no job is due
+        """
+        shard_sql = "" if shard is None else " AND bucket %% %d = %d" % (n_shards, shard)
+        now = time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            while True:
+                row = self.conn.execute(
+                    "SELECT id, path, chan, attempts, input_hash, state FROM jobs WHERE campaign=? "
+                    "AND ((state=? AND next_attempt<=?) OR (state=? AND lease_expires<?))%s "
+                    "ORDER BY next_attempt, id LIMIT 1" % shard_sql,
+                    (campaign, PENDING, now, RUNNING, now)).fetchone()
+                if row is None:
+                    self.conn.commit()
+                    return None
+                job_id, path, chan, attempts, input_hash, state = row
+                if state == RUNNING and attempts >= max_attempts:
+                    self.conn.execute("UPDATE jobs SET state=?, owner=NULL, error=?, updated=? "
+                                      "WHERE id=?", (DEAD, "lease expired", now, job_id))
+                    continue
+                self.conn.execute(
+                    "UPDATE jobs SET state=?, owner=?, lease_expires=?, attempts=?, updated=? "
+                    "WHERE id=?", (RUNNING, owner, now + lease, attempts + 1, now, job_id))
+                self.conn.commit()
+                return {"id": job_id, "path": path, "chan": chan, "attempts": attempts + 1,
+                        "input_hash": input_hash}
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    def _owned(self, job_id, owner, sql, args):
+        """!
+        @brief Update a running job of owner in the current transaction.
+        Later statements of the transaction are only run by an owner.
+        """
+        cur = self.conn.execute("UPDATE jobs SET %s WHERE id=? AND owner=? AND state=?" % sql,
+                                tuple(args) + (job_id, owner, RUNNING))
+        if cur.rowcount == 0:
+            raise LeaseLost("Job %d is no longer owned by %s" % (job_id, owner))
+
+    def _update_owned(self, job_id, owner, sql, args):
+        with self.conn:
+            self._owned(job_id, owner, sql, args)
+
+    def heartbeat(self, job_id, owner, lease=600.):
+        """!
+        @brief Extend the lease of a running job
+        """
+        now = time.time()
+        self._update_owned(job_id, owner, "lease_expires=?, updated=?", (now + lease, now))
+
+    def release(self, job_id, owner):
+        """!
+        @brief Give a job back without counting the attempt (worker shutdown)
+        """
+        self._update_owned(job_id, owner, "state=?, owner=NULL, attempts=attempts-1, updated=?",
+                           (PENDING, time.time()))
+
+    def set_input_hash(self, job_id, owner, input_hash):
+        """!
+        @brief Record the input file hash.  Checkpoints of a different
+        version of the file are dropped.
+        """
+        with self.conn:
+            row = self.conn.execute("SELECT input_hash FROM jobs WHERE id=?", (job_id,)).fetchone()
+            self._owned(job_id, owner, "input_hash=?", (input_hash,))
+            if row is not None and row[0] is not None and row[0] != input_hash:
+                self.conn.execute("DELETE FROM peaks WHERE job_id=?", (job_id,))
+
+    def complete(self, job_id, owner, output, n_peaks, n_failed, elapsed):
+        """!
+        @brief Mark a job done (partial if some peak fits failed)
+        """
+        self._update_owned(
+            job_id, owner, "state=?, owner=NULL, output=?, error=NULL, n_peaks=?, n_failed=?, "
+            "elapsed=?, updated=?", (PARTIAL if n_failed else DONE, output, n_peaks, n_failed,
+                                     elapsed, time.time()))
+
+    def fail(self, job_id, owner, error, attempts, max_attempts=3, backoff=30., max_backoff=3600.):
+        """!
+        @brief Schedule a retry after min(backoff 2^(attempts - 1),
+        max_backoff) (+ up to 25 % jitter) or mark the job dead when it is
+        out of attempts.
+        @return Float. Retry time, None if the job is dead
+        """
+        now = time.time()
+        if attempts >= max_attempts:
+            self._update_owned(job_id, owner, "state=?, owner=NULL, error=?, updated=?",
+                               (DEAD, error, now))
+            return None
+        delay = min(backoff * 2 ** (attempts - 1), max_backoff) * (1. + 0.25 * random.random())
+        self._update_owned(job_id, owner, "state=?, owner=NULL, error=?, next_attempt=?, updated=?",
+                           (PENDING, error, now + delay, now))
+        return now + delay
+
+    def next_retry(self, campaign, shard=None, n_shards=1):
+        """!
+        @brief Earliest retry time of the pending jobs (None if none)
+        """
+        shard_sql = "" if shard is None else " AND bucket %% %d = %d" % (n_shards, shard)
+        return self.conn.execute(
+            "SELECT MIN(next_attempt) FROM jobs WHERE campaign=? AND state=?%s" % shard_sql,
+            (campaign, PENDING)).fetchone()[0]
+
+    # ---- per-peak checkpoints ---------------------------------------------- #
+    def checkpoint_peak(self, job_id, owner, loc, rows, error=None, attempt=0, lease=600.):
+        """!
+        @brief Store the fit of one peak (ROI) of a job and extend the
+        lease.  Both happen in one transaction that raises LeaseLost,
+        without touching the checkpoints, if owner lost the job.
+        @param rows  spectrum.PEAK_TABLE_DTYPE array of the ROI
+        """
+        now = time.time()
+        with self.conn:
+            self._owned(job_id, owner, "lease_expires=?, updated=?", (now + lease, now))
+            self.conn.execute("DELETE FROM peaks WHERE job_id=? AND loc=?", (job_id, loc))
+            if error is not None or len(rows) == 0:
+                self.conn.execute(
+                    "INSERT INTO peaks (job_id, loc, state, error, attempt) VALUES (?, ?, ?, ?, ?)",
+                    (job_id, loc, "failed", error or "no fit", attempt))
+                return
+            self.conn.executemany(
+                "INSERT INTO peaks VALUES (?, 'ok', NULL, ?, %s)" %
+                ", ".join("?" * len(self.peak_columns)),
+                [(job_id, attempt) + tuple(row.item()) for row in rows])
+
+    def fitted_locs(self, job_id):
+        return np.array([row[0] for row in self.conn.execute(
+            "SELECT DISTINCT loc FROM peaks WHERE job_id=? AND state='ok'", (job_id,))])
+
+    def peak_table(self, job_id):
+        """!
+        @brief Checkpointed peak fits of a job (spectrum.PEAK_TABLE_DTYPE)
+        """
+        rows = self.conn.execute(
+            "SELECT %s FROM peaks WHERE job_id=? AND state='ok' ORDER BY loc, peak_id" %
+            ", ".join(self.peak_columns), (job_id,)).fetchall()
+        return np.array([tuple(row) for row in rows], dtype=spectrum.PEAK_TABLE_DTYPE)
+
+    def n_failed_peaks(self, job_id):
+        return self.conn.execute("SELECT COUNT(*) FROM peaks WHERE job_id=? AND state='failed'",
+                                 (job_id,)).fetchone()[0]
+
+
+def output_path(out_dir, path, chan, input_hash):
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(out_dir, "%s_%s_c%d.h5" % (stem, input_hash[:12], chan))
+
+
+def process_job(ledger, job, settings, owner, lease=600., max_attempts=3):
+    """!
+    @brief Analyze the spectrum of a claimed job, checkpointing each peak.
+    Peaks fitted by an earlier attempt on the same file are not refit.
+    With global_method "multistart" each attempt uses a different seed.
+    @return (output path or None, n_peaks, n_failed).  n_peaks counts the
+        rows of the peak table (each peak of a multiplet), as the
+        gammaspy-watch result store does.
+    """
+    job_id, path, chan = job["id"], job["path"], job["chan"]
+    input_hash = file_hash(path)
+    ledger.set_input_hash(job_id, owner, input_hash)
+    fitted = ledger.fitted_locs(job_id)
+    fit_kwargs = dict(settings.get("fit_kwargs") or {})
+    if fit_kwargs.get("global_method") == "multistart":
+        fit_kwargs["random_state"] = (fit_kwargs.get("random_state") or 0) + job["attempts"] - 1
+    cache = SpectrumCache(settings["cache_dir"]) if settings.get("cache_dir") else None
+    metadata, counts = reader.DataReader(cache=cache).read_counts(path, chan)
+    spec = spectrum.GammaSpectrum(metadata=metadata, counts=counts)
+
+    def skip(loc):
+        return len(fitted) > 0 and np.min(np.abs(fitted - loc)) < 1e-6
+
+    def checkpoint(peak_id, peak, error):
+        table = spec.peak_table()
+        ledger.checkpoint_peak(job_id, owner, spec.peak_bank.loc(peak_id),
+                               table[table['peak_id'] == peak_id], error, job["attempts"], lease)
+    pipeline.analyze_spectrum(spec, settings.get("cwt_settings"), fit_kwargs, skip=skip,
+                              callback=checkpoint)
+    n_failed = ledger.n_failed_peaks(job_id)
+    if n_failed and job["attempts"] < max_attempts:
+        return None, None, n_failed
+    table = ledger.peak_table(job_id)
+    output = None
+    if settings.get("out_dir"):
+        output = output_path(settings["out_dir"], path, chan, input_hash)
+        tmp = output + ".tmp"
+        reader.DataReader().write(tmp, spec.metadata, spec.counts, table, chan)
+        os.replace(tmp, output)
+    return output, len(table), n_failed
+
+
+def run_worker(ledger_path, campaign, owner=None, shard=None, n_shards=1, lease=600.,
+               max_attempts=3, backoff=30., max_backoff=3600., wait=False, max_jobs=None):
+    """!
+    @brief Process jobs of a campaign until none is due.
+    Module level so it can run in a process pool.
+    @param owner  String. Worker name (default host:pid)
+    @param wait  Bool. Sleep until pending retries are due instead of
+        returning
+    @param max_jobs  Int. Stop after this many jobs
+    @return dict of counts of done, partial, retried, dead and lost jobs
+    """
+    owner = owner or "%s:%d" % (socket.gethostname(), os.getpid())
+    ledger = JobLedger(ledger_path)
+    settings = ledger.settings(campaign)
+    if settings.get("out_dir") and not os.path.isdir(settings["out_dir"]):
+        os.makedirs(settings["out_dir"])
+    counts = {"done": 0, "partial": 0, "retried": 0, "dead": 0, "lost": 0}
+    try:
+        n_jobs = 0
+        while max_jobs is None or n_jobs < max_jobs:
+            job = ledger.claim(campaign, owner, lease, shard, n_shards, max_attempts)
+            if job is None:
+                next_retry = ledger.next_retry(campaign, shard, n_shards)
+                if not wait or next_retry is None:
+                    break
+                time.sleep(min(max(next_retry - time.time(), 0.1), 5.))
+                continue
+            n_jobs += 1
+            t0 = time.time()
+            try:
+                try:
+                    output, n_peaks, n_failed = process_job(ledger, job, settings, owner, lease,
+                                                            max_attempts)
+                except (KeyboardInterrupt, SystemExit):
+                    ledger.release(job["id"], owner)
+                    raise
+                except LeaseLost:
+                    raise
+                except Exception as e:
+                    error = "%s: %s" % (type(e).__name__, str(e))
+                    print("Job %s [%d] failed: %s" % (job["path"], job["chan"], error))
+                    retry_at = ledger.fail(job["id"], owner, error, job["attempts"], max_attempts,
+                                           backoff, max_backoff)
+                    counts["dead" if retry_at is None else "retried"] += 1
+                    continue
+                if n_peaks is None:
+                    ledger.fail(job["id"], owner, "%d peak fits failed" % n_failed, job["attempts"],
+                                max_attempts, backoff, max_backoff)
+                    counts["retried"] += 1
+                    continue
+                ledger.complete(job["id"], owner, output, n_peaks, n_failed, time.time() - t0)
+                counts["partial" if n_failed else "done"] += 1
+            except LeaseLost as e:
+                print(str(e))
+                counts["lost"] += 1
+    finally:
+        ledger.close()
+    return counts
+
+
+def _run_worker(kwargs):
+    return run_worker(**kwargs)
+
+
+def run_campaign(ledger_path, campaign, n_workers=1, **kwargs):
+    """!
+    @brief Run worker processes on a campaign until no job is due
+    @param kwargs  keyword args of run_worker
+    @return dict of summed job counts
+    """
+    if n_workers <= 1:
+        return run_worker(ledger_path, campaign, **kwargs)
+    owner = kwargs.pop("owner", None) or "%s:%d" % (socket.gethostname(), os.getpid())
+    tasks = [dict(kwargs, ledger_path=ledger_path, campaign=campaign, owner="%s/%d" % (owner, i))
+             for i in range(n_workers)]
+    total = {}
+    for counts in parallel.parallel_map(_run_worker, tasks, n_workers, "process"):
+        for key, n in counts.items():
+            total[key] = total.get(key, 0) + n
+    return total
+
+
+def find_files(paths, patterns=DEFAULT_PATTERNS):
+    """!
+    @brief Files given directly and matching files below given directories
+    """
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            files += [os.path.join(root, name) for name in sorted(names)
+                      if any(fnmatch.fnmatch(name, pattern) for pattern in patterns)]
+    return files
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Resumable spectrum (re)processing campaigns")
+    parser.add_argument("--db", default="gammaspy_jobs.sqlite", help="SQLite job ledger")
+    sub = parser.add_subparsers(dest="command")
+    add = sub.add_parser("add", help="Add files (or directories) to a campaign")
+    add.add_argument("campaign")
+    add.add_argument("paths", nargs="+")
+    add.add_argument("--chan", type=int, action="append", default=None, help="Channel (repeatable)")
+    add.add_argument("--pattern", action="append", default=None,
+                     help="File name pattern in directories (repeatable), default: *.CNF *.h5")
+    add.add_argument("--out-dir", default=None, help="Directory of the result HDF5 files")
+    add.add_argument("--cache-dir", default=None, help="Parsed CNF file cache directory")
+    add.add_argument("--maxiter", type=int, default=100, help="Basin hopping iterations per fit")
+    add.add_argument("--global-method", default=None, help="basinhopping or multistart")
+    add.add_argument("--triage", action="store_true",
+                     help="Triage peak candidates before fitting (default: fit all)")
+    run = sub.add_parser("run", help="Work on a campaign until no job is due")
+    run.add_argument("campaign")
+    run.add_argument("--workers", type=int, default=1, help="Number of worker processes")
+    run.add_argument("--shard", default=None, help="k/n: only process shard k of n")
+    run.add_argument("--lease", type=float, default=600., help="Job lease (s)")
+    run.add_argument("--max-attempts", type=int, default=3)
+    run.add_argument("--backoff", type=float, default=30., help="First retry delay (s)")
+    run.add_argument("--max-backoff", type=float, default=3600.)
+    run.add_argument("--wait", action="store_true", help="Wait for pending retries")
+    status = sub.add_parser("status", help="Job counts by state")
+    status.add_argument("campaign")
+    retry = sub.add_parser("retry", help="Requeue partial and dead jobs")
+    retry.add_argument("campaign")
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.error("a command is required")
+
+    if args.command == "run":
+        shard, n_shards = None, 1
+        if args.shard:
+            shard, n_shards = [int(v) for v in args.shard.split("/")]
+        counts = run_campaign(args.db, args.campaign, args.workers, shard=shard,
+                              n_shards=n_shards, lease=args.lease, max_attempts=args.max_attempts,
+                              backoff=args.backoff, max_backoff=args.max_backoff, wait=args.wait)
+        print(json.dumps(counts))
+        return
+    ledger = JobLedger(args.db)
+    try:
+        if args.command == "add":
+            fit_kwargs = {"maxiter": args.maxiter}
+            if args.global_method:
+                fit_kwargs["global_method"] = args.global_method
+            settings = ledger.add_campaign(args.campaign, {
+                "fit_kwargs": fit_kwargs, "cwt_settings": {"triage": args.triage},
+                "out_dir": os.path.abspath(args.out_dir) if args.out_dir else None,
+                "cache_dir": args.cache_dir})
+            files = find_files(args.paths, args.pattern or DEFAULT_PATTERNS)
+            n_new = ledger.add_jobs(args.campaign, files, args.chan or [0])
+            print("%d new jobs in campaign %s (%s)" % (n_new, args.campaign, json.dumps(settings)))
+        elif args.command == "status":
+            print(json.dumps(ledger.status(args.campaign)))
+        elif args.command == "retry":
+            print("%d jobs requeued" % ledger.retry(args.campaign))
+    finally:
+        ledger.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,385 @@
+"""!
+@brief gammaspy-server: local analysis server.
+A small asyncio HTTP/1.1 server (TCP on localhost or a Unix socket) that
+runs peak search and fits in a pool of warm worker processes, so clients
+do not pay the interpreter and scipy start up cost per spectrum.
+
+Endpoints (all results are JSON):
+    GET  /health   server counters
+    POST /read     spectrum metadata and raw counts of a file
+    POST /peaks    CWT peak search
+    POST /fit      fit of given peaks (locs) or of all found peaks
+The spectrum is sent either as a .npy payload (Content-Type
+application/x-npy; an (n, 2) [energy, counts / keV] array or an (n,)
+count array with e_cal given) with options in the query string, or as a
+JSON body {"path": file, "chan": 0, ...options}.
+Options: e_cal, l_time, r_time, chan, locs, cwt (dict of find_cwt_peaks
+args), fit (dict of Roi.fit_new args).  Query values are JSON decoded.
+
+Requests arriving within batch_window of each other are sent to a worker
+as one batch.  At most max_queue requests wait for a worker, further
+requests are answered with 503.
+"""
+from __future__ import print_function
+import argparse
+import asyncio
+import io
+import json
+import os
+import sys
+import time
+from six.moves.urllib.parse import urlsplit, parse_qsl
+import numpy as np
+from gammaspy.gammaData import parallel
+
+MAX_BODY = 64 * 1024 ** 2
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+               413: "Payload Too Large", 500: "Internal Server Error",
+               503: "Service Unavailable"}
+
+
+class RequestError(Exception):
+    def __init__(self, status, msg):
+        super(RequestError, self).__init__(msg)
+        self.status = status
+
+
+def _json_default(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, bytes):
+        return value.decode()
+    raise TypeError("%s is not JSON serializable" % type(value))
+
+
+# ---- worker side ------------------------------------------------------------ #
+def warm_worker(quiet=True):
+    """!
+    @brief Process pool initializer: import the analysis modules once and
+    silence the fit progress output.
+    """
+    import scipy.optimize  # noqa: F401
+    import gammaspy.gammaData.pipeline  # noqa: F401
+    if quiet:
+        sys.stdout = open(os.devnull, "w")
+
+
+def _peak_rows(table):
+    return [dict(zip(table.dtype.names, row.item())) for row in table]
+
+
+def run_job(job):
+    """!
+    @brief Run one request in a worker.
+    @param job  dict with keys op ("read", "peaks" or "fit"), spectrum
+        (np_array or None), path, chan, cache and the request options
+    @return JSON serializable dict
+    """
+    from gammaspy.gammaData import calibration, pipeline, reader, spectrum
+    t0 = time.time()
+    opts = job["options"]
+    metadata = {key: opts[key] for key in ("e_cal", "l_time", "r_time") if key in opts}
+    # warm workers serve unrelated clients: never learn shapes across requests
+    shape_cal = calibration.ShapeCalibration()
+    if job.get("path") is not None:
+        file_md, counts = reader.DataReader(cache=job.get("cache")).read_counts(
+            job["path"], int(opts.get("chan", 0)))
+        file_md.update(metadata)
+        spec = spectrum.GammaSpectrum(metadata=file_md, counts=counts, shape_cal=shape_cal)
+    elif job["spectrum"].ndim == 1:
+        spec = spectrum.GammaSpectrum(metadata=metadata, counts=job["spectrum"],
+                                      shape_cal=shape_cal)
+    else:
+        spec = spectrum.GammaSpectrum(np.asarray(job["spectrum"], dtype=float), metadata,
+                                      shape_cal=shape_cal)
+    result = {"metadata": spec.metadata}
+    if job["op"] == "read":
+        result["counts"] = np.asarray(spec.counts)
+    elif job["op"] == "peaks":
+        result["peaks"] = spec.find_cwt_peaks(**opts.get("cwt", {}))
+    elif job["op"] == "fit":
+        pipeline.analyze_spectrum(spec, opts.get("cwt"), opts.get("fit"), opts.get("locs"))
+        result["peaks"] = _peak_rows(spec.peak_table())
+    else:
+        raise ValueError("Unknown operation %s" % job["op"])
+    result["elapsed"] = time.time() - t0
+    return result
+
+
+def run_batch(jobs):
+    """!
+    @brief Run a batch of jobs in one worker call.  A failing job does not
+    affect the others.
+    @return list of (ok, result or error message)
+    """
+    results = []
+    for job in jobs:
+        try:
+            results.append((True, run_job(job)))
+        except Exception as e:
+            results.append((False, "%s: %s" % (type(e).__name__, str(e))))
+    return results
+
+
+# ---- server side ------------------------------------------------------------ #
+class Batcher(object):
+    """!
+    @brief Groups queued jobs into batches and runs them on the executor.
+    @param max_batch  Int. Max jobs per batch
+    @param window  Float. Time (s) to wait for more jobs after the first
+    @param max_in_flight  Int. Max batches running at once
+    @param max_queue  Int. Max jobs waiting for a batch
+    """
+    def __init__(self, executor, max_batch=8, window=0.005, max_in_flight=4, max_queue=256):
+        self.executor = executor
+        self.max_batch = max_batch
+        self.window = window
+        self.max_in_flight = max_in_flight
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.slots = asyncio.Semaphore(max_in_flight)
+        self.n_batches = 0
+        self.n_jobs = 0
+        self.in_flight = 0
+
+    async def submit(self, job):
+        """!
+        @brief Queue a job and wait for its result.
+        @raise RequestError (503) if the queue is full
+        """
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((job, future))
+        except asyncio.QueueFull:
+            raise RequestError(503, "Server busy, %d requests queued" % self.queue.qsize())
+        ok, result = await future
+        if not ok:
+            raise RequestError(400, result)
+        return result
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self.slots.acquire()
+            self.in_flight += 1
+            self.n_batches += 1
+            self.n_jobs += len(batch)
+            task = loop.run_in_executor(self.executor, run_batch, [job for job, _ in batch])
+            task.add_done_callback(lambda t, b=batch: self._done(t, b))
+
+    def _done(self, task, batch):
+        self.in_flight -= 1
+        self.slots.release()
+        if task.exception() is not None:
+            results = [(False, "Worker failed: %s" % str(task.exception()))] * len(batch)
+        else:
+            results = task.result()
+        for (job, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+class AnalysisServer(object):
+    """!
+    @brief HTTP front end of the worker pool.
+    @param n_workers  Int. Number of worker processes
+    @param cache  cache.SpectrumCache used by the workers to read CNF files
+    """
+    def __init__(self, n_workers=None, max_batch=8, batch_window=0.005, max_queue=256,
+                 cache=None, quiet=True, backend="process"):
+        self.n_workers = n_workers or parallel.default_workers()
+        self.executor = parallel.make_executor(self.n_workers, backend, warm_worker, (quiet,))
+        self.batcher = Batcher(self.executor, max_batch, batch_window, 2 * self.n_workers,
+                               max_queue)
+        self.cache = cache
+        self.start = time.time()
+        self.n_requests = 0
+        self.n_errors = 0
+        self._tasks = []
+
+    def warm_up(self):
+        """!
+        @brief Start all workers now instead of on the first requests
+        """
+        futures = [self.executor.submit(run_batch, []) for _ in range(self.n_workers)]
+        for future in futures:
+            future.result()
+
+    def stats(self):
+        return {"status": "ok", "uptime": time.time() - self.start, "workers": self.n_workers,
+                "requests": self.n_requests, "errors": self.n_errors,
+                "queued": self.batcher.queue.qsize(), "batches_in_flight": self.batcher.in_flight,
+                "batches": self.batcher.n_batches, "jobs": self.batcher.n_jobs}
+
+    def parse_job(self, op, query, headers, body):
+        options = {}
+        for key, val in parse_qsl(query):
+            try:
+                options[key] = json.loads(val)
+            except ValueError:
+                options[key] = val
+        content_type = headers.get("content-type", "").split(";")[0].strip()
+        job = {"op": op, "spectrum": None, "path": None, "cache": self.cache}
+        if content_type in ("application/x-npy", "application/octet-stream"):
+            try:
+                job["spectrum"] = np.load(io.BytesIO(body), allow_pickle=False)
+            except (ValueError, OSError) as e:
+                raise RequestError(400, "Invalid npy payload: %s" % str(e))
+            if job["spectrum"].ndim == 1 and "e_cal" not in options:
+                raise RequestError(400, "Count arrays require an e_cal option")
+        else:
+            try:
+                request = json.loads(body.decode() or "{}")
+            except ValueError as e:
+                raise RequestError(400, "Invalid JSON body: %s" % str(e))
+            if not isinstance(request, dict):
+                raise RequestError(400, "The JSON body must be an object")
+            if "path" not in request:
+                raise RequestError(400, "Send a npy payload or a JSON body with a path")
+            job["path"] = request.pop("path")
+            options.update(request)
+        job["options"] = options
+        return job
+
+    async def dispatch(self, method, target, headers, body):
+        url = urlsplit(target)
+        if url.path == "/health":
+            return 200, self.stats()
+        op = url.path.strip("/")
+        if op not in ("read", "peaks", "fit"):
+            raise RequestError(404, "Unknown endpoint %s" % url.path)
+        if method != "POST":
+            raise RequestError(405, "Use POST for %s" % url.path)
+        return 200, await self.batcher.submit(self.parse_job(op, url.query, headers, body))
+
+    async def handle(self, reader, writer):
+        """!
+        @brief Serve the requests of one connection (HTTP/1.1 keep alive)
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                keep_alive = False
+                try:
+                    try:
+                        method, target, version = request_line.decode("latin-1").split()
+                    except ValueError:
+                        raise RequestError(400, "Malformed request line")
+                    headers = {}
+                    while True:
+                        line = await reader.readline()
+                        if line in (b"\r\n", b"\n", b""):
+                            break
+                        key, _, val = line.decode("latin-1").partition(":")
+                        headers[key.strip().lower()] = val.strip()
+                    keep_alive = version == "HTTP/1.1" and \
+                        headers.get("connection", "").lower() != "close"
+                    try:
+                        length = int(headers.get("content-length", 0))
+                    except ValueError:
+                        length = -1
+                    if length < 0:
+                        # the body cannot be delimited, drop the connection after the reply
+                        keep_alive = False
+                        raise RequestError(400, "Invalid Content-Length")
+                    if length > MAX_BODY:
+                        keep_alive = False
+                        raise RequestError(413, "Payload larger than %d bytes" % MAX_BODY)
+                    body = await reader.readexactly(length) if length else b""
+                    self.n_requests += 1
+                    status, payload = await self.dispatch(method, target, headers, body)
+                except RequestError as e:
+                    self.n_errors += 1
+                    status, payload = e.status, {"error": str(e)}
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    raise
+                except Exception as e:
+                    # a bug must not drop the connection without a reply
+                    self.n_errors += 1
+                    keep_alive = False
+                    print("Request failed: %s: %s" % (type(e).__name__, str(e)))
+                    status, payload = 500, {"error": "%s: %s" % (type(e).__name__, str(e))}
+                await self.respond(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, payload, keep_alive):
+        data = json.dumps(payload, default=_json_default).encode()
+        head = "HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n" \
+               "Connection: %s\r\n\r\n" % (status, STATUS_TEXT.get(status, ""), len(data),
+                                           "keep-alive" if keep_alive else "close")
+        writer.write(head.encode("latin-1") + data)
+        await writer.drain()
+
+    async def serve(self, host="127.0.0.1", port=8765, unix_path=None):
+        """!
+        @brief Run the server until cancelled
+        """
+        self._tasks.append(asyncio.ensure_future(self.batcher.run()))
+        if unix_path is not None:
+            server = await asyncio.start_unix_server(self.handle, unix_path)
+            print("GammaSpy server listening on %s" % unix_path)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+            print("GammaSpy server listening on http://%s:%d" % (host, port))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in self._tasks:
+                task.cancel()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="GammaSpy analysis server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix", default=None, help="Listen on this Unix socket instead")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes")
+    parser.add_argument("--max-batch", type=int, default=8, help="Max requests per batch")
+    parser.add_argument("--batch-window", type=float, default=0.005,
+                        help="Time (s) to collect a batch")
+    parser.add_argument("--max-queue", type=int, default=256, help="Max queued requests")
+    parser.add_argument("--cache-dir", default=None, help="Parsed CNF file cache directory")
+    parser.add_argument("--verbose", action="store_true", help="Show worker fit output")
+    args = parser.parse_args(argv)
+
+    cache = None
+    if args.cache_dir:
+        from gammaspy.gammaData.cache import SpectrumCache
+        cache = SpectrumCache(args.cache_dir)
+    server = AnalysisServer(args.workers, args.max_batch, args.batch_window, args.max_queue,
+                            cache, quiet=not args.verbose)
+    server.warm_up()
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        if args.unix and os.path.exists(args.unix):
+            os.remove(args.unix)
+
+
+if __name__ == "__main__":
+    main()
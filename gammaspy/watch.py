@@ -0,0 +1,410 @@
+"""!
+@brief gammaspy-watch: analyze spectrum files as the detectors write them.
+Watched directories are scanned with inotify (if the inotify_simple
+package is installed) or by polling.  A file is analyzed once its size and
+mtime have been stable for the settle time.  Ready files are queued on a
+bounded queue and analyzed by a worker pool (gammaData.pipeline); results
+are stored in an SQLite database.  When the queue is full no new files are
+taken from the watcher until the workers catch up.
+"""
+from __future__ import print_function
+import argparse
+import collections
+import fnmatch
+import json
+import os
+import signal
+import sqlite3
+import threading
+import time
+from concurrent.futures import wait, FIRST_COMPLETED
+from gammaspy.gammaData import parallel, pipeline, spectrum
+from gammaspy.gammaData.cache import SpectrumCache
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+DEFAULT_PATTERNS = ("*.CNF", "*.cnf", "*.h5", "*.hdf5")
+
+
+class DirectoryWatcher(object):
+    """!
+    @brief Reports new or modified spectrum files once they are completely
+    written.
+    @param dirs  list of directories
+    @param patterns  list of file name glob patterns
+    @param settle_time  Float. Time (s) a file's size and mtime must be
+        unchanged before it is reported
+    @param recursive  Bool. Also watch sub directories (polling only)
+    @param use_inotify  Bool. Use inotify events instead of full rescans
+        when available
+    @param rescan_interval  Float. Time (s) between full rescans in inotify
+        mode (catches overflowed event queues)
+    """
+    def __init__(self, dirs, patterns=DEFAULT_PATTERNS, settle_time=2., recursive=False,
+                 use_inotify=True, rescan_interval=60.):
+        self.dirs = [os.path.abspath(d) for d in dirs]
+        self.patterns = list(patterns)
+        self.settle_time = settle_time
+        self.recursive = recursive
+        self.rescan_interval = rescan_interval
+        # path -> ((size, mtime_ns), time the file was last seen changing)
+        self.candidates = {}
+        # path -> (size, mtime_ns) when reported
+        self.reported = {}
+        self.inotify = None
+        self._wd_dirs = {}
+        self._last_scan = None
+        if use_inotify and inotify_simple is not None and not recursive:
+            self.inotify = inotify_simple.INotify()
+            flags = inotify_simple.flags.CLOSE_WRITE | inotify_simple.flags.MOVED_TO | \
+                inotify_simple.flags.MODIFY | inotify_simple.flags.CREATE
+            for d in self.dirs:
+                self._wd_dirs[self.inotify.add_watch(d, flags)] = d
+
+    def _matches(self, name):
+        return any(fnmatch.fnmatchcase(name, pattern) for pattern in self.patterns)
+
+    def scan(self):
+        """!
+        @brief All matching files in the watched directories
+        """
+        paths = []
+        for d in self.dirs:
+            if self.recursive:
+                for root, _, names in os.walk(d):
+                    paths.extend(os.path.join(root, name) for name in names if self._matches(name))
+            else:
+                try:
+                    paths.extend(entry.path for entry in os.scandir(d)
+                                 if entry.is_file() and self._matches(entry.name))
+                except OSError as e:
+                    print("WARNING: cannot scan %s: %s" % (d, str(e)))
+        return paths
+
+    def _changed_paths(self, now):
+        if self.inotify is None or self._last_scan is None or \
+                now - self._last_scan > self.rescan_interval:
+            self._last_scan = now
+            if self.inotify is not None:
+                self.inotify.read(timeout=0)
+            return self.scan()
+        paths = []
+        for event in self.inotify.read(timeout=0):
+            if event.name and self._matches(event.name):
+                paths.append(os.path.join(self._wd_dirs[event.wd], event.name))
+        return paths
+
+    def poll(self, max_files=None):
+        """!
+        @brief Check for files that are ready for analysis.  Does not block.
+        @param max_files  Int. Max number of files to report.  Ready files
+            beyond this are reported by a later poll.
+        @return list of paths, oldest first
+        """
+        now = time.time()
+        to_check = set(self._changed_paths(now)) | set(self.candidates)
+        ready = []
+        for path in to_check:
+            try:
+                st = os.stat(path)
+            except OSError:
+                self.candidates.pop(path, None)
+                continue
+            key = (st.st_size, st.st_mtime_ns)
+            if self.reported.get(path) == key:
+                self.candidates.pop(path, None)
+                continue
+            prev = self.candidates.get(path)
+            if prev is None or prev[0] != key:
+                # files not modified for settle_time are ready on first sight
+                changed_at = min(now, st.st_mtime) if prev is None else now
+                self.candidates[path] = (key, changed_at)
+            if now - self.candidates[path][1] >= self.settle_time and st.st_size > 0:
+                ready.append((st.st_mtime, path))
+        ready = [path for mtime, path in sorted(ready)][:max_files]
+        for path in ready:
+            self.reported[path] = self.candidates.pop(path)[0]
+        return ready
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+
+
+class ResultStore(object):
+    """!
+    @brief SQLite store of analyzed files and their fitted peaks.
+    Only used from the service thread.
+    """
+    peak_columns = [name for name, dtype in spectrum.PEAK_TABLE_DTYPE]
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS files (path TEXT, chan INTEGER, size INTEGER, "
+            "mtime REAL, status TEXT, error TEXT, analyzed_at REAL, elapsed REAL, "
+            "l_time REAL, r_time REAL, e_cal TEXT, n_peaks INTEGER, PRIMARY KEY (path, chan))")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS peaks (path TEXT, chan INTEGER, %s)" %
+            ", ".join("%s %s" % (name, "INTEGER" if name == "peak_id" else "REAL")
+                      for name in self.peak_columns))
+        self.conn.execute("CREATE INDEX IF NOT EXISTS peaks_path ON peaks (path, chan)")
+        self.conn.commit()
+
+    def is_done(self, path, size, mtime, chan=0):
+        """!
+        @brief True if this version of the file was already analyzed
+        """
+        row = self.conn.execute("SELECT size, mtime FROM files WHERE path=? AND chan=?",
+                                (os.path.abspath(path), chan)).fetchone()
+        return row is not None and row[0] == size and row[1] == mtime
+
+    def add_result(self, result):
+        """!
+        @brief Store the result dict of pipeline.analyze_file
+        """
+        md = result["metadata"]
+        peaks = result["peaks"]
+        with self.conn:
+            self.conn.execute("DELETE FROM peaks WHERE path=? AND chan=?",
+                              (result["path"], result["chan"]))
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, 'ok', NULL, ?, ?, ?, ?, ?, ?)",
+                (result["path"], result["chan"], result["size"], result["mtime"], time.time(),
+                 result["elapsed"], md.get("l_time"), md.get("r_time"),
+                 json.dumps([float(c) for c in md.get("e_cal", [])]), len(peaks)))
+            self.conn.executemany(
+                "INSERT INTO peaks VALUES (?, ?, %s)" % ", ".join("?" * len(self.peak_columns)),
+                [(result["path"], result["chan"]) + tuple(row.item()) for row in peaks])
+
+    def add_failure(self, path, size, mtime, error, chan=0):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files "
+                "(path, chan, size, mtime, status, error, analyzed_at) "
+                "VALUES (?, ?, ?, ?, 'failed', ?, ?)",
+                (os.path.abspath(path), chan, size, mtime, error, time.time()))
+
+    def close(self):
+        self.conn.close()
+
+
+class Counters(object):
+    """!
+    @brief Throughput and queue counters of the service
+    @param window  Float. Time window (s) of the throughput estimate
+    """
+    def __init__(self, window=60.):
+        self.window = window
+        self.start = time.time()
+        self.counts = collections.Counter()
+        self.done_times = collections.deque()
+        self.total_latency = 0.
+        self.total_elapsed = 0.
+
+    def incr(self, name, n=1):
+        self.counts[name] += n
+
+    def record_done(self, latency, elapsed):
+        now = time.time()
+        self.done_times.append(now)
+        self.total_latency += latency
+        self.total_elapsed += elapsed
+
+    def snapshot(self, queue_depth=0, in_flight=0):
+        now = time.time()
+        while self.done_times and now - self.done_times[0] > self.window:
+            self.done_times.popleft()
+        n_done = self.counts["files_done"]
+        span = min(self.window, max(now - self.start, 1e-9))
+        stats = dict(self.counts)
+        stats.update({"queue_depth": queue_depth, "in_flight": in_flight,
+                      "uptime": now - self.start,
+                      "files_per_min": 60. * len(self.done_times) / span,
+                      "mean_latency": self.total_latency / n_done if n_done else 0.,
+                      "mean_analysis_time": self.total_elapsed / n_done if n_done else 0.})
+        return stats
+
+
+class WatchService(object):
+    """!
+    @brief Feeds files reported by a DirectoryWatcher to a worker pool and
+    stores the results.
+    @param watcher  DirectoryWatcher
+    @param store  ResultStore
+    @param n_workers  Int. Number of analysis workers
+    @param max_queue  Int. Max number of ready files waiting for a worker
+    @param backend  String. "process" or "thread"
+    @param analysis_kwargs  dict of keyword args of pipeline.analyze_file
+    @param poll_interval  Float. Time (s) between watcher polls
+    @param stats_file  String. JSON file the counters are written to
+    @param stats_interval  Float. Time (s) between counter reports
+    """
+    def __init__(self, watcher, store, n_workers=None, max_queue=100, backend="process",
+                 analysis_kwargs=None, poll_interval=1., stats_file=None, stats_interval=10.):
+        self.watcher = watcher
+        self.store = store
+        self.n_workers = n_workers or parallel.default_workers()
+        self.max_queue = max_queue
+        self.max_in_flight = 2 * self.n_workers
+        self.backend = backend
+        self.analysis_kwargs = analysis_kwargs or {}
+        self.poll_interval = poll_interval
+        self.stats_file = stats_file
+        self.stats_interval = stats_interval
+        self.counters = Counters()
+        self.pending = collections.deque()
+        self.in_flight = {}
+        self.executor = None
+        self._stop = threading.Event()
+        self._last_stats = time.time()
+
+    def stats(self):
+        return self.counters.snapshot(len(self.pending), len(self.in_flight))
+
+    def _enqueue(self):
+        room = self.max_queue - len(self.pending)
+        if room <= 0:
+            self.counters.incr("backpressure_polls")
+            return
+        for path in self.watcher.poll(room):
+            self.counters.incr("files_seen")
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if self.store.is_done(path, st.st_size, st.st_mtime):
+                self.counters.incr("files_skipped")
+                continue
+            self.pending.append((path, st.st_size, st.st_mtime, time.time()))
+            self.counters.incr("files_queued")
+
+    def _dispatch(self):
+        while self.pending and len(self.in_flight) < self.max_in_flight:
+            item = self.pending.popleft()
+            future = self.executor.submit(pipeline.analyze_file, item[0], **self.analysis_kwargs)
+            self.in_flight[future] = item
+
+    def _collect(self, timeout):
+        if not self.in_flight:
+            self._stop.wait(timeout)
+            return
+        done, _ = wait(list(self.in_flight), timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            path, size, mtime, t_queued = self.in_flight.pop(future)
+            try:
+                result = future.result()
+                self.store.add_result(result)
+                self.counters.incr("files_done")
+                self.counters.incr("peaks_fitted", len(result["peaks"]))
+                self.counters.record_done(time.time() - t_queued, result["elapsed"])
+                print("Analyzed %s: %d peaks in %.2f s" % (path, len(result["peaks"]),
+                                                           result["elapsed"]))
+            except Exception as e:
+                self.store.add_failure(path, size, mtime, "%s: %s" % (type(e).__name__, str(e)))
+                self.counters.incr("files_failed")
+                print("Analysis of %s failed: %s" % (path, str(e)))
+
+    def _report(self, force=False):
+        now = time.time()
+        if not force and now - self._last_stats < self.stats_interval:
+            return
+        self._last_stats = now
+        stats = self.stats()
+        print("queue=%d in_flight=%d done=%d failed=%d files/min=%.1f" %
+              (stats["queue_depth"], stats["in_flight"], stats.get("files_done", 0),
+               stats.get("files_failed", 0), stats["files_per_min"]))
+        if self.stats_file:
+            tmp_path = self.stats_file + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(stats, f)
+            os.replace(tmp_path, self.stats_file)
+
+    def step(self):
+        """!
+        @brief One iteration: poll, dispatch, collect finished analyses
+        """
+        self._enqueue()
+        self._dispatch()
+        self._collect(self.poll_interval)
+        self._report()
+
+    def idle(self):
+        return not (self.pending or self.in_flight or self.watcher.candidates)
+
+    def stop(self, *args):
+        self._stop.set()
+
+    def run(self, once=False):
+        """!
+        @brief Run until stop() (or SIGINT / SIGTERM) is received.
+        @param once  Bool. Return when all files present have been analyzed
+        """
+        handlers = {}
+        if threading.current_thread() is threading.main_thread():
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                handlers[sig] = signal.signal(sig, self.stop)
+        self.executor = parallel.make_executor(self.n_workers, self.backend)
+        try:
+            while not self._stop.is_set():
+                self.step()
+                if once and self.idle():
+                    break
+        finally:
+            for future in self.in_flight:
+                future.cancel()
+            self.executor.shutdown(wait=True)
+            self._report(force=True)
+            for sig, handler in handlers.items():
+                signal.signal(sig, handler)
+        return self.stats()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Analyze gamma spectra as they are written")
+    parser.add_argument("dirs", nargs="+", help="Directories to watch")
+    parser.add_argument("--db", default="gammaspy_results.sqlite", help="SQLite results store")
+    parser.add_argument("--workers", type=int, default=None, help="Number of analysis workers")
+    parser.add_argument("--max-queue", type=int, default=100, help="Max number of queued files")
+    parser.add_argument("--poll", type=float, default=1., help="Poll interval (s)")
+    parser.add_argument("--settle", type=float, default=2.,
+                        help="Time (s) a file must be unchanged before it is analyzed")
+    parser.add_argument("--pattern", action="append", default=None,
+                        help="File name pattern (repeatable), default: *.CNF *.h5")
+    parser.add_argument("--recursive", action="store_true", help="Watch sub directories")
+    parser.add_argument("--no-inotify", action="store_true", help="Always poll")
+    parser.add_argument("--threads", action="store_true", help="Use threads instead of processes")
+    parser.add_argument("--cache-dir", default=None, help="Parsed CNF file cache directory")
+    parser.add_argument("--maxiter", type=int, default=100, help="Basin hopping iterations per fit")
+    parser.add_argument("--triage", action="store_true",
+                        help="Triage peak candidates before fitting (default: fit all)")
+    parser.add_argument("--stats-file", default=None, help="JSON file for the service counters")
+    parser.add_argument("--stats-interval", type=float, default=10.)
+    parser.add_argument("--once", action="store_true", help="Analyze existing files and exit")
+    args = parser.parse_args(argv)
+
+    watcher = DirectoryWatcher(args.dirs, args.pattern or DEFAULT_PATTERNS, args.settle,
+                               args.recursive, not args.no_inotify)
+    store = ResultStore(args.db)
+    analysis_kwargs = {"fit_kwargs": {"maxiter": args.maxiter},
+                       "cwt_settings": {"triage": args.triage}}
+    if args.cache_dir:
+        analysis_kwargs["cache"] = SpectrumCache(args.cache_dir)
+    service = WatchService(watcher, store, args.workers, args.max_queue,
+                           "thread" if args.threads else "process", analysis_kwargs,
+                           args.poll, args.stats_file, args.stats_interval)
+    print("Watching %s (%s)" % (", ".join(watcher.dirs),
+                                "inotify" if watcher.inotify is not None else "polling"))
+    try:
+        service.run(once=args.once)
+    finally:
+        watcher.close()
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
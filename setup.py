@@ -14,6 +14,9 @@ setup(name='GammaSpy',
       entry_points={
           'console_scripts': [
               'gammaspy = gammaspy.gamma_gui:main',
+              'gammaspy-watch = gammaspy.watch:main',
+              'gammaspy-server = gammaspy.server:main',
+              'gammaspy-jobs = gammaspy.jobs:main',
           ]
       }
 )
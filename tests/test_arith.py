@@ -0,0 +1,124 @@
+"""!
+@brief Tests of spectrum arithmetic
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import h5py
+import numpy as np
+from gammaspy.gammaData import arith
+
+
+class TestRebin(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.edges = np.linspace(0., 100., 201)
+        self.counts = rng.poisson(50., size=(3, 200)).astype(float)
+
+    def test_conserves_counts(self):
+        for new_edges in (np.linspace(0., 100., 71), np.linspace(0., 100., 1001),
+                          np.sort(np.random.RandomState(1).uniform(0., 100., 50))):
+            new_edges = np.concatenate(([0.], new_edges[(new_edges > 0.) & (new_edges < 100.)],
+                                        [100.]))
+            mat = arith.rebin_matrix(self.edges, new_edges)
+            self.assertEqual(mat.shape, (len(new_edges) - 1, 200))
+            # every old bin is split completely among the new bins
+            np.testing.assert_allclose(np.asarray(mat.sum(axis=0)).ravel(), 1.)
+            new_counts, new_var = arith.rebin(self.counts, self.edges, new_edges)
+            np.testing.assert_allclose(new_counts.sum(axis=1), self.counts.sum(axis=1))
+            self.assertTrue(np.all(new_var <= new_counts + 1e-9))
+
+    def test_partial_overlap(self):
+        # only the overlapping energy range is conserved
+        new_edges = np.linspace(25.25, 150., 126)
+        new_counts, _ = arith.rebin(self.counts[0], self.edges, new_edges)
+        self.assertAlmostEqual(new_counts.sum(),
+                               self.counts[0, 51:].sum() + 0.5 * self.counts[0, 50])
+        np.testing.assert_allclose(new_counts[new_edges[:-1] >= 100.], 0.)
+
+    def test_identity(self):
+        new_counts, new_var = arith.rebin(self.counts, self.edges, self.edges)
+        np.testing.assert_allclose(new_counts, self.counts)
+        np.testing.assert_allclose(new_var, self.counts)
+
+    def test_round_trip(self):
+        spec = arith.to_spectrum(self.edges, self.counts[0])
+        np.testing.assert_allclose(arith.to_counts(spec), self.counts[0])
+
+
+class TestSpectrumStack(unittest.TestCase):
+    def setUp(self):
+        self.edges = np.linspace(0., 100., 101)
+        self.sample = arith.SpectrumStack(self.edges, np.full((2, 100), 40.),
+                                          live_time=[100., 200.])
+        self.background = arith.SpectrumStack(self.edges, np.full(100, 10.), live_time=[50.])
+
+    def test_subtract(self):
+        net = self.sample.subtract(self.background)
+        # N = S - (t_S / t_B) B and var = S + (t_S / t_B)^2 B
+        np.testing.assert_allclose(net.counts[0], 40. - 2. * 10.)
+        np.testing.assert_allclose(net.counts[1], 40. - 4. * 10.)
+        np.testing.assert_allclose(net.variance[0], 40. + 4. * 10.)
+        np.testing.assert_allclose(net.variance[1], 40. + 16. * 10.)
+        np.testing.assert_allclose(net.live_time, self.sample.live_time)
+
+    def test_subtract_conserves_counts_on_other_grid(self):
+        # a background on a finer, shifted grid is rebinned without
+        # losing counts in the common range
+        bg_edges = np.linspace(0.3, 100.3, 301)
+        background = arith.SpectrumStack(bg_edges, np.full(300, 3.), live_time=[100.])
+        net = self.sample.subtract(background)
+        bg_in_range = 3. * 300 * (100. - 0.3) / 100.
+        np.testing.assert_allclose(net.counts.sum(axis=1),
+                                   self.sample.counts.sum(axis=1) -
+                                   np.array([1., 2.]) * bg_in_range)
+
+    def test_subtract_self_is_zero(self):
+        net = self.background.subtract(self.background)
+        np.testing.assert_allclose(net.counts, 0.)
+        np.testing.assert_allclose(net.variance, 2. * self.background.variance)
+
+    def test_total_and_window(self):
+        total = self.sample.total()
+        np.testing.assert_allclose(total.counts.sum(), self.sample.counts.sum())
+        np.testing.assert_allclose(total.live_time, [300.])
+        counts, variance = self.sample.window_counts([(10., 20.), (0.5, 1.)])
+        np.testing.assert_allclose(counts, [[400., 20.], [400., 20.]])
+        np.testing.assert_allclose(variance, [[400., 10.], [400., 10.]])
+
+
+class TestAggregateHDF5(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmpdir, "spectra.h5")
+        self.edges = np.linspace(0., 100., 101)
+        self.live_times = [100., 200., 300.]
+        spec = arith.to_spectrum(self.edges, np.full(100, 40.))
+        with h5py.File(self.fname, "w") as h5f:
+            for chan, l_time in enumerate(self.live_times):
+                grp = h5f.create_group(str(chan))
+                grp.create_dataset("spectrum", data=spec)
+                grp.create_dataset("l_time", data=l_time)
+        self.background = arith.SpectrumStack(self.edges, np.full(100, 10.), live_time=[50.])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_background_subtracted_once(self):
+        sources = [(self.fname, chan) for chan in range(3)]
+        total, w_counts, w_var, live_times = arith.aggregate_hdf5(
+            sources, self.edges, chunk_size=2, windows=[(10., 20.)], background=self.background)
+        # the background scales with the summed live time: 600 s / 50 s
+        np.testing.assert_allclose(total.counts[0], 3. * 40. - 12. * 10.)
+        np.testing.assert_allclose(total.variance[0], 3. * 40. + 12. ** 2. * 10.)
+        np.testing.assert_allclose(total.live_time, [600.])
+        # the per spectrum series is net of the background as well
+        scale = np.array(self.live_times) / 50.
+        np.testing.assert_allclose(w_counts[:, 0], 10. * (40. - scale * 10.))
+        np.testing.assert_allclose(w_var[:, 0], 10. * (40. + scale ** 2. * 10.))
+        np.testing.assert_allclose(live_times, self.live_times)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,155 @@
+"""!
+@brief Tests of the resumable job ledger
+"""
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import numpy as np
+from gammaspy import jobs
+from gammaspy.gammaData import spectrum
+
+
+def peak_rows(loc, means):
+    """!
+    @brief Peak table rows of one ROI at loc with peaks at means
+    """
+    rows = np.zeros(len(means), dtype=spectrum.PEAK_TABLE_DTYPE)
+    rows['peak_id'] = 1
+    rows['loc'] = loc
+    rows['mean'] = means
+    rows['area'] = 100.
+    return rows
+
+
+class TestJobLedger(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.ledger = jobs.JobLedger(os.path.join(self.tmp_dir, "jobs.sqlite"))
+        self.ledger.add_campaign("c", {"fit_kwargs": {"maxiter": 5}})
+        self.paths = [os.path.join(self.tmp_dir, "s%d.CNF" % i) for i in range(3)]
+        self.assertEqual(self.ledger.add_jobs("c", self.paths), 3)
+
+    def tearDown(self):
+        self.ledger.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_campaign(self):
+        # settings and jobs of an existing campaign are kept
+        self.assertEqual(self.ledger.add_campaign("c", {"fit_kwargs": {}}),
+                         {"fit_kwargs": {"maxiter": 5}})
+        self.assertEqual(self.ledger.add_jobs("c", self.paths[:1]), 0)
+        self.assertEqual(self.ledger.status("c"), {jobs.PENDING: 3})
+        with self.assertRaises(KeyError):
+            self.ledger.settings("missing")
+
+    def test_claim(self):
+        claimed = [self.ledger.claim("c", "w") for i in range(4)]
+        self.assertIsNone(claimed[-1])
+        self.assertEqual(sorted(job["path"] for job in claimed[:3]), sorted(self.paths))
+        self.assertTrue(all(job["attempts"] == 1 for job in claimed[:3]))
+        self.assertEqual(self.ledger.status("c"), {jobs.RUNNING: 3})
+
+    def test_shards(self):
+        paths = []
+        for shard in range(2):
+            while True:
+                job = self.ledger.claim("c", "w", shard=shard, n_shards=2)
+                if job is None:
+                    break
+                self.assertEqual(jobs.bucket_of(job["path"]) % 2, shard)
+                paths.append(job["path"])
+        self.assertEqual(sorted(paths), sorted(self.paths))
+
+    def test_lease_expiry(self):
+        self.ledger.claim("c", "a")
+        self.ledger.claim("c", "a")
+        job = self.ledger.claim("c", "a", lease=-1.)
+        # only the job with the expired lease can be taken over
+        taken = self.ledger.claim("c", "b")
+        self.assertEqual(taken["id"], job["id"])
+        self.assertEqual(taken["attempts"], 2)
+        self.assertIsNone(self.ledger.claim("c", "b"))
+        with self.assertRaises(jobs.LeaseLost):
+            self.ledger.heartbeat(job["id"], "a")
+        with self.assertRaises(jobs.LeaseLost):
+            self.ledger.complete(job["id"], "a", None, 1, 0, 1.)
+        self.ledger.heartbeat(taken["id"], "b")
+
+    def test_lease_expiry_out_of_attempts(self):
+        for owner in ("a", "b"):
+            job = self.ledger.claim("c", owner, lease=-1., max_attempts=2)
+        self.assertEqual(job["attempts"], 2)
+        self.ledger.claim("c", "c", max_attempts=2)
+        self.assertEqual(self.ledger.status("c")[jobs.DEAD], 1)
+
+    def test_retry_backoff(self):
+        job = self.ledger.claim("c", "w")
+        t0 = time.time()
+        retry_at = self.ledger.fail(job["id"], "w", "boom", job["attempts"], max_attempts=3,
+                                    backoff=10.)
+        self.assertTrue(t0 + 10. <= retry_at <= time.time() + 12.5)
+        # the failed job is not due yet, the others are
+        others = [self.ledger.claim("c", "w") for i in range(3)]
+        self.assertIsNone(others[-1])
+        self.assertNotIn(job["id"], [other["id"] for other in others[:2]])
+        self.assertEqual(self.ledger.next_retry("c"), retry_at)
+
+        # second failure: the delay doubles
+        with self.ledger.conn:
+            self.ledger.conn.execute("UPDATE jobs SET next_attempt=0 WHERE id=?", (job["id"],))
+        job = self.ledger.claim("c", "w")
+        self.assertEqual(job["attempts"], 2)
+        t0 = time.time()
+        retry_at = self.ledger.fail(job["id"], "w", "boom", job["attempts"], max_attempts=3,
+                                    backoff=10.)
+        self.assertTrue(t0 + 20. <= retry_at <= time.time() + 25.)
+
+        # out of attempts: dead, until retried
+        with self.ledger.conn:
+            self.ledger.conn.execute("UPDATE jobs SET next_attempt=0 WHERE id=?", (job["id"],))
+        job = self.ledger.claim("c", "w")
+        self.assertIsNone(self.ledger.fail(job["id"], "w", "boom", job["attempts"], 3))
+        self.assertEqual(self.ledger.status("c")[jobs.DEAD], 1)
+        self.assertEqual(self.ledger.retry("c"), 1)
+        job = self.ledger.claim("c", "w")
+        self.assertEqual(job["attempts"], 1)
+
+    def test_resume_from_checkpoints(self):
+        job = self.ledger.claim("c", "a")
+        self.ledger.set_input_hash(job["id"], "a", "h1")
+        # the last checkpoint lets the lease expire, as if worker a died
+        self.ledger.checkpoint_peak(job["id"], "a", 661.7, peak_rows(661.7, [661.7]))
+        self.ledger.checkpoint_peak(job["id"], "a", 1173.2, peak_rows(1173.2, [1173.2, 1175.]))
+        self.ledger.checkpoint_peak(job["id"], "a", 1332.5, peak_rows(1332.5, []), "no fit",
+                                    lease=-1.)
+        # b takes over and sees a's checkpoints
+        job = self.ledger.claim("c", "b")
+        self.ledger.set_input_hash(job["id"], "b", "h1")
+        np.testing.assert_allclose(np.sort(self.ledger.fitted_locs(job["id"])), [661.7, 1173.2])
+        self.assertEqual(self.ledger.n_failed_peaks(job["id"]), 1)
+        table = self.ledger.peak_table(job["id"])
+        self.assertEqual(table.dtype, np.dtype(spectrum.PEAK_TABLE_DTYPE))
+        np.testing.assert_allclose(table['mean'], [661.7, 1173.2, 1175.])
+
+        # a late write of a no longer owns the job and changes nothing
+        with self.assertRaises(jobs.LeaseLost):
+            self.ledger.checkpoint_peak(job["id"], "a", 661.7, peak_rows(661.7, []), "late")
+        self.ledger.checkpoint_peak(job["id"], "b", 1332.5, peak_rows(1332.5, [1332.5]),
+                                    attempt=2)
+        self.assertEqual(self.ledger.n_failed_peaks(job["id"]), 0)
+        self.assertEqual(len(self.ledger.peak_table(job["id"])), 4)
+        self.ledger.complete(job["id"], "b", None, 4, 0, 1.)
+        self.assertEqual(self.ledger.status("c")[jobs.DONE], 1)
+
+    def test_changed_input_drops_checkpoints(self):
+        job = self.ledger.claim("c", "a")
+        self.ledger.set_input_hash(job["id"], "a", "h1")
+        self.ledger.checkpoint_peak(job["id"], "a", 661.7, peak_rows(661.7, [661.7]))
+        self.ledger.set_input_hash(job["id"], "a", "h2")
+        self.assertEqual(len(self.ledger.fitted_locs(job["id"])), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+"""!
+@brief Tests of the sorted peak index
+"""
+import unittest
+import numpy as np
+from gammaspy.gammaData.peakindex import PeakIndex
+
+
+class TestPeakIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = PeakIndex()
+        self.ids = [self.index.add(loc, "roi_%g" % loc) for loc in (661.7, 121.8, 1332.5, 344.3)]
+
+    def test_add_sorted(self):
+        np.testing.assert_allclose(self.index.locs, [121.8, 344.3, 661.7, 1332.5])
+        self.assertEqual(self.index.ids, [self.ids[i] for i in (1, 3, 0, 2)])
+        self.assertEqual(len(set(self.ids)), 4)
+        self.assertEqual(self.index.get(self.ids[0]), "roi_661.7")
+        self.assertEqual(self.index[344.3], "roi_344.3")
+        self.assertIn(1332.5, self.index)
+        self.assertEqual(self.index.find(661.7 + 1e-3), None)
+        self.assertEqual(self.index.find(661.7 + 1e-3, tol=1e-2), self.ids[0])
+
+    def test_add_duplicate_loc(self):
+        peak_id = self.index.add(661.7, "other")
+        self.assertEqual(len(self.index), 5)
+        self.assertEqual(self.index.step(self.ids[0]), peak_id)
+        self.assertEqual(self.index.position(peak_id), 3)
+
+    def test_remove(self):
+        roi = self.index.remove(self.ids[3])
+        self.assertEqual(roi, "roi_344.3")
+        np.testing.assert_allclose(self.index.locs, [121.8, 661.7, 1332.5])
+        self.assertNotIn(344.3, self.index)
+        self.assertIsNone(self.index.get(self.ids[3]))
+        self.assertEqual(self.index.pop(121.8), "roi_121.8")
+        self.assertIsNone(self.index.pop(121.8, None))
+        with self.assertRaises(KeyError):
+            del self.index[121.8]
+        # ids are never reused
+        self.assertNotIn(self.index.add(50., "new"), self.ids)
+
+    def test_queries(self):
+        peak_id, dist = self.index.nearest(600.)
+        self.assertEqual(peak_id, self.ids[0])
+        self.assertAlmostEqual(dist, 61.7)
+        self.assertEqual(self.index.range(121.8, 1332.5), [self.ids[3], self.ids[0]])
+        np.testing.assert_allclose(self.index.locs_in(0., 500.), [121.8, 344.3])
+        self.assertIsNone(self.index.step(self.ids[2]))
+        self.assertEqual(self.index.step(self.ids[2], -3), self.ids[1])
+        self.assertEqual(PeakIndex().nearest(1.), (None, np.inf))
+
+    def test_relocate(self):
+        self.index.relocate(self.ids[1], 1000.)
+        np.testing.assert_allclose(self.index.locs, [344.3, 661.7, 1000., 1332.5])
+        self.assertEqual(self.index.loc(self.ids[1]), 1000.)
+        self.assertEqual(self.index.position(self.ids[1]), 2)
+        self.assertEqual(self.index[1000.], "roi_121.8")
+        self.assertNotIn(121.8, self.index)
+
+    def test_remap(self):
+        locs = self.index.locs.copy()
+        self.index.remap(lambda e: 1.01 * e + 0.5)
+        np.testing.assert_allclose(self.index.locs, 1.01 * locs + 0.5)
+        self.assertEqual(self.index.loc(self.ids[2]), 1.01 * 1332.5 + 0.5)
+        self.assertEqual(self.index[1.01 * 661.7 + 0.5], "roi_661.7")
+        with self.assertRaises(ValueError):
+            self.index.remap(lambda e: -e)
+        # a rejected map leaves the index unchanged
+        np.testing.assert_allclose(self.index.locs, 1.01 * locs + 0.5)
+
+    def test_locs_read_only(self):
+        with self.assertRaises(ValueError):
+            self.index.locs[0] = 0.
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+"""!
+@brief Tests of template unmixing
+"""
+import unittest
+import numpy as np
+from gammaspy.gammaData import calibration, spectrum, unmix
+
+
+class TestUnmix(unittest.TestCase):
+    def setUp(self):
+        self.unmixer = unmix.TemplateUnmixer()
+        self.res_cal = calibration.ResolutionCalibration(calibration.DEFAULT_FWHM_COEFFS)
+
+    def make_spectrum(self, nuclides, seed):
+        """!
+        @brief Poisson spectrum of the given nuclide line areas on an
+        exponential continuum
+        """
+        energy = 0.5 * np.arange(6000) + 0.2
+        mu = 300. * np.exp(-energy / 400.) + 5.
+        for name, area in nuclides.items():
+            for e_line, intensity in unmix.COMMON_LINES[name]:
+                sigma = self.res_cal.sigma(e_line)
+                mu = mu + area * intensity * 0.5 * np.exp(-(energy - e_line) ** 2 /
+                                                         (2. * sigma ** 2)) / \
+                    (sigma * np.sqrt(2. * np.pi))
+        counts = np.random.RandomState(seed).poisson(mu) / 0.5
+        return spectrum.GammaSpectrum(np.array([energy, counts]).T, {"l_time": 1000.})
+
+    def test_absent_nuclides_not_reported(self):
+        present = {"Cs-137": 2e5, "Co-60": 1e5}
+        for seed in range(3):
+            result = self.make_spectrum(present, seed).screen_nuclides(self.unmixer)
+            for name, amplitude, sig in zip(result["nuclides"], result["amplitude"],
+                                            result["significance"]):
+                if name in present:
+                    self.assertGreater(sig, 10.)
+                    self.assertAlmostEqual(amplitude / present[name], 1., delta=0.02)
+                else:
+                    self.assertLess(sig, 3., name)
+
+    def test_lsq_linear_matches_nnls(self):
+        spec = self.make_spectrum({"Cs-137": 2e5, "K-40": 5e4}, 0)
+        ref = spec.screen_nuclides(self.unmixer)
+        alt = spec.screen_nuclides(self.unmixer, solver="lsq_linear")
+        np.testing.assert_allclose(alt["amplitude"], ref["amplitude"], rtol=1e-3, atol=1.)
+
+
+if __name__ == "__main__":
+    unittest.main()